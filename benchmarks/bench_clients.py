@@ -0,0 +1,62 @@
+"""Per-invocation boto3 client overhead, with and without the registry.
+
+Each simulated invocation builds the clients a full ec2_dns run uses: one EC2
+client and three Route53 clients. No requests are made, so no credentials or
+network access are needed.
+
+    python benchmarks/bench_clients.py [--invocations N]
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import json
+import os
+import time
+import timeit
+
+import boto3
+
+from ec2_route53_lambdas import util
+
+SERVICES = ['ec2', 'route53', 'route53', 'route53']
+
+
+def fresh_clients():
+    for service in SERVICES:
+        boto3.client(service)
+
+
+def registry_clients():
+    for service in SERVICES:
+        util.client(service)
+
+
+def per_invocation(fn, invocations):
+    return timeit.timeit(fn, number=invocations) / invocations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--invocations', type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    # Prime the loader caches shared by both variants, as a warm Lambda would
+    fresh_clients()
+
+    start = time.time()
+    registry_clients()
+    cold = time.time() - start
+
+    results = {
+        'invocations': args.invocations,
+        'fresh_clients_s': per_invocation(fresh_clients, args.invocations),
+        'registry_cold_s': cold,
+        'registry_warm_s': per_invocation(registry_clients, args.invocations)
+    }
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Synthetic EC2 fleets and hosted zones.
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import random
+from datetime import datetime, timedelta
+
+from ec2_route53_lambdas.ec2_dns import records_from_instances
+from ec2_route53_lambdas.util import route53_sort_key
+
+EPOCH = datetime(2017, 1, 1, 0, 0, 0)
+
+
+def vpc_domains(vpc_count):
+    return dict(("vpc-{:08x}".format(i + 1),
+                 "vpc{}.us-east-1.aws.example.com".format(i + 1))
+                for i in range(vpc_count))
+
+
+# About `asg_ratio` of the instances belong to ASGs of `asg_size` instances,
+# `named_ratio` have a Name tag shared by about `name_group_size` instances
+# (some of them already numbered, like "web-1") and the rest are untagged.
+def gen_fleet(size, vpc_map, seed=0, asg_ratio=0.5, named_ratio=0.35,
+              asg_size=20, name_group_size=3):
+    rng = random.Random(seed)
+    vpcs = sorted(vpc_map)
+    instances = []
+
+    for i in range(size):
+        vpc_index = i % len(vpcs)
+        instance = {
+            "InstanceId": "i-{:017x}".format(i + 1),
+            "VpcId": vpcs[vpc_index],
+            "PrivateIpAddress": "10.{}.{}.{}".format(
+                vpc_index, (i // 250) % 250, i % 250 + 1),
+            "LaunchTime": EPOCH + timedelta(seconds=rng.randint(0, 10 ** 7)),
+            "State": {"Code": 16, "Name": "running"},
+            "Tags": [{"Key": "Environment", "Value": "benchmark"}]
+        }
+
+        kind = rng.random()
+        if kind < asg_ratio:
+            group = rng.randint(0, max(size // asg_size, 1))
+            name = "worker-{}".format(group)
+            instance["Tags"].extend([
+                {"Key": "Name", "Value": name},
+                {"Key": "aws:autoscaling:groupName", "Value": name + "-asg"}
+            ])
+        elif kind < asg_ratio + named_ratio:
+            group = rng.randint(0, max(size // name_group_size, 1))
+            name = ("Service {}" if group % 10 else "web-{}").format(group)
+            instance["Tags"].append({"Key": "Name", "Value": name})
+
+        instances.append(instance)
+
+    return instances
+
+
+# The zone left by a previous run: it matches the records for `instances`,
+# except for a `churn` fraction of instances that had a different address,
+# plus `unmanaged` records outside of the managed domains.
+def gen_zone(instances, vpc_map, ttl=60, seed=0, churn=0.02,
+             unmanaged=1000):
+    rng = random.Random(seed)
+    previous = []
+    for instance in instances:
+        if rng.random() < churn:
+            instance = dict(instance, PrivateIpAddress="172.16.{}.{}".format(
+                rng.randint(0, 255), rng.randint(1, 254)))
+        previous.append(instance)
+
+    records = [
+        {
+            "Name": record.name,
+            "Type": record.type,
+            "TTL": record.ttl,
+            "ResourceRecords": [{"Value": v} for v in sorted(record.records)]
+        }
+        for record in records_from_instances(previous, vpc_map, ttl)
+    ]
+
+    for i in range(unmanaged):
+        records.append({
+            "Name": "host-{}.legacy.aws.example.com.".format(i),
+            "Type": "CNAME" if i % 2 else "TXT",
+            "TTL": 300,
+            "ResourceRecords": [{"Value": "other-{}.example.com.".format(i)}]
+        })
+
+    records.sort(key=lambda r: (route53_sort_key(r["Name"]), r["Type"]))
+    return records
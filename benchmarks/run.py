@@ -0,0 +1,156 @@
+"""Time and memory-profile the reconcile hot path on synthetic fleets.
+
+    python benchmarks/run.py --sizes 1000,10000,100000 --output bench.json
+    python benchmarks/run.py --compare bench.json --output new.json
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from fleet import gen_fleet, gen_zone, vpc_domains
+
+from ec2_route53_lambdas import ec2_dns, util
+from ec2_route53_lambdas.fixtures import FakeEc2, FakeRoute53
+
+HOSTED_ZONE_ID = "/hostedzone/Z1111111111111"
+TTL = 60
+
+
+def setup(size, vpc_count):
+    vpc_map = vpc_domains(vpc_count)
+    domains = list(vpc_map.values())
+    instances = gen_fleet(size, vpc_map)
+    zone = gen_zone(instances, vpc_map, TTL)
+    current = frozenset(ec2_dns.extract_existing_records(zone, domains))
+    desired = ec2_dns.records_from_instances(instances, vpc_map, TTL)
+
+    route53 = FakeRoute53(zone)
+
+    def converge(**options):
+        util.register_client("ec2", FakeEc2(instances))
+        util.register_client("route53", route53)
+        route53.changes = []
+        return ec2_dns.converge_records(HOSTED_ZONE_ID, vpc_map, TTL,
+                                        **options)
+
+    return [
+        ("records_from_instances",
+         lambda: ec2_dns.records_from_instances(instances, vpc_map, TTL)),
+        ("extract_existing_records",
+         lambda: list(ec2_dns.extract_existing_records(zone, domains))),
+        ("diff_records",
+         lambda: list(ec2_dns.diff_records(current, desired))),
+        ("converge_records", converge),
+        ("converge_records_bounded", lambda: converge(bounded=True))
+    ]
+
+
+def measure(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    # Retained memory is what the result still holds once built, e.g. the
+    # record sets, as opposed to the peak reached while building it
+    tracemalloc.start()
+    try:
+        result = fn()
+        retained, peak = tracemalloc.get_traced_memory()
+        del result
+    finally:
+        tracemalloc.stop()
+
+    times.sort()
+    return {
+        "min_s": times[0],
+        "median_s": times[len(times) // 2],
+        "peak_bytes": peak,
+        "retained_bytes": retained
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results):
+    base = dict(((r["benchmark"], r["size"]), r) for r in baseline["results"])
+
+    def ratio(result, old, key):
+        if not old or key not in old:
+            return "-"
+        return "{:.2f}".format(result[key] / max(old[key], 1e-9))
+
+    print("{:<26} {:>8} {:>10} {:>6} {:>12} {:>6} {:>12} {:>6}".format(
+        "benchmark", "size", "median_s", "ratio", "peak_bytes", "ratio",
+        "retained", "ratio"))
+    for r in results:
+        old = base.get((r["benchmark"], r["size"]))
+        print("{:<26} {:>8} {:>10.4f} {:>6} {:>12} {:>6} {:>12} {:>6}".format(
+            r["benchmark"], r["size"], r["median_s"],
+            ratio(r, old, "median_s"), r["peak_bytes"],
+            ratio(r, old, "peak_bytes"), r["retained_bytes"],
+            ratio(r, old, "retained_bytes")))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="Comma-separated fleet sizes")
+    parser.add_argument("--vpcs", type=int, default=4,
+                        help="Number of VPCs/domains the fleet is spread over")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", help="Comma-separated benchmark names")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    args = parser.parse_args()
+
+    only = set(args.only.split(",")) if args.only else None
+    results = []
+    for size in map(int, args.sizes.split(",")):
+        for name, fn in setup(size, args.vpcs):
+            if only and name not in only:
+                continue
+
+            result = dict(benchmark=name, size=size, **measure(fn, args.repeat))
+            results.append(result)
+            print("{benchmark:<26} {size:>8} {median_s:>10.4f}s "
+                  "{peak_bytes:>14} bytes".format(**result), file=sys.stderr)
+
+    util.reset_clients()
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "vpcs": args.vpcs,
+        "repeat": args.repeat,
+        "results": results
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    elif not args.output:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
-from troposphere import iam, events, awslambda, sns
+from troposphere import iam, events, awslambda, sns, sqs
 from troposphere import GetAtt, Ref
-from awacs.aws import Action, Allow, Policy, Statement
+from awacs.aws import Action, Allow, ArnEquals, Condition, Policy, \
+    Principal, Statement
 from awacs.helpers.trust import get_lambda_assumerole_policy
 from stacker.blueprints.base import Blueprint
 from stacker.blueprints.variables.types import CFNNumber
@@ -87,3 +88,48 @@ class LambdaBlueprint(Blueprint):
             Principal='sns.amazonaws.com',
             SourceArn=topic
         ))
+
+    def add_lambda_sqs_queue(self, title, function, **kwargs):
+        t = self.template
+
+        # Messages must stay hidden for at least as long as the function
+        # may take to process them
+        queue = t.add_resource(sqs.Queue(
+            title + 'Queue',
+            VisibilityTimeout=Ref('Timeout')
+        ))
+
+        t.add_resource(awslambda.EventSourceMapping(
+            title + 'EventSourceMapping',
+            EventSourceArn=GetAtt(queue, 'Arn'),
+            FunctionName=Ref(function),
+            **kwargs
+        ))
+
+        return queue
+
+    def add_queue_events_rule(self, title, queue, **kwargs):
+        return self.template.add_resource(events.Rule(
+            title + 'ScheduleRule',
+            Targets=[events.Target(Arn=GetAtt(queue, 'Arn'),
+                                   Id=title + 'Queue')],
+            **kwargs
+        ))
+
+    def add_queue_events_policy(self, title, queue, rules):
+        # A queue has a single policy, so it covers all the rules at once
+        return self.template.add_resource(sqs.QueuePolicy(
+            title + 'QueuePolicy',
+            Queues=[Ref(queue)],
+            PolicyDocument=Policy(Version='2012-10-17', Statement=[
+                Statement(
+                    Effect=Allow,
+                    Principal=Principal('Service', 'events.amazonaws.com'),
+                    Action=[Action('sqs', 'SendMessage')],
+                    Resource=[GetAtt(queue, 'Arn')],
+                    Condition=Condition(ArnEquals(
+                        'aws:SourceArn',
+                        [GetAtt(rule, 'Arn') for rule in rules]))
+                )
+            ])
+        ))
@@ -1,4 +1,4 @@
-from troposphere import awslambda
+from troposphere import awslambda, dynamodb
 from troposphere import GetAtt, Ref, Join
 from stacker.blueprints.variables.types import \
     CFNCommaDelimitedList, CFNNumber, CFNString, EC2VPCIdList, \
@@ -24,6 +24,33 @@ class Ec2Dns(LambdaBlueprint):
             'description': 'List of domain prefixes to be used when creating '
                            'records for instances of each VPC'
         },
+        'TargetHostedZoneIDs': {
+            'type': CFNCommaDelimitedList,
+            'description': 'Optional list of Hosted Zone IDs for the VPCs in '
+                           'the same position in TargetVPCIDs. Empty '
+                           'entries use HostedZoneID',
+            'default': ''
+        },
+        'TargetRoleARNs': {
+            'type': CFNCommaDelimitedList,
+            'description': 'Optional list of IAM roles to assume to describe '
+                           'the instances of the VPCs in the same position '
+                           'in TargetVPCIDs, for VPCs of other accounts. '
+                           'Empty entries use the function\'s own role',
+            'default': ''
+        },
+        'TargetRegions': {
+            'type': CFNCommaDelimitedList,
+            'description': 'Optional list of regions of the VPCs in the same '
+                           'position in TargetVPCIDs. Empty entries use the '
+                           'stack\'s region',
+            'default': ''
+        },
+        'Concurrency': {
+            'type': CFNNumber,
+            'description': 'Number of hosted zones updated in parallel',
+            'default': '4'
+        },
         'RecordTTL': {
             'type': CFNNumber,
             'description': 'TTL to assign to created records',
@@ -33,6 +60,134 @@ class Ec2Dns(LambdaBlueprint):
             'type': CFNString,
             'description': 'Time for periodic DNS refresh',
             'default': 'rate(2 minutes)'
+        },
+        'IncrementalEvents': {
+            'type': CFNString,
+            'description': 'Whether instance state change events update only '
+                           'the records of the affected instance, leaving '
+                           'the full refresh to the schedule',
+            'default': 'false',
+            'allowed_values': ['true', 'false']
+        },
+        'StateURL': {
+            'type': CFNString,
+            'description': 'Location (s3://bucket/prefix or a local path) to '
+                           'persist state between runs, such as the zone '
+                           'snapshot. Empty to disable',
+            'default': ''
+        },
+        'SnapshotMaxAge': {
+            'type': CFNNumber,
+            'description': 'Seconds after which the zone snapshot is '
+                           'discarded and the hosted zone listed again',
+            'default': '600'
+        },
+        'FullReconcileInterval': {
+            'type': CFNNumber,
+            'description': 'Seconds between full reconciles of the hosted '
+                           'zones when their instances haven\'t changed. '
+                           'Runs in between stop after describing the '
+                           'instances. Requires StateURL, 0 to always '
+                           'reconcile',
+            'default': '0'
+        },
+        'WaitForSync': {
+            'type': CFNString,
+            'description': 'Whether to wait for Route53 changes to propagate '
+                           'before returning. When false, pending changes '
+                           'are checked on the next run, which requires '
+                           'StateURL',
+            'default': 'true',
+            'allowed_values': ['true', 'false']
+        },
+        'StableSlots': {
+            'type': CFNString,
+            'description': 'Whether numbered records keep their number for '
+                           'the lifetime of their instance, instead of '
+                           'being renumbered by launch time on every run',
+            'default': 'false',
+            'allowed_values': ['true', 'false']
+        },
+        'GroupRouting': {
+            'type': CFNString,
+            'description': 'Routing policy (multivalue or weighted) used to '
+                           'publish Name groups as up to 10 record sets, '
+                           'each holding the instances hashed to it, instead '
+                           'of a single record set. Empty to disable',
+            'default': '',
+            'allowed_values': ['', 'multivalue', 'weighted']
+        },
+        'ListingShards': {
+            'type': CFNNumber,
+            'description': 'Number of ranges of the hosted zone listed in '
+                           'parallel',
+            'default': '1'
+        },
+        'BoundedMemory': {
+            'type': CFNString,
+            'description': 'Whether to reconcile one domain at a time, '
+                           'submitting changes as they are found, to bound '
+                           'memory use on large fleets. Disables the zone '
+                           'snapshot',
+            'default': 'false',
+            'allowed_values': ['true', 'false']
+        },
+        'BatchEvents': {
+            'type': bool,
+            'description': 'Whether to deliver events through an SQS queue, '
+                           'so that bursts of them are handled in batches',
+            'default': False
+        },
+        'BatchSize': {
+            'type': CFNNumber,
+            'description': 'Maximum number of queued events handled by one '
+                           'invocation, when BatchEvents is enabled',
+            'default': '100'
+        },
+        'BatchWindow': {
+            'type': CFNNumber,
+            'description': 'Seconds to wait for queued events to accumulate '
+                           'before invoking the function, when BatchEvents '
+                           'is enabled',
+            'default': '20'
+        },
+        'LifecycleHooks': {
+            'type': bool,
+            'description': 'Whether to add a function handling the launch '
+                           'and terminate lifecycle hooks of Auto Scaling '
+                           'groups, so instances have their records before '
+                           'going InService and lose them before shutting '
+                           'down. The hooks must be added to the groups',
+            'default': False
+        },
+        'DrainTime': {
+            'type': CFNNumber,
+            'description': 'Seconds to wait after removing the records of a '
+                           'terminating instance, for cached answers to '
+                           'expire, when LifecycleHooks is enabled',
+            'default': '60'
+        },
+        'SingleFlight': {
+            'type': bool,
+            'description': 'Whether to hold a lease, kept in a DynamoDB '
+                           'table, while converging, so overlapping '
+                           'invocations never update the zones at once',
+            'default': False
+        },
+        'LeaseContention': {
+            'type': CFNString,
+            'description': 'What an invocation does when another one holds '
+                           'the lease, with SingleFlight: mark it dirty, so '
+                           'the holder converges once more, or skip',
+            'default': 'dirty',
+            'allowed_values': ['dirty', 'skip']
+        },
+        'Debug': {
+            'type': CFNString,
+            'description': 'Whether to log every change submitted to '
+                           'Route53, instead of a bounded summary',
+            'default': 'false',
+            'allowed_values': ['true', 'false']
         }
     }
 
@@ -45,13 +200,74 @@ class Ec2Dns(LambdaBlueprint):
         t = self.template
         v = self.get_variables()
 
-        lambda_role = self.add_lambda_role('Ec2Dns', [
+        permissions = [
             ('ec2', 'DescribeInstances'),
             ('ec2', 'DescribeTags'),
+            ('sts', 'AssumeRole'),
             ('route53', 'ChangeResourceRecordSets'),
             ('route53', 'ListResourceRecordSets'),
-            ('route53', 'GetChange')
-        ])
+            ('route53', 'GetChange'),
+            ('s3', 'GetObject'),
+            ('s3', 'PutObject'),
+            ('s3', 'DeleteObject')
+        ]
+        if v['BatchEvents']:
+            permissions.extend([
+                ('sqs', 'ReceiveMessage'),
+                ('sqs', 'DeleteMessage'),
+                ('sqs', 'GetQueueAttributes')
+            ])
+
+        if v['SingleFlight']:
+            lease_table = t.add_resource(dynamodb.Table(
+                'Ec2DnsLeaseTable',
+                AttributeDefinitions=[dynamodb.AttributeDefinition(
+                    AttributeName='LeaseKey', AttributeType='S')],
+                KeySchema=[dynamodb.KeySchema(
+                    AttributeName='LeaseKey', KeyType='HASH')],
+                BillingMode='PAY_PER_REQUEST'
+            ))
+            lease_url = Join('', ['dynamodb://', Ref(lease_table)])
+            permissions.extend([
+                ('dynamodb', 'PutItem'),
+                ('dynamodb', 'UpdateItem'),
+                ('dynamodb', 'DeleteItem')
+            ])
+        else:
+            lease_url = ''
+
+        if v['LifecycleHooks']:
+            permissions.extend([
+                ('autoscaling', 'CompleteLifecycleAction'),
+                ('ec2', 'CreateTags')
+            ])
+
+        lambda_role = self.add_lambda_role('Ec2Dns', permissions)
+
+        environment = awslambda.Environment(Variables={
+            'EC2_DNS_HOSTED_ZONE_ID': Ref('HostedZoneID'),
+            'EC2_DNS_VPC_IDS': Join(',', Ref('TargetVPCIDs')),
+            'EC2_DNS_VPC_DOMAINS': Join(',', Ref('TargetDomains')),
+            'EC2_DNS_VPC_HOSTED_ZONE_IDS':
+                Join(',', Ref('TargetHostedZoneIDs')),
+            'EC2_DNS_VPC_ROLE_ARNS': Join(',', Ref('TargetRoleARNs')),
+            'EC2_DNS_VPC_REGIONS': Join(',', Ref('TargetRegions')),
+            'EC2_DNS_CONCURRENCY': Ref('Concurrency'),
+            'EC2_DNS_RECORD_TTL': Ref('RecordTTL'),
+            'EC2_DNS_INCREMENTAL_EVENTS': Ref('IncrementalEvents'),
+            'EC2_DNS_STATE_URL': Ref('StateURL'),
+            'EC2_DNS_SNAPSHOT_MAX_AGE': Ref('SnapshotMaxAge'),
+            'EC2_DNS_FULL_RECONCILE_INTERVAL': Ref('FullReconcileInterval'),
+            'EC2_DNS_WAIT_FOR_SYNC': Ref('WaitForSync'),
+            'EC2_DNS_STABLE_SLOTS': Ref('StableSlots'),
+            'EC2_DNS_GROUP_ROUTING': Ref('GroupRouting'),
+            'EC2_DNS_BOUNDED_MEMORY': Ref('BoundedMemory'),
+            'EC2_DNS_LISTING_SHARDS': Ref('ListingShards'),
+            'EC2_DNS_DRAIN_TIME': Ref('DrainTime'),
+            'EC2_DNS_LEASE_URL': lease_url,
+            'EC2_DNS_LEASE_CONTENTION': Ref('LeaseContention'),
+            'EC2_DNS_DEBUG': Ref('Debug')
+        })
 
         func = t.add_resource(awslambda.Function(
             'Ec2DnsLambdaFunction',
@@ -61,24 +277,56 @@ class Ec2Dns(LambdaBlueprint):
             Runtime='python2.7',
             MemorySize=Ref('MemorySize'),
             Timeout=Ref('Timeout'),
-            Environment=awslambda.Environment(Variables={
-                'EC2_DNS_HOSTED_ZONE_ID': Ref('HostedZoneID'),
-                'EC2_DNS_VPC_IDS': Join(',', Ref('TargetVPCIDs')),
-                'EC2_DNS_VPC_DOMAINS': Join(',', Ref('TargetDomains')),
-                'EC2_DNS_RECORD_TTL': Ref('RecordTTL')
-            })
+            Environment=environment
         ))
 
-        self.add_lambda_events_rule(
-            'Ec2DnsInstanceChange', func,
-            EventPattern={
+        if v['LifecycleHooks']:
+            # A function of its own, so lifecycle actions are never queued
+            # behind a full refresh, or batched with other events
+            lifecycle_func = t.add_resource(awslambda.Function(
+                'Ec2DnsLifecycleLambdaFunction',
+                Code=v['Code'],
+                Handler='ec2_route53_lambdas.asg_lifecycle.handler',
+                Role=GetAtt(lambda_role, 'Arn'),
+                Runtime='python2.7',
+                MemorySize=Ref('MemorySize'),
+                Timeout=Ref('Timeout'),
+                Environment=environment
+            ))
+            lifecycle_action = {
+                'EventPattern': {
+                    'source': ['aws.autoscaling'],
+                    'detail-type': ['EC2 Instance-launch Lifecycle Action',
+                                    'EC2 Instance-terminate Lifecycle Action']
+                }
+            }
+            self.add_lambda_events_rule('Ec2DnsLifecycleAction',
+                                        lifecycle_func, **lifecycle_action)
+
+        instance_change = {
+            'EventPattern': {
                 'source': ['aws.ec2'],
                 'detail-type': ['EC2 Instance State-change Notification'],
                 "detail": {
                     "state": ["running", "stopped", "terminated"]
                 }
             }
-        )
+        }
+        refresh = {'ScheduleExpression': Ref('Schedule')}
+
+        if not v['BatchEvents']:
+            self.add_lambda_events_rule('Ec2DnsInstanceChange', func,
+                                        **instance_change)
+            self.add_lambda_events_rule('Ec2DnsRefresh', func, **refresh)
+            return
 
-        self.add_lambda_events_rule(
-            'Ec2DnsRefresh', func, ScheduleExpression=Ref('Schedule'))
+        queue = self.add_lambda_sqs_queue(
+            'Ec2Dns', func,
+            BatchSize=Ref('BatchSize'),
+            MaximumBatchingWindowInSeconds=Ref('BatchWindow'))
+        rules = [
+            self.add_queue_events_rule('Ec2DnsInstanceChange', queue,
+                                       **instance_change),
+            self.add_queue_events_rule('Ec2DnsRefresh', queue, **refresh)
+        ]
+        self.add_queue_events_policy('Ec2Dns', queue, rules)
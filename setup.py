@@ -18,4 +18,9 @@ setup(
     # here and add them to requirements-dev.txt
     #
     # install_requires=['boto3', 'python-dateutil'],
+    entry_points={
+        'console_scripts': [
+            'ec2-dns-plan = ec2_route53_lambdas.cli:main'
+        ]
+    },
     keywords='aws ec2 route53 dns lambda')
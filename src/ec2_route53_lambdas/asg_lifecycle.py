@@ -0,0 +1,154 @@
+"""Publish the records of Auto Scaling instances from their lifecycle hooks.
+
+Launching instances get their records before they go InService, and
+terminating ones lose them, and have them expire from resolver caches,
+before they are shut down.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import os
+import time
+
+from botocore.exceptions import ClientError
+
+from ec2_route53_lambdas.ec2_dns import DRAINING_TAG, \
+    converge_all_from_env, converge_instance, env_flag, \
+    group_routing_from_env, lease_from_env, locations_from_env, \
+    zones_from_env
+from ec2_route53_lambdas.lease import single_flight
+from ec2_route53_lambdas.state import state_store_from_url
+from ec2_route53_lambdas.util import asg, ec2
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+LAUNCHING = "autoscaling:EC2_INSTANCE_LAUNCHING"
+TERMINATING = "autoscaling:EC2_INSTANCE_TERMINATING"
+# EC2 state passed to converge_instance for each transition. Terminating
+# instances are still running, but must be handled as already gone.
+TRANSITION_STATES = {
+    LAUNCHING: "running",
+    TERMINATING: "shutting-down"
+}
+# Seconds of the invocation left for completing the lifecycle action
+MARGIN = 5
+
+
+def complete_lifecycle_action(detail, result="CONTINUE"):
+    try:
+        asg().complete_lifecycle_action(
+            AutoScalingGroupName=detail["AutoScalingGroupName"],
+            LifecycleHookName=detail["LifecycleHookName"],
+            LifecycleActionToken=detail["LifecycleActionToken"],
+            InstanceId=detail["EC2InstanceId"],
+            LifecycleActionResult=result)
+    except ClientError as e:
+        # The action may have timed out, or been completed by an earlier
+        # attempt of the same event
+        if e.response["Error"]["Code"] != "ValidationError":
+            raise
+        logger.warning("Failed to complete lifecycle action for {}: "
+                       "{}".format(detail["EC2InstanceId"], e))
+
+
+# Terminating instances stay running until their action completes, so they
+# are tagged to keep the periodic refresh from publishing them again
+def mark_draining(instance_id):
+    try:
+        ec2().create_tags(Resources=[instance_id],
+                          Tags=[{"Key": DRAINING_TAG, "Value": "true"}])
+    except ClientError as e:
+        logger.warning("Failed to tag {} as draining: {}".format(
+            instance_id, e))
+
+
+def drain(seconds, context=None, sleep=time.sleep):
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000.0
+        seconds = min(seconds, remaining - MARGIN)
+
+    if seconds > 0:
+        logger.info("Waiting {:.0f}s for cached records to expire".format(
+            seconds))
+        sleep(seconds)
+
+
+# Runs `converge` holding `lease` when it's free, and `again` if it was
+# marked dirty meanwhile. The scaling activity can't wait for another
+# invocation holding it, so the change is then made anyway, and the lease
+# marked dirty afterwards, for the holder to converge again from the zone
+# including it.
+def converge_leased(lease, converge, again=None):
+    if lease is None:
+        converge()
+        return
+
+    if single_flight(lease, converge, again=again, mark_dirty=False):
+        return
+
+    converge()
+    if lease.mark_dirty():
+        logger.info("Lease {} is held, marked it dirty".format(lease.key))
+
+
+def handle_lifecycle_action(detail, zones, ttl, state=None, wait=True,
+                            stable_slots=False, group_routing=None,
+                            locations=None, drain_time=0, context=None,
+                            sleep=time.sleep, lease=None, again=None):
+    transition = detail.get("LifecycleTransition")
+    if transition not in TRANSITION_STATES:
+        logger.info("Ignoring lifecycle transition {}".format(transition))
+        return False
+
+    instance_id = detail["EC2InstanceId"]
+
+    def converge():
+        # Only the records of the instance and its name group change, the
+        # rest of the zone is left to the periodic refresh
+        for zone_id, zone_vpc_map in zones.items():
+            converge_instance(zone_id, zone_vpc_map, ttl, instance_id,
+                              TRANSITION_STATES[transition],
+                              state_store=state, wait=wait,
+                              stable_slots=stable_slots,
+                              group_routing=group_routing,
+                              locations=locations)
+
+    try:
+        if transition == TERMINATING:
+            mark_draining(instance_id)
+
+        converge_leased(lease, converge, again)
+
+        if transition == TERMINATING:
+            drain(drain_time, context, sleep=sleep)
+    finally:
+        # A failure to update DNS must not hold up, or abandon, the scaling
+        # activity: the periodic refresh will fix the records later
+        complete_lifecycle_action(detail)
+
+    return True
+
+
+def handler(event, context):
+    zones = zones_from_env()
+    ttl = int(os.environ['EC2_DNS_RECORD_TTL'])
+    state = state_store_from_url(os.environ.get('EC2_DNS_STATE_URL'))
+    wait = env_flag('EC2_DNS_WAIT_FOR_SYNC', default=True)
+    stable_slots = env_flag('EC2_DNS_STABLE_SLOTS')
+    group_routing = group_routing_from_env()
+    locations = locations_from_env()
+    drain_time = int(os.environ.get('EC2_DNS_DRAIN_TIME', ttl))
+
+    detail = event["detail"]
+    logger.info("Handling {} for instance {} of {}".format(
+        detail.get("LifecycleTransition"), detail.get("EC2InstanceId"),
+        detail.get("AutoScalingGroupName")))
+
+    return handle_lifecycle_action(
+        detail, zones, ttl, state=state, wait=wait, stable_slots=stable_slots,
+        group_routing=group_routing, locations=locations,
+        drain_time=drain_time, context=context,
+        lease=lease_from_env(zones, context),
+        again=lambda: converge_all_from_env(zones, ttl))
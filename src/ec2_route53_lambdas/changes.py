@@ -0,0 +1,198 @@
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Route53 limits for a single ChangeResourceRecordSets request. UPSERT
+# actions count twice towards the value and character limits.
+MAX_BATCH_CHANGES = 1000
+MAX_BATCH_VALUES = 1000
+MAX_BATCH_CHARACTERS = 32000
+
+ACTION_ORDER = {"DELETE": 0, "CREATE": 1, "UPSERT": 1}
+
+
+def change_cost(change):
+    record_set = change["ResourceRecordSet"]
+    values = [r["Value"] for r in record_set.get("ResourceRecords", [])]
+    # Alias records carry no values, but still take up a slot in the batch
+    count = max(len(values), 1)
+    characters = sum(len(v) for v in values)
+
+    if change["Action"] == "UPSERT":
+        return count * 2, characters * 2
+
+    return count, characters
+
+
+class ChangeBatch(object):
+    def __init__(self, max_changes=MAX_BATCH_CHANGES,
+                 max_values=MAX_BATCH_VALUES,
+                 max_characters=MAX_BATCH_CHARACTERS):
+        self.max_changes = max_changes
+        self.max_values = max_values
+        self.max_characters = max_characters
+
+        self.changes = []
+        self.values = 0
+        self.characters = 0
+
+    def fits(self, changes):
+        values, characters = self._cost(changes)
+        return (len(self.changes) + len(changes) <= self.max_changes and
+                self.values + values <= self.max_values and
+                self.characters + characters <= self.max_characters)
+
+    def add(self, changes):
+        values, characters = self._cost(changes)
+        self.changes.extend(changes)
+        self.values += values
+        self.characters += characters
+
+    @staticmethod
+    def _cost(changes):
+        costs = [change_cost(c) for c in changes]
+        return sum(c[0] for c in costs), sum(c[1] for c in costs)
+
+
+def group_changes(changes):
+    groups = OrderedDict()
+    for change in changes:
+        name = change["ResourceRecordSet"]["Name"].rstrip(".")
+        groups.setdefault(name, []).append(change)
+
+    for name, group in groups.items():
+        # Stable sort, so DELETEs for a name come before its CREATEs/UPSERTs
+        yield sorted(group, key=lambda c: ACTION_ORDER[c["Action"]])
+
+
+def new_change_batch(group, **limits):
+    batch = ChangeBatch(**limits)
+    if not batch.fits(group):
+        raise ValueError("Change for {} exceeds Route53 batch limits".format(
+            group[0]["ResourceRecordSet"]["Name"]))
+
+    batch.add(group)
+    return batch
+
+
+# Changes for the same name are kept in the same batch whenever they fit, so
+# Route53 applies them in order. Batches in a wave are independent and can be
+# submitted concurrently. Names with more changes than fit in one batch are
+# split into extra single-batch waves, submitted one after the other.
+def plan_change_batches(changes, **limits):
+    independent = []
+    sequential = []
+
+    for group in group_changes(changes):
+        if not ChangeBatch(**limits).fits(group):
+            batch = None
+            for change in group:
+                if batch is None or not batch.fits([change]):
+                    batch = new_change_batch([change], **limits)
+                    sequential.append([batch])
+                else:
+                    batch.add([change])
+            continue
+
+        for batch in independent:
+            if batch.fits(group):
+                batch.add(group)
+                break
+        else:
+            independent.append(new_change_batch(group, **limits))
+
+    waves = ([independent] if independent else []) + sequential
+    return [[batch.changes for batch in wave] for wave in waves]
+
+
+def submit_change_batch(client, hosted_zone_id, changes):
+    response = client.change_resource_record_sets(
+        HostedZoneId=hosted_zone_id, ChangeBatch={"Changes": changes})
+    return response["ChangeInfo"]
+
+
+def submit_change_batches(client, hosted_zone_id, waves, concurrency=4):
+    change_infos = []
+
+    def submit(changes):
+        return submit_change_batch(client, hosted_zone_id, changes)
+
+    for wave in waves:
+        if len(wave) == 1 or concurrency <= 1:
+            change_infos.extend(map(submit, wave))
+            continue
+
+        pool = ThreadPool(min(concurrency, len(wave)))
+        try:
+            change_infos.extend(pool.map(submit, wave))
+        finally:
+            pool.close()
+            pool.join()
+
+    return change_infos
+
+
+# Submits changes in batches as they are added, so the full list of changes
+# is never built. Batches go out one at a time and in order, so a change only
+# reaches Route53 after every change added before it.
+class ChangeStream(object):
+    def __init__(self, client, hosted_zone_id, **limits):
+        self.client = client
+        self.hosted_zone_id = hosted_zone_id
+        self.limits = limits
+
+        self.batch = ChangeBatch(**limits)
+        self.change_infos = []
+        self.count = 0
+
+    def add(self, change):
+        if not self.batch.fits([change]):
+            self.flush()
+            if not self.batch.fits([change]):
+                raise ValueError(
+                    "Change for {} exceeds Route53 batch limits".format(
+                        change["ResourceRecordSet"]["Name"]))
+
+        self.batch.add([change])
+        self.count += 1
+
+    def flush(self):
+        if not self.batch.changes:
+            return
+
+        self.change_infos.append(submit_change_batch(
+            self.client, self.hosted_zone_id, self.batch.changes))
+        self.batch = ChangeBatch(**self.limits)
+
+
+def poll_changes(client, change_ids):
+    return dict((change_id,
+                 client.get_change(Id=change_id)["ChangeInfo"]["Status"])
+                for change_id in change_ids)
+
+
+def wait_changes(client, change_infos, delay=30, max_attempts=60):
+    pending = [info["Id"] for info in change_infos
+               if info["Status"] != "INSYNC"]
+
+    for attempt in range(max_attempts):
+        if not pending:
+            return
+
+        if attempt > 0:
+            time.sleep(delay)
+
+        statuses = poll_changes(client, pending)
+        pending = [change_id for change_id in pending
+                   if statuses[change_id] != "INSYNC"]
+
+    if pending:
+        raise RuntimeError(
+            "Timed out waiting for Route53 changes: {}".format(pending))
@@ -0,0 +1,142 @@
+"""Run the EC2 DNS reconciliation offline, against captured inventories.
+
+    ec2-dns-plan --instances instances.json --zone zone.json \\
+        --vpc vpc-11111111=prod.example.com --profile run.prof
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import argparse
+import cProfile
+import json
+import logging
+import sys
+
+from ec2_route53_lambdas import ec2_dns
+from ec2_route53_lambdas.fixtures import \
+    FakeEc2, FakeRoute53, load_instances, load_record_sets
+from ec2_route53_lambdas.metrics import Metrics
+from ec2_route53_lambdas.util import register_client, reset_clients
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+HOSTED_ZONE_ID = "/hostedzone/OFFLINE"
+
+
+def load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def parse_vpc(value):
+    vpc, sep, domain = value.partition("=")
+    if not sep or not vpc or not domain:
+        raise argparse.ArgumentTypeError(
+            "expected VPC_ID=DOMAIN, got {!r}".format(value))
+    return vpc, domain
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Plan the Route53 changes for captured EC2 instances and "
+                    "hosted zone records, without calling AWS")
+    parser.add_argument("--instances", required=True,
+                        help="JSON output of describe-instances")
+    parser.add_argument("--zone",
+                        help="JSON output of list-resource-record-sets. "
+                             "Defaults to an empty zone")
+    parser.add_argument("--vpc", action="append", type=parse_vpc,
+                        required=True, metavar="VPC_ID=DOMAIN",
+                        help="Managed VPC and its domain, can be repeated")
+    parser.add_argument("--ttl", type=int, default=60)
+    parser.add_argument("--hosted-zone-id", default=HOSTED_ZONE_ID)
+    parser.add_argument("--stable-slots", action="store_true")
+    parser.add_argument("--group-routing",
+                        choices=sorted(ec2_dns.GROUP_ROUTING),
+                        help="Split Name groups into hashed shards of "
+                             "record sets with this routing policy")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the planned changes as JSON")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write cProfile stats for the run to PATH")
+    parser.add_argument("--tracemalloc", metavar="PATH",
+                        help="Write the top memory allocations of the run "
+                             "to PATH")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Print the run metrics in EMF to stderr")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Log the progress of the run to stderr")
+
+    args = parser.parse_args(argv)
+    if args.tracemalloc and tracemalloc is None:
+        parser.error("--tracemalloc requires Python 3.4 or later")
+    return args
+
+
+def plan(instances, records, vpc_map, ttl, hosted_zone_id=HOSTED_ZONE_ID,
+         metrics=None, **options):
+    route53 = FakeRoute53(records)
+    register_client("ec2", FakeEc2(instances))
+    register_client("route53", route53)
+    try:
+        ec2_dns.converge_records(hosted_zone_id, vpc_map, ttl,
+                                 metrics=metrics, **options)
+    finally:
+        reset_clients()
+
+    return route53.changes
+
+
+def write_allocations(snapshot, path, limit=50):
+    with open(path, "w") as f:
+        for stat in snapshot.statistics("lineno")[:limit]:
+            f.write("{}\n".format(stat))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(stream=sys.stderr)
+    ec2_dns.logger.setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    instances = load_instances(load_json(args.instances))
+    records = load_record_sets(load_json(args.zone)) if args.zone else []
+    metrics = Metrics(dimensions={"HostedZoneId": "offline"})
+
+    profile = cProfile.Profile() if args.profile else None
+    if args.tracemalloc:
+        tracemalloc.start()
+    if profile:
+        profile.enable()
+
+    try:
+        changes = plan(instances, records, dict(args.vpc), args.ttl,
+                       hosted_zone_id=args.hosted_zone_id, metrics=metrics,
+                       stable_slots=args.stable_slots,
+                       group_routing=args.group_routing)
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        if args.tracemalloc:
+            write_allocations(tracemalloc.take_snapshot(), args.tracemalloc)
+            tracemalloc.stop()
+
+    if args.json:
+        json.dump(changes, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        for change in changes:
+            print(ec2_dns.format_change(change))
+
+    if args.metrics:
+        metrics.emit(sys.stderr)
+
+    print(ec2_dns.summarize_changes(changes, limit=0), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,34 +1,146 @@
 from __future__ import absolute_import, unicode_literals
 
+import hashlib
+import json
 import re
 import pprint
 import os
 import logging
+import time
+from collections import OrderedDict
 from datetime import datetime
+from itertools import count, takewhile
+from multiprocessing.pool import ThreadPool
 
+from botocore.exceptions import ClientError
+
+from ec2_route53_lambdas.changes import \
+    ChangeStream, plan_change_batches, poll_changes, submit_change_batches, \
+    wait_changes
+from ec2_route53_lambdas.events import coalesce_events, unwrap_events
+from ec2_route53_lambdas.lease import \
+    LEASE_DURATION, Lease, lease_store_from_url, single_flight
+from ec2_route53_lambdas.metrics import Metrics
+from ec2_route53_lambdas.state import \
+    SNAPSHOT_MAX_AGE, InventoryFingerprint, PendingChanges, ZoneSnapshot, \
+    state_store_from_url
 from ec2_route53_lambdas.util import \
-    RecordSet, clean_hostname, ec2, route53
+    ROUTE53_SCHEDULER, DomainIndex, RecordSet, clean_hostname, ec2, route53, \
+    route53_sort_key
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+LIVE_STATES = ("pending", "running")
+MANAGED_TYPES = ("A", "CNAME")
+CONCURRENCY = 4
+# Batches with more instances than this converge the whole zone once, rather
+# than each instance on its own
+INCREMENTAL_LIMIT = 5
+CHANGE_ACTIONS = ("CREATE", "UPSERT", "DELETE")
+CHANGE_SUMMARY_LIMIT = 20
+# With a group routing policy, Name groups are published as this many
+# record sets, each holding the addresses of the instances hashed to it,
+# rather than as a single record set whose changes may not fit in a Route53
+# change batch
+GROUP_SHARDS = 10
+GROUP_ROUTING = {
+    "multivalue": ("MultiValueAnswer", True),
+    "weighted": ("Weight", 1)
+}
+# Number of accounts and regions whose instances are described at once
+INVENTORY_CONCURRENCY = 8
+# Number of addresses looked up per DescribeInstances call
+ADDRESS_BATCH_SIZE = 200
+# Tag of the instances whose terminate lifecycle action is draining them.
+# They are still running meanwhile, but no longer get any records.
+DRAINING_TAG = "ec2-dns:draining"
+
+
+def assign_slots(instances, taken=None):
+    # Instances keep the slot recorded for their address, if any, and the
+    # rest fill the lowest free slots in launch order
+    taken = taken or {}
+    slots = [None] * len(instances)
+    used = set()
+    for i, instance in enumerate(instances):
+        slot = taken.get(instance["PrivateIpAddress"])
+        if slot is not None and slot not in used:
+            slots[i] = slot
+            used.add(slot)
+
+    free = (n for n in count(1) if n not in used)
+    return [(instance, slot if slot is not None else next(free))
+            for instance, slot in zip(instances, slots)]
+
+
+def numbered_slots(records, domains):
+    index = DomainIndex(domains)
+    slots = {}
+    for record in records:
+        domain = index.match(record.name)
+        if domain is None or record.type != "A" or \
+                record.set_identifier is not None or len(record.records) != 1:
+            continue
+
+        label = record.name[:-len(RecordSet.normalize_name(domain)) - 1]
+        match = re.match(r'^(.+)-(\d+)$', label)
+        if match:
+            name, slot = match.group(1), int(match.group(2))
+            ip, = record.records
+            slots.setdefault((name, domain), {})[ip] = slot
+
+    return slots
+
+
+def stable_hash(instance_id):
+    return hashlib.sha1(instance_id.encode("utf-8")).hexdigest()
+
+
+def group_shard(instance_id):
+    return int(stable_hash(instance_id), 16) % GROUP_SHARDS
+
+
+# Splits a Name group into up to GROUP_SHARDS record sets, identified by
+# their shard number. Instances always hash to the same shard, so instances
+# joining or leaving the group only change the record set of theirs.
+def shard_group_records(name, ttl, instances, group_routing):
+    shards = {}
+    for instance in instances:
+        shards.setdefault(group_shard(instance["InstanceId"]), []).append(
+            instance["PrivateIpAddress"])
 
-def records_from_instances(instances, vpc_map, ttl=60):
+    return [RecordSet(name, "A", ttl, ips, set_identifier=str(shard),
+                      routing=GROUP_ROUTING[group_routing])
+            for shard, ips in sorted(shards.items())]
+
+
+# Numbered records are assigned in launch order by default, so they shift
+# whenever an earlier instance goes away. With `slots` (as returned by
+# `numbered_slots` for the current records) instances keep their numbers.
+# With `group_routing` (a key of GROUP_ROUTING), Name groups are split with
+# `shard_group_records`. Instances tagged with DRAINING_TAG get no records.
+def records_from_instances(instances, vpc_map, ttl=60, slots=None,
+                           group_routing=None):
     zones = {}
-    indexes = {}
+    groups = {}
+    members = {}
 
     for instance in sorted(instances, key=lambda inst: inst["LaunchTime"]):
         domain = vpc_map.get(instance["VpcId"])
         if not domain:
             continue
 
+        tags = dict((t["Key"], t["Value"]) for t in instance.get("Tags", []))
+        if DRAINING_TAG in tags:
+            continue
+
         instance_id = instance["InstanceId"]
         ips = frozenset([instance["PrivateIpAddress"]])
         zones[(instance_id, domain)] = \
             RecordSet(instance_id + "." + domain, "A", ttl, ips)
 
-        tags = dict((t["Key"], t["Value"]) for t in instance.get("Tags", []))
         name = tags.get("Name")
         if not name:
             continue
@@ -37,135 +149,1021 @@ def records_from_instances(instances, vpc_map, ttl=60):
         asg_name = tags.get("aws:autoscaling:groupName")
         index_match = re.match(r'^(.+)-(\d+)$', name)
         if not asg_name and not index_match:
-            prev_index = indexes.get((name, domain), 0)
-            index = indexes[(name, domain)] = prev_index + 1
-            indexed_name = "{}-{}".format(name, index)
-
-            zones[(indexed_name, domain)] = \
-                RecordSet(indexed_name + "." + domain, "A", ttl, ips)
+            groups.setdefault((name, domain), []).append(instance)
 
         record = RecordSet(name + "." + domain, "A", ttl, ips)
         old_record = zones.get((name, domain), None)
         zones[(name, domain)] = record.merge(old_record)
+        if group_routing:
+            members.setdefault((name, domain), []).append(instance)
+
+    for (name, domain), group in groups.items():
+        taken = slots.get((name, domain)) if slots else None
+        for instance, index in assign_slots(group, taken):
+            indexed_name = "{}-{}".format(name, index)
+            ips = frozenset([instance["PrivateIpAddress"]])
+            zones[(indexed_name, domain)] = \
+                RecordSet(indexed_name + "." + domain, "A", ttl, ips)
+
+    for (name, domain), group in members.items():
+        record = zones.pop((name, domain))
+        for shard in shard_group_records(record.name, ttl, group,
+                                         group_routing):
+            zones[(name, domain, shard.set_identifier)] = shard
 
     return frozenset(zones.values())
 
 
-def records_from_running_instances(vpc_map, ttl):
-    response = ec2().describe_instances(Filters=[{
-        "Name": "instance-state-name", "Values": ["pending", "running"]
-    }])
-    instances = [i for r in response["Reservations"] for i in r["Instances"]]
+INSTANCE_FIELDS = ("InstanceId", "VpcId", "PrivateIpAddress", "LaunchTime")
+INSTANCE_TAGS = ("Name", "aws:autoscaling:groupName", DRAINING_TAG)
+
 
-    return records_from_instances(instances, vpc_map, ttl)
+def slim_instance(instance):
+    slim = dict((k, instance[k]) for k in INSTANCE_FIELDS if k in instance)
+    slim["Tags"] = [t for t in instance.get("Tags", [])
+                    if t["Key"] in INSTANCE_TAGS]
+    return slim
+
+
+def running_instances(vpc_ids, client=None):
+    if not vpc_ids:
+        return
+
+    filters = [
+        {"Name": "instance-state-name", "Values": list(LIVE_STATES)},
+        {"Name": "vpc-id", "Values": sorted(vpc_ids)}
+    ]
+
+    paginator = (client or ec2()).get_paginator("describe_instances")
+    for page in paginator.paginate(Filters=filters):
+        for reservation in page["Reservations"]:
+            for instance in reservation["Instances"]:
+                yield slim_instance(instance)
+
+
+# VPCs in other accounts or regions are given in `locations`, mapping their
+# IDs to a (role ARN, region) pair, either of which can be None for the ones
+# the function runs with. VPCs not in `locations` are local.
+def location_vpcs(vpc_ids, locations=None):
+    groups = OrderedDict()
+    for vpc in sorted(vpc_ids):
+        groups.setdefault((locations or {}).get(vpc), []).append(vpc)
+
+    return groups
+
+
+def location_ec2(location):
+    return ec2(*location) if location else ec2()
+
+
+# Instances of every location are described concurrently, through clients
+# for the location's role and region
+def instances_in_vpcs(vpc_ids, locations=None):
+    groups = list(location_vpcs(vpc_ids, locations).items())
+
+    def describe(group):
+        location, vpcs = group
+        return list(running_instances(vpcs, client=location_ec2(location)))
+
+    if len(groups) <= 1:
+        return [i for group in groups for i in describe(group)]
+
+    pool = ThreadPool(min(INVENTORY_CONCURRENCY, len(groups)))
+    try:
+        return [i for instances in pool.map(describe, groups)
+                for i in instances]
+    finally:
+        pool.close()
+        pool.join()
+
+
+def iter_instances(vpc_ids, locations=None):
+    for location, vpcs in location_vpcs(vpc_ids, locations).items():
+        for instance in running_instances(vpcs, client=location_ec2(location)):
+            yield instance
+
+
+# Digest of everything records are derived from: the instances' IDs, VPCs,
+# addresses, tags and launch times (which give the order of numbered
+# records), and the settings in `config`. Instance digests are added up, so
+# the result doesn't depend on the order instances are listed in, and they
+# can be streamed through without being held in memory.
+def inventory_fingerprint(instances, config):
+    total = 0
+    size = 0
+    for instance in instances:
+        tags = dict((t["Key"], t["Value"]) for t in instance.get("Tags", []))
+        fields = [instance["InstanceId"], instance.get("VpcId"),
+                  instance.get("PrivateIpAddress"), tags.get("Name"),
+                  tags.get("aws:autoscaling:groupName"),
+                  str(instance.get("LaunchTime")), DRAINING_TAG in tags]
+        digest = hashlib.sha1(json.dumps(fields).encode("utf-8"))
+        total = (total + int(digest.hexdigest(), 16)) % 2 ** 160
+        size += 1
+
+    settings = json.dumps(config, sort_keys=True)
+    return "{}-{:040x}-{}".format(
+        size, total, hashlib.sha1(settings.encode("utf-8")).hexdigest())
+
+
+def records_from_running_instances(vpc_map, ttl, metrics=None, slots=None,
+                                   group_routing=None, locations=None,
+                                   instances=None):
+    metrics = metrics or Metrics()
+
+    if instances is None:
+        with metrics.timer("Inventory"):
+            instances = instances_in_vpcs(vpc_map.keys(), locations)
+    metrics.add("Instances", len(instances))
+
+    with metrics.timer("Derivation"):
+        records = records_from_instances(instances, vpc_map, ttl,
+                                         slots=slots,
+                                         group_routing=group_routing)
+    metrics.add("Records", len(records))
+
+    return records
 
 
 def extract_existing_records(records, domains):
-    domains = list(map(RecordSet.normalize_name, domains))
+    index = domains if isinstance(domains, DomainIndex) \
+        else DomainIndex(domains)
+
     for record in records:
         tpe = record["Type"]
-        if tpe not in ("A", "CNAME"):
-            pass
+        if tpe not in MANAGED_TYPES:
+            continue
 
         name = record["Name"]
-        for domain in domains:
-            if name.endswith("." + domain):
-                break
-        else:
+        if index.match(name) is None:
             continue
 
-        resources = {r["Value"] for r in record["ResourceRecords"]}
-        yield RecordSet(name, tpe, record["TTL"], resources,
-                        original_json=record)
+        yield RecordSet.from_json(record)
 
 
-def existing_records(hosted_zone_id, domains):
-    records = set()
-    paginator = route53().get_paginator("list_resource_record_sets")
-    for page in paginator.paginate(HostedZoneId=hosted_zone_id):
-        page_records = extract_existing_records(
-            page["ResourceRecordSets"], domains)
-        for record in page_records:
-            records.add(record)
+# Splits the zone into `shards` ranges of names, delimited by evenly spaced
+# names among `boundaries`. Each range is given by the name to start listing
+# from (None for the start of the zone) and the sort key of the first name
+# past it (None for the end of the zone).
+def shard_ranges(boundaries, shards):
+    keys = sorted(set((route53_sort_key(n), RecordSet.normalize_name(n))
+                      for n in boundaries))
+    shards = min(shards, len(keys) + 1)
+    if shards <= 1:
+        return [(None, None)]
 
-    return frozenset(records)
+    bounds = sorted(set(keys[len(keys) * i // shards]
+                        for i in range(1, shards)))
 
+    starts = [None] + [name for _, name in bounds]
+    ends = [key for key, _ in bounds] + [None]
+    return list(zip(starts, ends))
 
-def diff_records(old, new):
-    old = sorted(old, key=lambda r: r.name)
-    new = sorted(new, key=lambda r: r.name)
 
-    old_i = iter(old)
-    new_i = iter(new)
+# Leftmost labels splitting a domain with no known names inside it: about
+# half of the managed records are instance ID records, spread evenly over
+# the hex digits after "i-", and the rest are spread over the first letter
+# of their names
+FALLBACK_LABELS = ["i-" + c for c in "0123456789abcdef"] + \
+    list("abcdefghijklmnopqrstuvwxyz")
+
 
+# The ranges of the zone holding the names of `domains`, in Route53 order,
+# each split in up to `shards` ranges at the `boundaries` inside it, or at
+# FALLBACK_LABELS when there are none. Domains nested in other managed
+# domains are already covered by their parents.
+def domain_ranges(domains, shards=1, boundaries=()):
+    sections = sorted(set((route53_sort_key(d), RecordSet.normalize_name(d))
+                          for d in domains))
+    ranges = []
+    for i, (prefix, name) in enumerate(sections):
+        if any(prefix.startswith(p) for p, _ in sections[:i]):
+            continue
+
+        # Every name under the domain sorts before the key of the domain with
+        # its trailing dot replaced by the next character
+        inside = [n for n in boundaries
+                  if route53_sort_key(n).startswith(prefix) and
+                  RecordSet.normalize_name(n) != name]
+        if not inside:
+            inside = [label + "." + name for label in FALLBACK_LABELS]
+        for start, end in shard_ranges(inside, shards):
+            ranges.append((start or name, end or prefix[:-1] + "/"))
+
+    return ranges
+
+
+# Only the sections of the zone holding the managed domains are listed, so
+# the cost depends on the size of the managed domains rather than on the
+# whole zone.
+def existing_records_stream(hosted_zone_id, domains, shards=1,
+                            boundaries=None):
+    index = DomainIndex(domains)
+    ranges = domain_ranges(domains, shards, boundaries or ())
+
+    def list_range(shard):
+        return extract_existing_records(
+            list_record_range(hosted_zone_id, *shard), index)
+
+    if shards <= 1:
+        for shard in ranges:
+            for record in list_range(shard):
+                yield record
+        return
+
+    # Ranges are listed concurrently, within the Route53 request budget, and
+    # merged back in order, so the result is the same as listing serially
+    pool = ThreadPool(min(shards, len(ranges)))
     try:
-        old_r = next(old_i)
-        new_r = next(new_i)
-
-        while True:
-            if old_r.name < new_r.name:
-                yield old_r.delete_request()
-                old_r = next(old_i)
-            elif old_r.name > new_r.name:
-                yield new_r.change_request()
-                new_r = next(new_i)
-            else:
-                if old_r != new_r:
-                    yield new_r.change_request(existing=True)
-                old_r = next(old_i)
-                new_r = next(new_i)
-    except StopIteration:
-        pass
+        for records in pool.imap(lambda shard: list(list_range(shard)),
+                                 ranges):
+            for record in records:
+                yield record
+    finally:
+        pool.close()
+        pool.join()
+
+
+def existing_records(hosted_zone_id, domains, shards=1, boundaries=None):
+    return frozenset(existing_records_stream(
+        hosted_zone_id, domains, shards=shards, boundaries=boundaries))
+
+
+def record_key(record):
+    return record.name, record.type, record.set_identifier
+
+
+# Only the desired records are indexed: the existing ones are consumed
+# lazily, so they can be streamed straight from the zone listing.
+def diff_records(old, new):
+    pending = dict((record_key(r), r) for r in new)
+
+    for record in old:
+        updated = pending.pop(record_key(record), None)
+        if updated is None:
+            yield record.delete_request()
+        elif updated != record:
+            yield updated.change_request(existing=True)
 
+    for record in pending.values():
+        yield record.change_request()
+
+
+def list_record_sets(hosted_zone_id, start_name=None):
+    params = {"HostedZoneId": hosted_zone_id}
+    if start_name:
+        params["StartRecordName"] = RecordSet.normalize_name(start_name)
+    client = route53()
+
+    while True:
+        response = client.list_resource_record_sets(**params)
+        for record in response["ResourceRecordSets"]:
+            yield record
+
+        if not response["IsTruncated"]:
+            return
+
+        params["StartRecordName"] = response["NextRecordName"]
+        for key in ("Type", "Identifier"):
+            if "NextRecord" + key in response:
+                params["StartRecord" + key] = response["NextRecord" + key]
+
+
+def list_record_range(hosted_zone_id, start_name=None, end_key=None):
+    records = list_record_sets(hosted_zone_id, start_name)
+    if end_key is None:
+        return records
+
+    return takewhile(lambda r: route53_sort_key(r["Name"]) < end_key,
+                     records)
+
+
+def list_record_section(hosted_zone_id, start_name, key_prefix):
+    return takewhile(
+        lambda r: route53_sort_key(r["Name"]).startswith(key_prefix),
+        list_record_sets(hosted_zone_id, start_name))
+
+
+def records_named(hosted_zone_id, name):
+    name = RecordSet.normalize_name(name)
+    records = list_record_section(hosted_zone_id, name,
+                                  route53_sort_key(name))
+    return takewhile(
+        lambda r: RecordSet.normalize_name(r["Name"]) == name, records)
+
+
+def describe_instance(instance_id):
     try:
-        while True:
-            yield next(old_i).delete_request()
-    except StopIteration:
-        pass
+        response = ec2().describe_instances(InstanceIds=[instance_id])
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "InvalidInstanceID.NotFound":
+            return None, None
+        raise
+
+    for reservation in response["Reservations"]:
+        for instance in reservation["Instances"]:
+            return slim_instance(instance), instance["State"]["Name"]
+
+    return None, None
+
+
+# Instances whose records fall in the group of `name`: the ones tagged with
+# it, and the ones already published at `addresses` by the group's records.
+# Record names are cleaned up Name tags, so tags that only differ in case or
+# punctuation share a group, and the latter finds them without describing
+# every instance of the VPCs.
+def instances_named(name, vpc_ids, client=None, addresses=()):
+    pattern = re.compile(r"^{}(-\d+)?$".format(re.escape(clean_hostname(name))))
+    filters = [
+        {"Name": "instance-state-name", "Values": list(LIVE_STATES)},
+        {"Name": "vpc-id", "Values": sorted(vpc_ids)}
+    ]
+    selections = [{"Name": "tag:Name", "Values": [name, name + "-*"]}]
+    addresses = sorted(addresses)
+    for start in range(0, len(addresses), ADDRESS_BATCH_SIZE):
+        selections.append({"Name": "private-ip-address",
+                           "Values": addresses[start:start +
+                                               ADDRESS_BATCH_SIZE]})
+
+    client = client or ec2()
+    seen = set()
+    for selection in selections:
+        paginator = client.get_paginator("describe_instances")
+        for page in paginator.paginate(Filters=filters + [selection]):
+            for reservation in page["Reservations"]:
+                for instance in reservation["Instances"]:
+                    instance = slim_instance(instance)
+                    if instance["InstanceId"] in seen:
+                        continue
+                    seen.add(instance["InstanceId"])
+
+                    tag = instance_name(instance)
+                    if tag and pattern.match(clean_hostname(tag)):
+                        yield instance
+
+
+def instance_name(instance):
+    for tag in instance.get("Tags", []):
+        if tag["Key"] == "Name":
+            return tag["Value"]
+
+    return None
+
+
+def name_group_matcher(name, domain):
+    name = clean_hostname(name)
+    pattern = re.compile(r"^{}(-\d+)?\.{}$".format(
+        re.escape(name), re.escape(RecordSet.normalize_name(domain))))
+    return lambda record_name: bool(pattern.match(record_name))
+
+
+def existing_instance_records(hosted_zone_id, instance_id, name, domain):
+    names = [instance_id + "." + domain]
+    if name:
+        name = clean_hostname(name)
+        names.append(name + "." + domain)
+
+    records = [r for n in names for r in records_named(hosted_zone_id, n)]
+    if name:
+        # Numbered records ("name-N") sort between "name-" and "name-."
+        numbered_start = name + "-." + domain
+        prefix = route53_sort_key(domain) + name + "-"
+        records.extend(list_record_section(hosted_zone_id, numbered_start,
+                                           prefix))
+
+    return extract_existing_records(records, [domain])
+
+
+def instance_domains(hosted_zone_id, instance, vpc_map):
+    if instance and instance.get("VpcId"):
+        domain = vpc_map.get(instance["VpcId"])
+        return [domain] if domain else []
+
+    # Instances that were terminated a while ago lose their VPC, so look for
+    # the domain that still holds their ID record
+    instance_id = instance["InstanceId"]
+    return [domain for domain in sorted(set(vpc_map.values()))
+            if any(records_named(hosted_zone_id, instance_id + "." + domain))]
+
+
+def converge_instance(hosted_zone_id, vpc_map, ttl, instance_id, state,
+                      state_store=None, wait=True, stable_slots=False,
+                      group_routing=None, locations=None):
+    if state_store:
+        check_pending_changes(hosted_zone_id, state_store)
+
+    instance, current_state = describe_instance(instance_id)
+    if instance is None:
+        instance = {"InstanceId": instance_id}
+
+    live = state in LIVE_STATES and current_state in LIVE_STATES
+    name = instance_name(instance)
+
+    changes = []
+    for domain in instance_domains(hosted_zone_id, instance, vpc_map):
+        domain_vpcs = dict((vpc, d) for vpc, d in vpc_map.items()
+                           if d == domain)
+
+        id_name = RecordSet.normalize_name(instance_id + "." + domain)
+        in_group = name_group_matcher(name, domain) if name else None
+
+        def affected(record):
+            return record.name == id_name or bool(
+                in_group and in_group(record.name))
+
+        current = list(existing_instance_records(hosted_zone_id, instance_id,
+                                                 name, domain))
+
+        instances = {}
+        if name:
+            addresses = set(ip for record in current
+                            if in_group(record.name)
+                            for ip in record.records)
+            for location, vpcs in location_vpcs(domain_vpcs,
+                                                locations).items():
+                for inst in instances_named(name, vpcs,
+                                            location_ec2(location),
+                                            addresses=addresses):
+                    instances[inst["InstanceId"]] = inst
+
+        instances.pop(instance_id, None)
+        if live:
+            instances[instance_id] = instance
+
+        slots = numbered_slots(current, [domain]) if stable_slots else None
+        updated = records_from_instances(instances.values(), domain_vpcs,
+                                         ttl, slots=slots,
+                                         group_routing=group_routing)
+        changes.extend(diff_records(filter(affected, current),
+                                    filter(affected, updated)))
+
+    logger.info("Updating DNS for instance {} ({}): {} changes".format(
+        instance_id, state, len(changes)))
+    change_infos = apply_changes(hosted_zone_id, changes, wait=wait)
+
+    if state_store and changes:
+        snapshot = ZoneSnapshot(state_store, hosted_zone_id,
+                                list(vpc_map.values()))
+        snapshot.apply(changes)
+    if not wait:
+        record_pending_changes(hosted_zone_id, state_store, change_infos)
+
+    return True
+
+
+def current_records(hosted_zone_id, domains, snapshot=None, shards=1):
+    if not snapshot:
+        return existing_records_stream(hosted_zone_id, domains,
+                                       shards=shards), False
+
+    records = snapshot.load()
+    if records is not None:
+        logger.info("Using zone snapshot with {} records".format(
+            len(records)))
+        return records, True
+
+    # Even an expired snapshot tells how names are spread over the zone
+    listed_at = time.time()
+    records = existing_records(hosted_zone_id, domains, shards=shards,
+                               boundaries=snapshot.names())
+    snapshot.save(records, listed_at)
+
+    return records, False
+
+
+def domain_partitions(vpc_map):
+    partitions = {}
+    for vpc, domain in vpc_map.items():
+        partitions.setdefault(domain, {})[vpc] = domain
+
+    return OrderedDict(sorted(partitions.items(),
+                              key=lambda p: route53_sort_key(p[0])))
+
+
+# Splits the records listed from the zone, in Route53 order, into the
+# records of each domain. A domain is complete once the listing moves past
+# its names, so only the domains still being listed are held in memory.
+def domain_sections(records, domains):
+    index = DomainIndex(domains)
+    pending = OrderedDict((d, []) for d in sorted(domains,
+                                                  key=route53_sort_key))
+    prefixes = dict((d, route53_sort_key(d)) for d in domains)
+
+    def passed(domain, key):
+        return key > prefixes[domain] and not key.startswith(prefixes[domain])
+
+    for record in records:
+        key = route53_sort_key(record.name)
+        while pending:
+            domain = next(iter(pending))
+            if not passed(domain, key):
+                break
+            yield domain, pending.pop(domain)
+
+        domain = index.match(record.name)
+        if domain not in pending:
+            raise RuntimeError("Record {} listed after the records of {} were "
+                               "complete".format(record.name, domain))
+        pending[domain].append(record)
+
+    for domain, section in pending.items():
+        yield domain, section
+
+
+# Reconciles one domain at a time, deriving its records only from the
+# instances of its VPCs, and submits the changes as they come out of the
+# diff. Memory then depends on the size of the largest domain rather than on
+# the whole fleet. The zone snapshot isn't used, and is discarded if any
+# changes were made, as it would no longer be accurate.
+def converge_partitions(hosted_zone_id, vpc_map, ttl, state=None, wait=True,
+                        metrics=None, stable_slots=False, listing_shards=1,
+                        group_routing=None, locations=None):
+    metrics = metrics or Metrics()
+    partitions = domain_partitions(vpc_map)
+    client = route53()
+    stream = ChangeStream(client, hosted_zone_id)
+    counts = dict((action, 0) for action in CHANGE_ACTIONS)
+
+    current = metrics.timed("ZoneListing", existing_records_stream(
+        hosted_zone_id, list(partitions), shards=listing_shards))
+    for domain, section in domain_sections(current, list(partitions)):
+        slots = numbered_slots(section, [domain]) if stable_slots else None
+        updated = records_from_running_instances(
+            partitions[domain], ttl, metrics=metrics, slots=slots,
+            group_routing=group_routing, locations=locations)
+
+        for change in metrics.timed("Diff", diff_records(section, updated)):
+            counts[change["Action"]] += 1
+            with metrics.timer("Submit"):
+                stream.add(change)
+        del section, updated
+
+    with metrics.timer("Submit"):
+        stream.flush()
+
+    for action, total in counts.items():
+        metrics.add("Changes" + action.capitalize(), total)
+    metrics.add("ChangeBatches", len(stream.change_infos))
+    logger.info("Submitted {} changes ({}) in {} batches".format(
+        stream.count, ", ".join("{} {}".format(counts[a], a)
+                                for a in CHANGE_ACTIONS),
+        len(stream.change_infos)))
+
+    if state and stream.count:
+        ZoneSnapshot(state, hosted_zone_id, list(vpc_map.values())) \
+            .invalidate()
+
+    if not wait:
+        record_pending_changes(hosted_zone_id, state, stream.change_infos)
+    else:
+        with metrics.timer("Propagation"):
+            wait_changes(client, stream.change_infos)
+
+    return True
+
+
+# With `state` and a `full_interval`, runs where the inventory hasn't changed
+# since the last one (as told by `inventory_fingerprint`) end right after it,
+# without listing the zone. The zone is still reconciled every
+# `full_interval` seconds, to undo any changes made to it by hand.
+def converge_records(hosted_zone_id, vpc_map, ttl, state=None,
+                     snapshot_max_age=SNAPSHOT_MAX_AGE, wait=True,
+                     metrics=None, stable_slots=False, bounded=False,
+                     listing_shards=1, group_routing=None, locations=None,
+                     full_interval=0):
+    metrics = metrics or Metrics()
+    if state:
+        check_pending_changes(hosted_zone_id, state, metrics=metrics)
+
+    options = dict(state=state, wait=wait, metrics=metrics,
+                   stable_slots=stable_slots, listing_shards=listing_shards,
+                   group_routing=group_routing, locations=locations)
+    if not state or not full_interval:
+        if bounded:
+            return converge_partitions(hosted_zone_id, vpc_map, ttl,
+                                       **options)
+        return reconcile_records(hosted_zone_id, vpc_map, ttl,
+                                 snapshot_max_age=snapshot_max_age, **options)
+
+    fingerprints = InventoryFingerprint(state, hosted_zone_id,
+                                        list(vpc_map.values()),
+                                        max_age=full_interval)
+    config = [ttl, sorted(vpc_map.items()), stable_slots, group_routing,
+              GROUP_SHARDS]
+    instances = None
+    with metrics.timer("Inventory"):
+        if bounded:
+            fingerprint = inventory_fingerprint(
+                iter_instances(vpc_map.keys(), locations), config)
+        else:
+            instances = instances_in_vpcs(vpc_map.keys(), locations)
+            fingerprint = inventory_fingerprint(instances, config)
+
+    if fingerprints.matches(fingerprint):
+        logger.info("Instances unchanged since the last run, skipping")
+        metrics.add("InventoryUnchanged", 1)
+        return True
+
+    metrics.add("InventoryUnchanged", 0)
+    if bounded:
+        converge_partitions(hosted_zone_id, vpc_map, ttl, **options)
+    else:
+        reconcile_records(hosted_zone_id, vpc_map, ttl,
+                          snapshot_max_age=snapshot_max_age,
+                          instances=instances, **options)
+
+    fingerprints.save(fingerprint)
+    return True
+
+
+def reconcile_records(hosted_zone_id, vpc_map, ttl, state=None,
+                      snapshot_max_age=SNAPSHOT_MAX_AGE, wait=True,
+                      metrics=None, stable_slots=False, listing_shards=1,
+                      group_routing=None, locations=None, instances=None):
+    metrics = metrics or Metrics()
+    domains = list(vpc_map.values())
+    snapshot = state and ZoneSnapshot(state, hosted_zone_id, domains,
+                                      max_age=snapshot_max_age)
+
+    with metrics.timer("ZoneListing"):
+        current, from_snapshot = current_records(hosted_zone_id, domains,
+                                                 snapshot,
+                                                 shards=listing_shards)
+        # Stable slots come from the current records, so they have to be
+        # listed before the instance records are derived
+        if stable_slots:
+            current = frozenset(current)
+
+    slots = numbered_slots(current, domains) if stable_slots else None
+    updated = records_from_running_instances(vpc_map, ttl, metrics=metrics,
+                                             slots=slots,
+                                             group_routing=group_routing,
+                                             locations=locations,
+                                             instances=instances)
+
+    # Without a snapshot the zone is listed lazily while diffing, so the time
+    # spent waiting on Route53 is moved from the diff to the listing
+    listing = metrics.get("ZoneListingTime", 0)
+    current = metrics.timed("ZoneListing", current)
+    with metrics.timer("Diff"):
+        changes = list(diff_records(current, updated))
+    metrics.add("DiffTime", listing - metrics.get("ZoneListingTime", 0),
+                unit="Milliseconds")
 
     try:
-        while True:
-            yield next(new_i).change_request()
-    except StopIteration:
-        pass
+        change_infos = apply_changes(hosted_zone_id, changes, wait=wait,
+                                     metrics=metrics)
+    except ClientError as e:
+        if snapshot:
+            snapshot.invalidate()
+
+        code = e.response["Error"]["Code"]
+        if not from_snapshot or code != "InvalidChangeBatch":
+            raise
+
+        logger.warning("Route53 rejected changes planned from the zone "
+                       "snapshot, relisting: {}".format(e))
+        return reconcile_records(hosted_zone_id, vpc_map, ttl, state=state,
+                                 snapshot_max_age=snapshot_max_age, wait=wait,
+                                 metrics=metrics, stable_slots=stable_slots,
+                                 listing_shards=listing_shards,
+                                 group_routing=group_routing,
+                                 locations=locations, instances=instances)
+
+    if snapshot:
+        snapshot.apply(changes)
+    if not wait:
+        record_pending_changes(hosted_zone_id, state, change_infos)
+
+    return True
+
 
+def count_changes(changes):
+    counts = dict((action, 0) for action in CHANGE_ACTIONS)
+    for change in changes:
+        counts[change["Action"]] += 1
+    return counts
 
-def converge_records(hosted_zone_id, vpc_map, ttl):
-    current = existing_records(hosted_zone_id, list(vpc_map.values()))
-    updated = records_from_running_instances(vpc_map, ttl)
 
-    changes = list(diff_records(current, updated))
+def format_change(change):
+    record_set = change["ResourceRecordSet"]
+    values = sorted(r["Value"] for r in record_set.get("ResourceRecords", []))
+    return "{} {} {} {}".format(change["Action"], record_set["Type"],
+                                record_set["Name"], ",".join(values))
+
+
+# Counts of the changes by action, followed by the first `limit` changes.
+# With a `limit` of 0 only the counts are given.
+def summarize_changes(changes, limit=CHANGE_SUMMARY_LIMIT):
+    counts = count_changes(changes)
+    lines = ["{} changes ({})".format(len(changes), ", ".join(
+        "{} {}".format(counts[action], action) for action in CHANGE_ACTIONS))]
+    lines.extend(format_change(c) for c in changes[:limit])
+    if limit and len(changes) > limit:
+        lines.append("... and {} more".format(len(changes) - limit))
+
+    return "\n".join(lines)
+
+
+def apply_changes(hosted_zone_id, changes, wait=True, metrics=None):
+    metrics = metrics or Metrics()
+    for action, total in count_changes(changes).items():
+        metrics.add("Changes" + action.capitalize(), total)
+
     if not changes:
         logger.info("No changes to be made, stopping.")
-        return True
+        return []
 
-    logger.info("Applying {} changes:\n{}".format(len(changes),
-                                                  pprint.pformat(changes)))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Applying {} changes:\n{}".format(
+            len(changes), pprint.pformat(changes)))
+    else:
+        logger.info("Applying {}".format(summarize_changes(changes)))
 
     start_time = datetime.utcnow()
 
-    change_batch = {"Changes": changes}
-    change_response = route53().change_resource_record_sets(
-        HostedZoneId=hosted_zone_id, ChangeBatch=change_batch)
+    client = route53()
+    with metrics.timer("Submit"):
+        waves = plan_change_batches(changes)
+        change_infos = submit_change_batches(client, hosted_zone_id, waves)
+    metrics.add("ChangeBatches", len(change_infos))
+
+    if not wait:
+        logger.info("Submitted Route53 changes {}, not waiting for them to "
+                    "propagate".format([i["Id"] for i in change_infos]))
+        return change_infos
 
-    if change_response["ChangeInfo"]["Status"] != "INSYNC":
-        waiter = route53().get_waiter("resource_record_sets_changed")
-        waiter.wait(Id=change_response["ChangeInfo"]["Id"])
+    with metrics.timer("Propagation"):
+        wait_changes(client, change_infos)
 
     elapsed_time = datetime.utcnow() - start_time
     logger.info("Route53 changes completed in {}".format(elapsed_time))
 
-    return True
+    return change_infos
 
 
-def handler(event, context):
+def check_pending_changes(hosted_zone_id, state, metrics=None):
+    metrics = metrics or Metrics()
+    pending = PendingChanges(state, hosted_zone_id)
+    changes = pending.load()
+    if not changes:
+        return []
+
+    statuses = poll_changes(route53(), [c["Id"] for c in changes])
+    now = time.time()
+
+    latencies = []
+    remaining = []
+    for change in changes:
+        if statuses[change["Id"]] != "INSYNC":
+            remaining.append(change)
+            continue
+
+        # Only an upper bound, since the change may have propagated at any
+        # point since the previous check
+        latency = now - change["SubmittedAt"]
+        latencies.append(latency)
+        metrics.append("PropagationLatency", latency, unit="Seconds")
+        logger.info("Route53 change {} propagated within {:.1f}s".format(
+            change["Id"], latency))
+
+    pending.save(remaining)
+    metrics.add("PendingChanges", len(remaining))
+    logger.info("{} Route53 changes propagated, {} still pending".format(
+        len(latencies), len(remaining)))
+    return latencies
+
+
+def record_pending_changes(hosted_zone_id, state, change_infos):
+    if state:
+        PendingChanges(state, hosted_zone_id).add(change_infos)
+
+
+def zone_id(hosted_zone_id):
+    return hosted_zone_id.split("/")[-1]
+
+
+def zone_vpc_maps(vpc_map, hosted_zone_id, vpc_zones=None):
+    zones = OrderedDict()
+    for vpc, domain in vpc_map.items():
+        zone = (vpc_zones or {}).get(vpc) or hosted_zone_id
+        zones.setdefault(zone, {})[vpc] = domain
+
+    return zones
+
+
+def converge_zone(hosted_zone_id, vpc_map, ttl, **options):
+    domains = sorted(set(vpc_map.values()))
+    metrics = Metrics(dimensions={"HostedZoneId": zone_id(hosted_zone_id)})
+    start_time = time.time()
+    error = None
+
+    try:
+        converge_records(hosted_zone_id, vpc_map, ttl, metrics=metrics,
+                         **options)
+    except Exception as e:
+        logger.exception("Failed to converge HostedZoneId={}, "
+                         "Domains={}".format(hosted_zone_id, domains))
+        error = e
+
+    elapsed = time.time() - start_time
+    metrics.add_time("Total", elapsed)
+    metrics.add("Errors", 1 if error else 0)
+    metrics.emit()
+
+    logger.info("Finished HostedZoneId={}, Domains={} in {:.3f}s".format(
+        hosted_zone_id, domains, elapsed))
+
+    return {
+        "hosted_zone_id": hosted_zone_id,
+        "domains": domains,
+        "elapsed": elapsed,
+        "error": error
+    }
+
+
+def converge_zones(zones, ttl, concurrency=CONCURRENCY, **options):
+    def converge(zone):
+        hosted_zone_id, vpc_map = zone
+        return converge_zone(hosted_zone_id, vpc_map, ttl, **options)
+
+    zones = list(zones.items())
+    if len(zones) == 1 or concurrency <= 1:
+        return list(map(converge, zones))
+
+    pool = ThreadPool(min(concurrency, len(zones)))
+    try:
+        return pool.map(converge, zones)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if not value:
+        return default
+
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def log_request_stats():
+    stats = ROUTE53_SCHEDULER.stats()
+    logger.info("Route53 requests: {requests}, throttled: {throttled}, "
+                "waited {wait_time:.1f}s for the rate limit and "
+                "{backoff_time:.1f}s backing off".format(**stats))
+
+
+def zones_from_env():
     hosted_zone_id = os.environ['EC2_DNS_HOSTED_ZONE_ID']
     vpcs = os.environ['EC2_DNS_VPC_IDS'].split(",")
     domains = os.environ['EC2_DNS_VPC_DOMAINS'].split(",")
-    ttl = int(os.environ['EC2_DNS_RECORD_TTL'])
+    vpc_zone_ids = os.environ.get('EC2_DNS_VPC_HOSTED_ZONE_IDS')
 
     vpc_map = dict(zip(vpcs, domains))
-    logger.info("Updating DNS from EC2 instances: HostedZoneId={}, VpcMap={}, "
-                "TTL={}".format(hosted_zone_id, vpc_map, ttl))
+    vpc_zones = dict(zip(vpcs, vpc_zone_ids.split(","))) \
+        if vpc_zone_ids else {}
+    return zone_vpc_maps(vpc_map, hosted_zone_id, vpc_zones)
+
+
+# Optional role ARNs and regions of the VPCs in the same position in
+# EC2_DNS_VPC_IDS. Empty entries use the function's own.
+def locations_from_env():
+    vpcs = os.environ['EC2_DNS_VPC_IDS'].split(",")
+    role_arns = (os.environ.get('EC2_DNS_VPC_ROLE_ARNS') or "").split(",")
+    regions = (os.environ.get('EC2_DNS_VPC_REGIONS') or "").split(",")
+
+    locations = {}
+    for i, vpc in enumerate(vpcs):
+        role_arn = role_arns[i] if i < len(role_arns) else ""
+        region = regions[i] if i < len(regions) else ""
+        if role_arn or region:
+            locations[vpc] = (role_arn or None, region or None)
+
+    return locations
 
-    return converge_records(hosted_zone_id, vpc_map, ttl)
+
+def group_routing_from_env():
+    group_routing = os.environ.get('EC2_DNS_GROUP_ROUTING') or None
+    if group_routing and group_routing not in GROUP_ROUTING:
+        raise ValueError("Unknown group routing policy: {}".format(
+            group_routing))
+
+    return group_routing
+
+
+def lease_key(zones):
+    pairs = sorted("{}:{}".format(zone_id(zone), domain)
+                   for zone, vpc_map in zones.items()
+                   for domain in set(vpc_map.values()))
+    digest = hashlib.sha1(",".join(pairs).encode("utf-8"))
+    return "converge-" + digest.hexdigest()[:12]
+
+
+def lease_from_env(zones, context=None):
+    store = lease_store_from_url(os.environ.get('EC2_DNS_LEASE_URL'))
+    if not store:
+        return None
+
+    # Leases outlive the invocation holding them by at most its timeout
+    duration = LEASE_DURATION
+    if context is not None:
+        duration = context.get_remaining_time_in_millis() / 1000.0
+
+    return Lease(store, lease_key(zones), duration=duration)
+
+
+# Converges the whole of `zones`, with the options given by the environment
+def converge_all_from_env(zones, ttl):
+    results = converge_zones(
+        zones, ttl,
+        concurrency=int(os.environ.get('EC2_DNS_CONCURRENCY', CONCURRENCY)),
+        state=state_store_from_url(os.environ.get('EC2_DNS_STATE_URL')),
+        snapshot_max_age=int(os.environ.get('EC2_DNS_SNAPSHOT_MAX_AGE',
+                                            SNAPSHOT_MAX_AGE)),
+        wait=env_flag('EC2_DNS_WAIT_FOR_SYNC', default=True),
+        stable_slots=env_flag('EC2_DNS_STABLE_SLOTS'),
+        bounded=env_flag('EC2_DNS_BOUNDED_MEMORY'),
+        listing_shards=int(os.environ.get('EC2_DNS_LISTING_SHARDS', 1)),
+        group_routing=group_routing_from_env(),
+        locations=locations_from_env(),
+        full_interval=int(os.environ.get('EC2_DNS_FULL_RECONCILE_INTERVAL',
+                                         0)))
+
+    failed = [r for r in results if r["error"] is not None]
+    if failed:
+        raise RuntimeError("Failed to update DNS for: {}".format(
+            ", ".join("{} {}".format(r["hosted_zone_id"], r["domains"])
+                      for r in failed)))
+
+
+def handler(event, context):
+    zones = zones_from_env()
+    ttl = int(os.environ['EC2_DNS_RECORD_TTL'])
+    incremental = env_flag('EC2_DNS_INCREMENTAL_EVENTS')
+    state = state_store_from_url(os.environ.get('EC2_DNS_STATE_URL'))
+    wait = env_flag('EC2_DNS_WAIT_FOR_SYNC', default=True)
+    stable_slots = env_flag('EC2_DNS_STABLE_SLOTS')
+    group_routing = group_routing_from_env()
+    locations = locations_from_env()
+    incremental_limit = int(os.environ.get('EC2_DNS_INCREMENTAL_LIMIT',
+                                           INCREMENTAL_LIMIT))
+    logger.setLevel(logging.DEBUG if env_flag('EC2_DNS_DEBUG')
+                    else logging.INFO)
+
+    logger.info("Updating DNS from EC2 instances: Zones={}, TTL={}".format(
+        dict(zones), ttl))
+
+    events = unwrap_events(event)
+    instance_states, full = coalesce_events(events)
+    if len(events) > 1:
+        logger.info("Coalesced {} events for {} instances{}".format(
+            len(events), len(instance_states),
+            ", and a full refresh" if full else ""))
+
+    def converge_all():
+        converge_all_from_env(zones, ttl)
+
+    def converge():
+        if not incremental or full or \
+                len(instance_states) > incremental_limit:
+            return converge_all()
+
+        for instance_id, instance_state in instance_states.items():
+            for zone_id, zone_vpc_map in zones.items():
+                converge_instance(zone_id, zone_vpc_map, ttl,
+                                  instance_id, instance_state,
+                                  state_store=state, wait=wait,
+                                  stable_slots=stable_slots,
+                                  group_routing=group_routing,
+                                  locations=locations)
+
+    lease = lease_from_env(zones, context)
+    ROUTE53_SCHEDULER.reset_stats()
+    try:
+        if lease is None:
+            converge()
+        else:
+            # Extra passes for dirty marks can't tell what the invocations
+            # that made them were asked to do, so they converge everything
+            single_flight(lease, converge, again=converge_all,
+                          mark_dirty=os.environ.get(
+                              'EC2_DNS_LEASE_CONTENTION') != 'skip')
+    finally:
+        log_request_stats()
+
+    return True
+
+
+def check_changes_handler(event, context):
+    state = state_store_from_url(os.environ.get('EC2_DNS_STATE_URL'))
+    if not state:
+        logger.info("No state store configured, no changes to check")
+        return True
+
+    for hosted_zone_id in zones_from_env():
+        metrics = Metrics(dimensions={"HostedZoneId": zone_id(hosted_zone_id)})
+        check_pending_changes(hosted_zone_id, state, metrics=metrics)
+        metrics.emit()
+
+    return True
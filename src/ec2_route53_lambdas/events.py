@@ -0,0 +1,76 @@
+from __future__ import absolute_import, unicode_literals
+
+import json
+import threading
+from collections import OrderedDict, deque
+
+
+STATE_CHANGE_EVENT = "EC2 Instance State-change Notification"
+SQS_EVENT_SOURCE = "aws:sqs"
+
+
+def is_state_change(event):
+    return event.get("detail-type") == STATE_CHANGE_EVENT
+
+
+def unwrap_events(event):
+    # Events delivered through an SQS queue arrive in batches, with each
+    # original event as the body of a record
+    records = event.get("Records")
+    if not records:
+        return [event]
+
+    return [json.loads(r["body"]) for r in records
+            if r.get("eventSource") == SQS_EVENT_SOURCE]
+
+
+# Collapses a batch of events into the latest state of each instance they
+# mention, in the order the instances first appeared. Any other event, like
+# the periodic refresh, means the whole zone has to be converged.
+def coalesce_events(events):
+    states = OrderedDict()
+    full = False
+    for event in sorted(events, key=lambda e: e.get("time") or ""):
+        if not is_state_change(event):
+            full = True
+            continue
+
+        detail = event["detail"]
+        states.pop(detail["instance-id"], None)
+        states[detail["instance-id"]] = detail["state"]
+
+    return states, full
+
+
+# In-memory stand-in for the SQS queue between the EventBridge rules and the
+# function, producing the same batch events the Lambda SQS integration does.
+class LocalQueue(object):
+    def __init__(self):
+        self.messages = deque()
+        self.lock = threading.Lock()
+        self.sent = 0
+
+    def send(self, event):
+        with self.lock:
+            self.sent += 1
+            self.messages.append({
+                "messageId": str(self.sent),
+                "eventSource": SQS_EVENT_SOURCE,
+                "body": json.dumps(event)
+            })
+
+    def receive(self, max_messages=10):
+        with self.lock:
+            records = [self.messages.popleft()
+                       for _ in range(min(max_messages, len(self.messages)))]
+
+        return {"Records": records} if records else None
+
+    def drain(self, handler, context=None, max_messages=10):
+        results = []
+        while True:
+            batch = self.receive(max_messages)
+            if batch is None:
+                return results
+
+            results.append(handler(batch, context))
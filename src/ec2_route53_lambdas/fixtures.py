@@ -0,0 +1,167 @@
+"""In-memory EC2 and Route53 clients serving captured or generated data.
+"""
+from __future__ import absolute_import, unicode_literals
+
+import json
+from bisect import bisect_left
+from fnmatch import fnmatchcase
+
+from ec2_route53_lambdas.util import route53_sort_key
+
+
+class FakePaginator(object):
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.method(**kwargs)
+            yield page
+
+            if page.get("NextToken"):
+                kwargs["NextToken"] = page["NextToken"]
+                continue
+
+            if not page.get("IsTruncated"):
+                return
+
+            for key in ("Name", "Type", "Identifier"):
+                if "NextRecord" + key in page:
+                    kwargs["StartRecord" + key] = page["NextRecord" + key]
+
+
+def instance_matches(instance, filters, instance_ids=None):
+    if instance_ids is not None and instance["InstanceId"] not in instance_ids:
+        return False
+
+    tags = dict((t["Key"], t["Value"]) for t in instance.get("Tags", []))
+    for f in filters:
+        if f["Name"] == "instance-state-name":
+            values = [instance["State"]["Name"]]
+        elif f["Name"] == "vpc-id":
+            values = [instance.get("VpcId")]
+        elif f["Name"] == "private-ip-address":
+            values = [instance.get("PrivateIpAddress")]
+        elif f["Name"] == "tag-key":
+            values = list(tags)
+        elif f["Name"].startswith("tag:"):
+            values = [tags.get(f["Name"][len("tag:"):])]
+        else:
+            raise ValueError("Unsupported filter: {}".format(f["Name"]))
+
+        if not any(value is not None and fnmatchcase(value, v)
+                   for value in values for v in f["Values"]):
+            return False
+
+    return True
+
+
+class FakeEc2(object):
+    def __init__(self, instances, page_size=1000):
+        self.instances = instances
+        self.page_size = page_size
+        self.selections = {}
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+    def describe_instances(self, Filters=(), InstanceIds=None,
+                           NextToken=None):
+        key = json.dumps([Filters, InstanceIds], sort_keys=True)
+        if key not in self.selections:
+            self.selections[key] = [
+                i for i in self.instances
+                if instance_matches(i, Filters, InstanceIds)]
+
+        selected = self.selections[key]
+        start = int(NextToken or 0)
+        page = selected[start:start + self.page_size]
+
+        response = {"Reservations": [{"Instances": page}]}
+        if start + self.page_size < len(selected):
+            response["NextToken"] = str(start + self.page_size)
+        return response
+
+
+def record_set_key(record):
+    return (route53_sort_key(record["Name"]), record["Type"],
+            record.get("SetIdentifier", ""))
+
+
+# Changes are recorded in `changes` rather than applied, and are reported as
+# propagated right away.
+class FakeRoute53(object):
+    def __init__(self, records, page_size=300):
+        self.records = sorted(records, key=record_set_key)
+        self.index = [record_set_key(r) for r in self.records]
+        self.page_size = page_size
+        self.changes = []
+        self.listed = 0
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName=None,
+                                  StartRecordType=None,
+                                  StartRecordIdentifier=None, MaxItems=None):
+        start = 0
+        if StartRecordName:
+            start = bisect_left(self.index, (route53_sort_key(StartRecordName),
+                                             StartRecordType or "",
+                                             StartRecordIdentifier or ""))
+
+        page_size = int(MaxItems or self.page_size)
+        end = start + page_size
+        response = {
+            "ResourceRecordSets": self.records[start:end],
+            "IsTruncated": end < len(self.records),
+            "MaxItems": str(page_size)
+        }
+        self.listed += len(response["ResourceRecordSets"])
+        if response["IsTruncated"]:
+            response["NextRecordName"] = self.records[end]["Name"]
+            response["NextRecordType"] = self.records[end]["Type"]
+            if "SetIdentifier" in self.records[end]:
+                response["NextRecordIdentifier"] = \
+                    self.records[end]["SetIdentifier"]
+        return response
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        self.changes.extend(ChangeBatch["Changes"])
+        return {"ChangeInfo": {"Id": "C{}".format(len(self.changes)),
+                               "Status": "INSYNC"}}
+
+    def get_change(self, Id):
+        return {"ChangeInfo": {"Id": Id, "Status": "INSYNC"}}
+
+
+def _pages(data):
+    return data if isinstance(data, list) else [data]
+
+
+# Captured output of `aws ec2 describe-instances`: a single response, a list
+# of pages, or a plain list of instances.
+def load_instances(data):
+    instances = []
+    for page in _pages(data):
+        if "Reservations" not in page:
+            instances.append(page)
+            continue
+
+        for reservation in page["Reservations"]:
+            instances.extend(reservation["Instances"])
+
+    return instances
+
+
+# Captured output of `aws route53 list-resource-record-sets`: a single
+# response, a list of pages, or a plain list of record sets.
+def load_record_sets(data):
+    records = []
+    for page in _pages(data):
+        if "ResourceRecordSets" in page:
+            records.extend(page["ResourceRecordSets"])
+        else:
+            records.append(page)
+
+    return records
@@ -0,0 +1,247 @@
+from __future__ import absolute_import, unicode_literals
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import contextmanager
+
+from botocore.exceptions import ClientError
+
+from ec2_route53_lambdas.util import dynamodb
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+LEASE_DURATION = 900
+
+
+# Leases are kept as a JSON file per key, read and updated under an exclusive
+# lock of a sibling file, so that processes on the same host can contend.
+class FileLeaseStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".lease.json")
+
+    @contextmanager
+    def _locked(self, key):
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        with open(self._path(key) + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield self._path(key)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    @staticmethod
+    def _write(path, lease):
+        if lease is None:
+            os.remove(path)
+            return
+
+        with open(path, "w") as f:
+            json.dump(lease, f)
+
+    def acquire(self, key, owner, expires, now):
+        with self._locked(key) as path:
+            lease = self._read(path)
+            if lease is not None and lease["expires"] >= now:
+                return False
+
+            self._write(path, {"owner": owner, "expires": expires,
+                               "dirty": False})
+            return True
+
+    def mark_dirty(self, key, now):
+        with self._locked(key) as path:
+            lease = self._read(path)
+            if lease is None or lease["expires"] < now:
+                return False
+
+            lease["dirty"] = True
+            self._write(path, lease)
+            return True
+
+    def release(self, key, owner, expires):
+        with self._locked(key) as path:
+            lease = self._read(path)
+            if lease is None or lease["owner"] != owner:
+                return True
+
+            if lease["dirty"]:
+                self._write(path, {"owner": owner, "expires": expires,
+                                   "dirty": False})
+                return False
+
+            self._write(path, None)
+            return True
+
+    def abandon(self, key, owner):
+        with self._locked(key) as path:
+            lease = self._read(path)
+            if lease is not None and lease["owner"] == owner:
+                self._write(path, None)
+
+
+# Leases are items of a DynamoDB table with a string hash key named
+# LeaseKey. Every transition is a single conditional write, so concurrent
+# invocations can't both hold a lease, or lose a dirty mark.
+class DynamoDBLeaseStore(object):
+    def __init__(self, table, client=None):
+        self.table = table
+        self.client = client
+
+    def _client(self):
+        return self.client or dynamodb()
+
+    def _write(self, method, **kwargs):
+        try:
+            getattr(self._client(), method)(TableName=self.table, **kwargs)
+        except ClientError as e:
+            if e.response["Error"]["Code"] == \
+                    "ConditionalCheckFailedException":
+                return False
+            raise
+
+        return True
+
+    @staticmethod
+    def _key(key):
+        return {"LeaseKey": {"S": key}}
+
+    def acquire(self, key, owner, expires, now):
+        item = dict(self._key(key), Owner={"S": owner},
+                    Expires={"N": repr(expires)}, Dirty={"BOOL": False})
+        return self._write(
+            "put_item", Item=item,
+            ConditionExpression="attribute_not_exists(LeaseKey) OR "
+                                "Expires < :now",
+            ExpressionAttributeValues={":now": {"N": repr(now)}})
+
+    def mark_dirty(self, key, now):
+        return self._write(
+            "update_item", Key=self._key(key),
+            UpdateExpression="SET Dirty = :true",
+            ConditionExpression="attribute_exists(LeaseKey) AND "
+                                "Expires >= :now",
+            ExpressionAttributeValues={":true": {"BOOL": True},
+                                       ":now": {"N": repr(now)}})
+
+    def release(self, key, owner, expires):
+        if self._write(
+                "delete_item", Key=self._key(key),
+                ConditionExpression="Owner = :owner AND Dirty = :false",
+                ExpressionAttributeValues={":owner": {"S": owner},
+                                           ":false": {"BOOL": False}}):
+            return True
+
+        # Either the lease was marked dirty, and is kept for another pass,
+        # or it isn't ours anymore
+        renewed = self._write(
+            "update_item", Key=self._key(key),
+            UpdateExpression="SET Dirty = :false, Expires = :expires",
+            ConditionExpression="Owner = :owner AND Dirty = :true",
+            ExpressionAttributeValues={":owner": {"S": owner},
+                                       ":true": {"BOOL": True},
+                                       ":false": {"BOOL": False},
+                                       ":expires": {"N": repr(expires)}})
+        return not renewed
+
+    def abandon(self, key, owner):
+        self._write("delete_item", Key=self._key(key),
+                    ConditionExpression="Owner = :owner",
+                    ExpressionAttributeValues={":owner": {"S": owner}})
+
+
+def lease_store_from_url(url):
+    if not url:
+        return None
+
+    if url.startswith("dynamodb://"):
+        return DynamoDBLeaseStore(url[len("dynamodb://"):])
+
+    if url.startswith("file://"):
+        url = url[len("file://"):]
+
+    return FileLeaseStore(url)
+
+
+# Lets a single invocation at a time do the work guarded by `key`. Others
+# can mark the lease as dirty instead of waiting, which makes the holder run
+# one more pass before releasing it. Leases expire after `duration`, so that
+# an invocation that dies while holding one doesn't block the rest forever.
+class Lease(object):
+    def __init__(self, store, key, duration=LEASE_DURATION, owner=None,
+                 clock=time.time):
+        self.store = store
+        self.key = key
+        self.duration = duration
+        self.owner = owner or uuid.uuid4().hex
+        self.clock = clock
+
+    def _expires(self):
+        return self.clock() + self.duration
+
+    def acquire(self):
+        return self.store.acquire(self.key, self.owner, self._expires(),
+                                  self.clock())
+
+    def mark_dirty(self):
+        return self.store.mark_dirty(self.key, self.clock())
+
+    def release(self):
+        # False when the lease was marked dirty: it's then renewed, and still
+        # held, for the extra pass
+        return self.store.release(self.key, self.owner, self._expires())
+
+    def abandon(self):
+        self.store.abandon(self.key, self.owner)
+
+
+# Runs `func` holding `lease`, and `again` for every time the lease was
+# marked dirty meanwhile. Returns False without running anything if another
+# invocation holds the lease, after marking it dirty if `mark_dirty` is set.
+def single_flight(lease, func, again=None, mark_dirty=True):
+    if not lease.acquire():
+        if mark_dirty and lease.mark_dirty():
+            logger.info("Lease {} is held, marked it dirty".format(lease.key))
+            return False
+
+        # A lease that can't be marked was released meanwhile, or expired,
+        # and can be taken over
+        if not mark_dirty or not lease.acquire():
+            logger.info("Lease {} is held, skipping".format(lease.key))
+            return False
+
+    try:
+        func()
+        while not lease.release():
+            logger.info("Lease {} was marked dirty, running again".format(
+                lease.key))
+            (again or func)()
+    except Exception:
+        lease.abandon()
+        raise
+
+    return True
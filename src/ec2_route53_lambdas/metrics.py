@@ -0,0 +1,92 @@
+from __future__ import absolute_import, division, print_function, \
+    unicode_literals
+
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+NAMESPACE = "Ec2Dns"
+
+
+# Collects the timings and counts of one run, to be emitted as a single
+# CloudWatch Embedded Metric Format (EMF) log line. Timings of the same phase
+# are added up, so phases split in several steps, or interleaved with others
+# (like listing a zone while diffing it), are reported as a whole.
+class Metrics(object):
+    def __init__(self, namespace=NAMESPACE, dimensions=None,
+                 clock=time.time):
+        self.namespace = namespace
+        self.dimensions = OrderedDict(sorted((dimensions or {}).items()))
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.values = OrderedDict()
+        self.units = {}
+
+    def add(self, name, value=1, unit="Count"):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    def append(self, name, value, unit="Count"):
+        with self.lock:
+            self.values.setdefault(name, []).append(value)
+            self.units[name] = unit
+
+    def add_time(self, phase, seconds):
+        self.add(phase + "Time", seconds * 1000, unit="Milliseconds")
+
+    @contextmanager
+    def timer(self, phase):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add_time(phase, self.clock() - start)
+
+    def timed(self, phase, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = self.clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add_time(phase, self.clock() - start)
+
+            yield item
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def to_emf(self):
+        with self.lock:
+            values = OrderedDict(self.values)
+            units = dict(self.units)
+
+        document = OrderedDict([
+            ("_aws", {
+                "Timestamp": int(self.clock() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [list(self.dimensions)],
+                    "Metrics": [{"Name": name, "Unit": units[name]}
+                                for name in values]
+                }]
+            })
+        ])
+        document.update(self.dimensions)
+        document.update(values)
+        return document
+
+    def emit(self, stream=None):
+        # EMF documents must be written as plain lines, without the prefix
+        # the logging module adds, for CloudWatch to extract the metrics
+        stream = stream or sys.stdout
+        print(json.dumps(self.to_emf()), file=stream)
+        stream.flush()
@@ -0,0 +1,230 @@
+from __future__ import absolute_import, division, unicode_literals
+
+import calendar
+import errno
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from botocore.exceptions import ClientError
+
+from ec2_route53_lambdas.util import RecordSet, s3
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SNAPSHOT_MAX_AGE = 600
+FINGERPRINT_MAX_AGE = 3600
+
+
+class FileStateStore(object):
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def put(self, key, value):
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Write to a temporary file first so readers never see partial data
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f)
+        os.rename(tmp_path, self._path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class ObjectStateStore(object):
+    def __init__(self, bucket, prefix="", client=None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client
+
+    def _client(self):
+        return self.client or s3()
+
+    def _key(self, key):
+        return self.prefix + key + ".json"
+
+    def get(self, key):
+        try:
+            response = self._client().get_object(Bucket=self.bucket,
+                                                 Key=self._key(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+        return json.loads(response["Body"].read().decode("utf-8"))
+
+    def put(self, key, value):
+        self._client().put_object(Bucket=self.bucket, Key=self._key(key),
+                                  Body=json.dumps(value).encode("utf-8"),
+                                  ContentType="application/json")
+
+    def delete(self, key):
+        self._client().delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+def state_store_from_url(url):
+    if not url:
+        return None
+
+    if url.startswith("s3://"):
+        bucket, _, prefix = url[len("s3://"):].partition("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        return ObjectStateStore(bucket, prefix)
+
+    if url.startswith("file://"):
+        url = url[len("file://"):]
+
+    return FileStateStore(url)
+
+
+def zone_key(kind, hosted_zone_id, domains):
+    zone = hosted_zone_id.split("/")[-1]
+    digest = hashlib.sha1(",".join(sorted(domains)).encode("utf-8"))
+    return "{}-{}-{}".format(kind, zone, digest.hexdigest()[:12])
+
+
+class ZoneSnapshot(object):
+    def __init__(self, store, hosted_zone_id, domains,
+                 max_age=SNAPSHOT_MAX_AGE, clock=time.time):
+        self.store = store
+        self.key = zone_key("snapshot", hosted_zone_id, domains)
+        self.max_age = max_age
+        self.clock = clock
+
+    def load(self):
+        data = self.store.get(self.key)
+        if data is None:
+            return None
+
+        age = self.clock() - data["listed_at"]
+        if age > self.max_age:
+            logger.info("Zone snapshot is {:.0f}s old, relisting".format(age))
+            return None
+
+        return frozenset(map(RecordSet.from_json, data["records"]))
+
+    def names(self):
+        data = self.store.get(self.key)
+        return [r["Name"] for r in data["records"]] if data else []
+
+    def save(self, records, listed_at):
+        self.store.put(self.key, {
+            "listed_at": listed_at,
+            "records": [r.to_json() for r in records]
+        })
+
+    def apply(self, changes):
+        data = self.store.get(self.key)
+        if data is None:
+            return
+
+        def record_key(record):
+            return (RecordSet.normalize_name(record["Name"]), record["Type"],
+                    record.get("SetIdentifier"))
+
+        records = dict((record_key(r), r) for r in data["records"])
+        for change in changes:
+            record = change["ResourceRecordSet"]
+            if change["Action"] == "DELETE":
+                records.pop(record_key(record), None)
+            else:
+                records[record_key(record)] = record
+
+        data["records"] = list(records.values())
+        self.store.put(self.key, data)
+
+    def invalidate(self):
+        self.store.delete(self.key)
+
+
+# Fingerprint of the inventory the zone was last reconciled with. It stops
+# matching after `max_age` seconds, to force a full reconcile now and then.
+class InventoryFingerprint(object):
+    def __init__(self, store, hosted_zone_id, domains,
+                 max_age=FINGERPRINT_MAX_AGE, clock=time.time):
+        self.store = store
+        self.key = zone_key("fingerprint", hosted_zone_id, domains)
+        self.max_age = max_age
+        self.clock = clock
+
+    def matches(self, fingerprint):
+        data = self.store.get(self.key)
+        if data is None or data["fingerprint"] != fingerprint:
+            return False
+
+        age = self.clock() - data["recorded_at"]
+        if age > self.max_age:
+            logger.info("Last full reconcile was {:.0f}s ago, "
+                        "reconciling".format(age))
+            return False
+
+        return True
+
+    def save(self, fingerprint):
+        self.store.put(self.key, {"fingerprint": fingerprint,
+                                  "recorded_at": self.clock()})
+
+
+def to_epoch(dt):
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+class PendingChanges(object):
+    def __init__(self, store, hosted_zone_id, clock=time.time):
+        self.store = store
+        self.key = "pending-" + hosted_zone_id.split("/")[-1]
+        self.clock = clock
+
+    def load(self):
+        data = self.store.get(self.key)
+        return data["changes"] if data else []
+
+    def save(self, changes):
+        if changes:
+            self.store.put(self.key, {"changes": changes})
+        else:
+            self.store.delete(self.key)
+
+    def add(self, change_infos):
+        changes = self.load()
+        for info in change_infos:
+            if info["Status"] == "INSYNC":
+                continue
+
+            submitted_at = info.get("SubmittedAt")
+            changes.append({
+                "Id": info["Id"],
+                "SubmittedAt": to_epoch(submitted_at) if submitted_at
+                else self.clock()
+            })
+
+        self.save(changes)
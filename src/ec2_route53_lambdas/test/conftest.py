@@ -10,6 +10,21 @@ from botocore import UNSIGNED
 from botocore.client import Config
 from botocore.stub import Stubber
 
+from ec2_route53_lambdas import util
+
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    util.reset_clients()
+    yield
+    util.reset_clients()
+
+
+@pytest.fixture(autouse=True)
+def no_request_delay(monkeypatch):
+    for scheduler in util.SCHEDULERS.values():
+        monkeypatch.setattr(scheduler, "sleep", lambda delay: None)
+
 
 def boto3_stub(mocker, mocked_svc):
     client = boto3.client(mocked_svc, config=Config(signature_version=UNSIGNED),
@@ -59,6 +74,24 @@ def asg_stub(mocker):
         yield stub
 
 
+@pytest.fixture
+def dynamodb_stub(mocker):
+    for stub in boto3_stub(mocker, 'dynamodb'):
+        yield stub
+
+
+@pytest.fixture
+def sts_stub(mocker):
+    for stub in boto3_stub(mocker, 'sts'):
+        yield stub
+
+
+@pytest.fixture
+def s3_stub(mocker):
+    for stub in boto3_stub(mocker, 's3'):
+        yield stub
+
+
 def gen_instance_info_response(instance_id, private_ip, name='test-instance',
                                public_ip='1.1.1.1', vpc_id='vpc-11111111',
                                availability_zone='us-east-1a',
@@ -0,0 +1,176 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime
+
+import pytest
+
+from .conftest import gen_instance_info_response
+
+from ec2_route53_lambdas import asg_lifecycle, ec2_dns
+from ec2_route53_lambdas.fixtures import FakeEc2, FakeRoute53
+from ec2_route53_lambdas.lease import FileLeaseStore, Lease
+from ec2_route53_lambdas.util import register_client
+
+
+HOSTED_ZONE_ID = "/hostedzone/Z1111111111111"
+VPC_ID = "vpc-11111111"
+VPC_DOMAIN_MAP = {VPC_ID: "prod.aws.example.com"}
+TTL = 60
+
+
+def lifecycle_event(transition):
+    return {
+        "detail-type": "EC2 Instance-launch Lifecycle Action",
+        "source": "aws.autoscaling",
+        "detail": {
+            "LifecycleActionToken": "87654321-4321-4321-4321-210987654321",
+            "AutoScalingGroupName": "asg",
+            "LifecycleHookName": "dns",
+            "EC2InstanceId": "i-abcd1111",
+            "LifecycleTransition": transition
+        }
+    }
+
+
+def complete_params(result="CONTINUE"):
+    return {
+        "AutoScalingGroupName": "asg",
+        "LifecycleHookName": "dns",
+        "LifecycleActionToken": "87654321-4321-4321-4321-210987654321",
+        "InstanceId": "i-abcd1111",
+        "LifecycleActionResult": result
+    }
+
+
+@pytest.fixture
+def lifecycle_env(monkeypatch):
+    monkeypatch.setenv("EC2_DNS_HOSTED_ZONE_ID", HOSTED_ZONE_ID)
+    monkeypatch.setenv("EC2_DNS_VPC_IDS", VPC_ID)
+    monkeypatch.setenv("EC2_DNS_VPC_DOMAINS", VPC_DOMAIN_MAP[VPC_ID])
+    monkeypatch.setenv("EC2_DNS_RECORD_TTL", str(TTL))
+
+
+def test_handler_launch(mocker, asg_stub, lifecycle_env):
+    converge_instance = mocker.patch(
+        "ec2_route53_lambdas.asg_lifecycle.converge_instance",
+        return_value=True, autospec=True)
+    asg_stub.add_response("complete_lifecycle_action", {}, complete_params())
+
+    event = lifecycle_event(asg_lifecycle.LAUNCHING)
+    assert asg_lifecycle.handler(event, mocker.MagicMock())
+
+    converge_instance.assert_called_once_with(
+        HOSTED_ZONE_ID, VPC_DOMAIN_MAP, TTL, "i-abcd1111", "running",
+        state_store=None, wait=True, stable_slots=False,
+        group_routing=None, locations={})
+    asg_stub.assert_no_pending_responses()
+
+
+def test_handle_terminate_drains(mocker, asg_stub, ec2_stub):
+    calls = []
+    mocker.patch("ec2_route53_lambdas.asg_lifecycle.converge_instance",
+                 side_effect=lambda *a, **kw: calls.append("converge"))
+    ec2_stub.add_response("create_tags", {}, {
+        "Resources": ["i-abcd1111"],
+        "Tags": [{"Key": ec2_dns.DRAINING_TAG, "Value": "true"}]
+    })
+    asg_stub.add_response("complete_lifecycle_action", {}, complete_params())
+
+    context = mocker.MagicMock()
+    context.get_remaining_time_in_millis.return_value = 30000
+
+    detail = lifecycle_event(asg_lifecycle.TERMINATING)["detail"]
+    assert asg_lifecycle.handle_lifecycle_action(
+        detail, {HOSTED_ZONE_ID: VPC_DOMAIN_MAP}, TTL, drain_time=TTL,
+        context=context, sleep=lambda delay: calls.append(delay))
+
+    # Records are removed first, and the drain is cut short to leave time to
+    # complete the action
+    assert calls == ["converge", 25]
+    ec2_stub.assert_no_pending_responses()
+    asg_stub.assert_no_pending_responses()
+
+
+def test_draining_instances_not_republished():
+    instances = [gen_instance_info_response(
+        name="web", instance_id="i-abcd111{}".format(i), vpc_id=VPC_ID,
+        private_ip="10.0.0.{}".format(i + 1),
+        tags={"aws:autoscaling:groupName": "asg"},
+        launch_time=datetime(2017, 1, 1, 0, 0, i)) for i in range(2)]
+    vpc_map = {VPC_ID: "prod"}
+    zone = [r.to_json() for r in ec2_dns.records_from_instances(
+        map(ec2_dns.slim_instance, instances[1:]), vpc_map, TTL)]
+
+    # The records of the instance were removed by its terminate action, and
+    # the periodic refresh leaves them out while it drains
+    instances[0]["Tags"].append(
+        {"Key": ec2_dns.DRAINING_TAG, "Value": "true"})
+    route53 = FakeRoute53(zone)
+    register_client("ec2", FakeEc2(instances))
+    register_client("route53", route53)
+    ec2_dns.converge_records(HOSTED_ZONE_ID, vpc_map, TTL)
+
+    assert route53.changes == []
+
+
+def test_handle_completes_on_failure(mocker, asg_stub):
+    mocker.patch("ec2_route53_lambdas.asg_lifecycle.converge_instance",
+                 side_effect=RuntimeError("Route53 failure"))
+    asg_stub.add_client_error("complete_lifecycle_action", "ValidationError",
+                              expected_params=complete_params())
+
+    detail = lifecycle_event(asg_lifecycle.LAUNCHING)["detail"]
+    with pytest.raises(RuntimeError):
+        asg_lifecycle.handle_lifecycle_action(
+            detail, {HOSTED_ZONE_ID: VPC_DOMAIN_MAP}, TTL)
+
+    asg_stub.assert_no_pending_responses()
+
+
+def test_handle_lease_held(mocker, asg_stub, tmpdir):
+    converge_instance = mocker.patch(
+        "ec2_route53_lambdas.asg_lifecycle.converge_instance")
+    asg_stub.add_response("complete_lifecycle_action", {}, complete_params())
+
+    store = FileLeaseStore(str(tmpdir))
+    holder = Lease(store, "converge")
+    assert holder.acquire()
+
+    # The change is made anyway, and the holder told to converge again
+    detail = lifecycle_event(asg_lifecycle.LAUNCHING)["detail"]
+    assert asg_lifecycle.handle_lifecycle_action(
+        detail, {HOSTED_ZONE_ID: VPC_DOMAIN_MAP}, TTL,
+        lease=Lease(store, "converge"))
+    assert converge_instance.call_count == 1
+    assert not holder.release()
+    asg_stub.assert_no_pending_responses()
+
+
+def test_handle_lease_marked_dirty(mocker, asg_stub, tmpdir):
+    store = FileLeaseStore(str(tmpdir))
+    other = Lease(store, "converge")
+    # Another invocation finds the lease held during the change
+    mocker.patch("ec2_route53_lambdas.asg_lifecycle.converge_instance",
+                 side_effect=lambda *a, **kw: other.mark_dirty())
+    again = mocker.MagicMock()
+    asg_stub.add_response("complete_lifecycle_action", {}, complete_params())
+
+    detail = lifecycle_event(asg_lifecycle.LAUNCHING)["detail"]
+    assert asg_lifecycle.handle_lifecycle_action(
+        detail, {HOSTED_ZONE_ID: VPC_DOMAIN_MAP}, TTL,
+        lease=Lease(store, "converge"), again=again)
+
+    # Which makes this one converge everything before releasing it
+    again.assert_called_once_with()
+    assert other.acquire()
+    asg_stub.assert_no_pending_responses()
+
+
+def test_handle_ignores_other_transitions(mocker):
+    converge_instance = mocker.patch(
+        "ec2_route53_lambdas.asg_lifecycle.converge_instance")
+
+    detail = {"LifecycleTransition": "autoscaling:TEST_NOTIFICATION"}
+    assert not asg_lifecycle.handle_lifecycle_action(
+        detail, {HOSTED_ZONE_ID: VPC_DOMAIN_MAP}, TTL)
+    assert not converge_instance.called
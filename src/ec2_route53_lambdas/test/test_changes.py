@@ -0,0 +1,155 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime
+
+import pytest
+
+from ec2_route53_lambdas import changes
+from ec2_route53_lambdas.util import RecordSet, route53
+
+
+HOSTED_ZONE_ID = "/hostedzone/Z1111111111111"
+
+
+def gen_change(action, name, values, tpe="A"):
+    return {
+        "Action": action,
+        "ResourceRecordSet": {
+            "Name": name,
+            "Type": tpe,
+            "TTL": 60,
+            "ResourceRecords": [{"Value": v} for v in values]
+        }
+    }
+
+
+def change_info(change_id, status):
+    return {
+        "ChangeInfo": {
+            "Id": change_id,
+            "Status": status,
+            "SubmittedAt": datetime(2017, 1, 1, 0, 0, 0)
+        }
+    }
+
+
+def test_plan_change_batches_single():
+    diff = [gen_change("CREATE", "a.asd.", ["1.1.1.1"]),
+            gen_change("UPSERT", "b.asd.", ["1.1.1.2"])]
+
+    assert changes.plan_change_batches(diff) == [[diff]]
+
+
+def test_plan_change_batches_empty():
+    assert changes.plan_change_batches([]) == []
+
+
+def test_plan_change_batches_values_limit():
+    diff = [gen_change("CREATE", "{}.asd.".format(i), ["1.1.1.1", "1.1.1.2"])
+            for i in range(5)]
+
+    waves = changes.plan_change_batches(diff, max_values=4)
+    assert len(waves) == 1
+    assert waves[0] == [diff[0:2], diff[2:4], diff[4:5]]
+
+
+def test_plan_change_batches_upsert_counts_twice():
+    diff = [gen_change("UPSERT", "{}.asd.".format(i), ["1.1.1.1"])
+            for i in range(4)]
+
+    waves = changes.plan_change_batches(diff, max_values=4)
+    assert waves == [[diff[0:2], diff[2:4]]]
+
+
+def test_plan_change_batches_characters_limit():
+    diff = [gen_change("CREATE", "{}.asd.".format(i), ["10.0.0.1"])
+            for i in range(3)]
+
+    waves = changes.plan_change_batches(diff, max_characters=16)
+    assert waves == [[diff[0:2], diff[2:3]]]
+
+
+def test_plan_change_batches_delete_before_create():
+    create = gen_change("CREATE", "a.asd.", ["a.asd.com."], tpe="CNAME")
+    other = gen_change("CREATE", "b.asd.", ["1.1.1.1"])
+    delete = gen_change("DELETE", "a.asd", ["1.1.1.1"])
+
+    waves = changes.plan_change_batches([create, other, delete],
+                                        max_changes=2)
+    assert waves == [[[delete, create], [other]]]
+
+
+def test_plan_change_batches_oversized_name():
+    delete = gen_change("DELETE", "a.asd.", ["1.1.1.1", "1.1.1.2"])
+    create = gen_change("CREATE", "a.asd.", ["a.asd.com."], tpe="CNAME")
+    other = gen_change("CREATE", "b.asd.", ["1.1.1.3"])
+
+    waves = changes.plan_change_batches([create, other, delete],
+                                        max_values=2)
+    assert waves == [[[other]], [[delete]], [[create]]]
+
+
+def test_plan_change_batches_too_large():
+    diff = [gen_change("CREATE", "a.asd.", ["1.1.1.1", "1.1.1.2"])]
+
+    with pytest.raises(ValueError):
+        changes.plan_change_batches(diff, max_values=1)
+
+
+def test_plan_change_batches_record_sets():
+    old = RecordSet.from_json({
+        "Name": "a.asd",
+        "Type": "A",
+        "TTL": 300,
+        "ResourceRecords": [{"Value": "1.1.1.1"}]
+    })
+    new = RecordSet("a.asd", "CNAME", 300, {"b.asd"})
+
+    diff = [new.change_request(), old.delete_request()]
+    waves = changes.plan_change_batches(diff)
+    assert waves == [[[old.delete_request(), new.change_request()]]]
+
+
+def test_submit_and_wait_change_batches(mocker, route53_stub):
+    sleep = mocker.patch("time.sleep")
+    batch_1 = [gen_change("CREATE", "a.asd.", ["1.1.1.1"])]
+    batch_2 = [gen_change("CREATE", "b.asd.", ["1.1.1.2"])]
+    batch_3 = [gen_change("CREATE", "c.asd.", ["1.1.1.3"])]
+
+    for change_id, batch in [("C1", batch_1), ("C2", batch_2)]:
+        route53_stub.add_response(
+            "change_resource_record_sets",
+            change_info(change_id, "PENDING"),
+            {"HostedZoneId": HOSTED_ZONE_ID,
+             "ChangeBatch": {"Changes": batch}})
+    route53_stub.add_response(
+        "change_resource_record_sets",
+        change_info("C3", "INSYNC"),
+        {"HostedZoneId": HOSTED_ZONE_ID, "ChangeBatch": {"Changes": batch_3}})
+
+    route53_stub.add_response("get_change", change_info("C1", "PENDING"),
+                              {"Id": "C1"})
+    route53_stub.add_response("get_change", change_info("C2", "INSYNC"),
+                              {"Id": "C2"})
+    route53_stub.add_response("get_change", change_info("C1", "INSYNC"),
+                              {"Id": "C1"})
+
+    client = route53()
+    infos = changes.submit_change_batches(
+        client, HOSTED_ZONE_ID, [[batch_1, batch_2], [batch_3]],
+        concurrency=1)
+    assert [info["Id"] for info in infos] == ["C1", "C2", "C3"]
+
+    changes.wait_changes(client, infos, delay=5)
+    route53_stub.assert_no_pending_responses()
+    sleep.assert_called_once_with(5)
+
+
+def test_wait_changes_timeout(mocker, route53_stub):
+    mocker.patch("time.sleep")
+    route53_stub.add_response("get_change", change_info("C1", "PENDING"),
+                              {"Id": "C1"})
+
+    with pytest.raises(RuntimeError):
+        changes.wait_changes(route53(), [{"Id": "C1", "Status": "PENDING"}],
+                             max_attempts=1)
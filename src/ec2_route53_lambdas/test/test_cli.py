@@ -0,0 +1,110 @@
+from __future__ import absolute_import, unicode_literals
+
+import json
+import pstats
+
+from ec2_route53_lambdas import cli, ec2_dns
+
+
+INSTANCES = {
+    "Reservations": [{
+        "Instances": [{
+            "InstanceId": "i-1111",
+            "VpcId": "vpc-1",
+            "PrivateIpAddress": "10.0.0.1",
+            "LaunchTime": "2017-01-01T00:00:00+00:00",
+            "State": {"Code": 16, "Name": "running"},
+            "Tags": [{"Key": "Name", "Value": "web"}]
+        }, {
+            "InstanceId": "i-2222",
+            "VpcId": "vpc-2",
+            "PrivateIpAddress": "10.0.1.1",
+            "LaunchTime": "2017-01-01T00:00:00+00:00",
+            "State": {"Code": 48, "Name": "terminated"}
+        }]
+    }]
+}
+
+ZONE = {
+    "ResourceRecordSets": [{
+        "Name": "web.prod.",
+        "Type": "A",
+        "TTL": 60,
+        "ResourceRecords": [{"Value": "10.0.0.1"}]
+    }, {
+        "Name": "i-0000.prod.",
+        "Type": "A",
+        "TTL": 60,
+        "ResourceRecords": [{"Value": "10.0.0.9"}]
+    }, {
+        "Name": "prod.",
+        "Type": "TXT",
+        "TTL": 300,
+        "ResourceRecords": [{"Value": "\"unmanaged\""}]
+    }]
+}
+
+
+def write_json(tmpdir, name, data):
+    path = tmpdir.join(name)
+    path.write(json.dumps(data))
+    return str(path)
+
+
+def test_cli_plan(tmpdir, capsys):
+    instances = write_json(tmpdir, "instances.json", INSTANCES)
+    zone = write_json(tmpdir, "zone.json", ZONE)
+    profile = str(tmpdir.join("run.prof"))
+
+    assert cli.main(["--instances", instances, "--zone", zone,
+                     "--vpc", "vpc-1=prod", "--vpc", "vpc-2=dev",
+                     "--profile", profile]) == 0
+
+    out, err = capsys.readouterr()
+    assert sorted(out.splitlines()) == [
+        "CREATE A i-1111.prod. 10.0.0.1",
+        "CREATE A web-1.prod. 10.0.0.1",
+        "DELETE A i-0000.prod. 10.0.0.9"
+    ]
+    assert err.splitlines()[-1] == \
+        "3 changes (2 CREATE, 0 UPSERT, 1 DELETE)"
+    assert "more" not in err
+    assert pstats.Stats(profile).total_calls > 0
+
+
+def test_cli_plan_json(tmpdir, capsys):
+    instances = write_json(tmpdir, "instances.json",
+                           INSTANCES["Reservations"][0]["Instances"])
+    allocations = str(tmpdir.join("allocations.txt"))
+
+    assert cli.main(["--instances", instances, "--vpc", "vpc-1=prod",
+                     "--json", "--tracemalloc", allocations]) == 0
+
+    out, _ = capsys.readouterr()
+    changes = json.loads(out)
+    assert sorted(c["ResourceRecordSet"]["Name"] for c in changes) == \
+        ["i-1111.prod.", "web-1.prod.", "web.prod."]
+    assert tmpdir.join("allocations.txt").size() > 0
+
+
+def test_cli_plan_split_group(tmpdir, capsys):
+    instances = [{
+        "InstanceId": "i-{:04d}".format(i),
+        "VpcId": "vpc-1",
+        "PrivateIpAddress": "10.0.{}.{}".format(i // 250, i % 250 + 1),
+        "LaunchTime": "2017-01-01T00:00:00+00:00",
+        "State": {"Code": 16, "Name": "running"},
+        "Tags": [{"Key": "Name", "Value": "web"}]
+    } for i in range(400)]
+    # The group published by an earlier run spans several listing pages
+    zone = [r.to_json() for r in ec2_dns.records_from_instances(
+        instances, {"vpc-1": "prod"}, 60, group_routing="multivalue")]
+
+    assert cli.main([
+        "--instances", write_json(tmpdir, "instances.json", instances),
+        "--zone", write_json(tmpdir, "zone.json", zone),
+        "--vpc", "vpc-1=prod", "--group-routing", "multivalue"]) == 0
+
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert "0 changes" in err
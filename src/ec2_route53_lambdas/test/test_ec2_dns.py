@@ -1,9 +1,25 @@
 from __future__ import absolute_import, unicode_literals
 
+import time
 from datetime import datetime
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import pytest
+from botocore.exceptions import ClientError
+
 from .conftest import gen_instance_info_response
 
-from ec2_route53_lambdas.util import RecordSet
+from ec2_route53_lambdas.events import LocalQueue
+from ec2_route53_lambdas.fixtures import FakeEc2, FakeRoute53
+from ec2_route53_lambdas.metrics import Metrics
+from ec2_route53_lambdas.state import \
+    SNAPSHOT_MAX_AGE, FileStateStore, PendingChanges, ZoneSnapshot, to_epoch
+from ec2_route53_lambdas.util import \
+    RecordSet, register_client, route53_sort_key
 from ec2_route53_lambdas import ec2_dns
 
 
@@ -96,6 +112,41 @@ def test_records_from_instances():
     assert records == set(STARTING_ZONES)
 
 
+def test_records_from_instances_stable_slots():
+    def web(i, ip):
+        return {
+            "InstanceId": "i-{}".format(i),
+            "VpcId": PROD_VPC,
+            "PrivateIpAddress": ip,
+            "LaunchTime": datetime(2017, 1, 1, 0, i, 0),
+            "Tags": [{"Key": "Name", "Value": "web"}]
+        }
+
+    group = [web(1, "10.0.0.1"), web(2, "10.0.0.2"), web(3, "10.0.0.3")]
+    current = ec2_dns.records_from_instances(group, VPC_DOMAIN_MAP, TTL)
+    slots = ec2_dns.numbered_slots(current, VPC_DOMAIN_MAP.values())
+    assert slots[("web", "prod")] == {"10.0.0.1": 1, "10.0.0.2": 2,
+                                      "10.0.0.3": 3}
+
+    # The first instance going away only deletes its own numbered record
+    updated = ec2_dns.records_from_instances(group[1:], VPC_DOMAIN_MAP, TTL,
+                                             slots=slots)
+    numbered = [c for c in ec2_dns.diff_records(current, updated)
+                if c["ResourceRecordSet"]["Name"].startswith("web-")]
+    assert [change_key(c) for c in numbered] == \
+        [("web-1.prod.", "A", "DELETE", frozenset(["10.0.0.1"]))]
+
+    # And the next one launched takes the free slot
+    updated = ec2_dns.records_from_instances(
+        group[1:] + [web(4, "10.0.0.4")], VPC_DOMAIN_MAP, TTL, slots=slots)
+    assert RecordSet("web-1.prod", "A", TTL, {"10.0.0.4"}) in updated
+    assert RecordSet("web-3.prod", "A", TTL, {"10.0.0.3"}) in updated
+
+    # Without slots, instances are renumbered in launch order
+    updated = ec2_dns.records_from_instances(group[1:], VPC_DOMAIN_MAP, TTL)
+    assert RecordSet("web-1.prod", "A", TTL, {"10.0.0.2"}) in updated
+
+
 def test_records_from_running_instances(mocker, ec2_stub):
     mocker.patch("ec2_route53_lambdas.ec2_dns.records_from_instances",
                  return_value=STARTING_ZONES, autospec=True)
@@ -114,6 +165,9 @@ def test_records_from_running_instances(mocker, ec2_stub):
             "Filters": [{
                 "Name": "instance-state-name",
                 "Values": ["pending", "running"]
+            }, {
+                "Name": "vpc-id",
+                "Values": sorted(VPC_DOMAIN_MAP.keys())
             }]
         })
 
@@ -121,6 +175,43 @@ def test_records_from_running_instances(mocker, ec2_stub):
     assert extracted == STARTING_ZONES
 
 
+def test_running_instances(ec2_stub):
+    filters = [{
+        "Name": "instance-state-name",
+        "Values": ["pending", "running"]
+    }, {
+        "Name": "vpc-id",
+        "Values": [PROD_VPC]
+    }]
+
+    ec2_stub.add_response(
+        "describe_instances",
+        {
+            "Reservations": [{"Instances": STARTING_INSTANCES[:4]}],
+            "NextToken": "page-2"
+        },
+        {"Filters": filters})
+    ec2_stub.add_response(
+        "describe_instances",
+        {"Reservations": [{"Instances": STARTING_INSTANCES[4:6]}]},
+        {"Filters": filters, "NextToken": "page-2"})
+
+    instances = list(ec2_dns.running_instances([PROD_VPC]))
+    ec2_stub.assert_no_pending_responses()
+
+    assert [i["InstanceId"] for i in instances] == \
+        [i["InstanceId"] for i in STARTING_INSTANCES[:6]]
+    assert set(instances[0].keys()) == \
+        {"InstanceId", "VpcId", "PrivateIpAddress", "LaunchTime", "Tags"}
+    assert {t["Key"] for t in instances[0]["Tags"]} == \
+        {"Name", "aws:autoscaling:groupName"}
+
+    records = ec2_dns.records_from_instances(instances, VPC_DOMAIN_MAP, TTL)
+    assert records == \
+        ec2_dns.records_from_instances(STARTING_INSTANCES[:6],
+                                       VPC_DOMAIN_MAP, TTL)
+
+
 HOSTED_ZONE_ID = "/hostedzone/Z1111111111111"
 RECORD_SETS = [
     {
@@ -178,6 +269,14 @@ RECORD_SETS = [
         "Name": "prefix-prod.aws.example.com.",
         "TTL": 300
     },
+    {
+        "ResourceRecords": [
+            {"Value": "\"v=spf1 -all\""}
+        ],
+        "Type": "TXT",
+        "Name": "db.dev.aws.example.com.",
+        "TTL": 300
+    },
 ]
 
 
@@ -195,14 +294,20 @@ def test_extract_existing_records():
 
 
 def test_existing_records(route53_stub):
-    route53_stub.add_response(
-        "list_resource_record_sets",
-        {
-            "ResourceRecordSets": RECORD_SETS,
-            "IsTruncated": False,
-            "MaxItems": "100"
-        },
-        {"HostedZoneId": HOSTED_ZONE_ID})
+    # Each managed domain is listed from its own position in the zone, and
+    # the listing stops past its names
+    zone = sorted(RECORD_SETS, key=lambda r: route53_sort_key(r["Name"]))
+    for name in ("dev.aws.example.com.", "prod.aws.example.com."):
+        start = [route53_sort_key(r["Name"]) >= route53_sort_key(name)
+                 for r in zone].index(True)
+        route53_stub.add_response(
+            "list_resource_record_sets",
+            {
+                "ResourceRecordSets": zone[start:],
+                "IsTruncated": False,
+                "MaxItems": "100"
+            },
+            {"HostedZoneId": HOSTED_ZONE_ID, "StartRecordName": name})
 
     extracted = ec2_dns.existing_records(
         HOSTED_ZONE_ID, ["prod.aws.example.com", "dev.aws.example.com"])
@@ -260,7 +365,16 @@ NEW_RECORDS = [
 
 RECORDS_DIFF = [
     {
-        "Action": "UPSERT",
+        "Action": "DELETE",
+        "ResourceRecordSet": {
+            "Name": "b.asd",
+            "ResourceRecords": [{"Value": "a.asd."}],
+            "TTL": 300,
+            "Type": "CNAME"
+        }
+    },
+    {
+        "Action": "CREATE",
         "ResourceRecordSet": {
             "Name": "b.asd.",
             "ResourceRecords": [{"Value": "1.1.1.5"}],
@@ -299,12 +413,36 @@ RECORDS_DIFF = [
 ]
 
 
-def test_diff_records():
-    def sort_key(e):
-        return e["ResourceRecordSet"]["Name"], e["ResourceRecordSet"]["Type"]
+def diff_sort_key(e):
+    return e["ResourceRecordSet"]["Name"], e["ResourceRecordSet"]["Type"]
+
 
+def test_diff_records():
     generated = ec2_dns.diff_records(OLD_RECORDS, NEW_RECORDS)
-    assert sorted(generated, key=sort_key) == sorted(RECORDS_DIFF, key=sort_key)
+    assert sorted(generated, key=diff_sort_key) == \
+        sorted(RECORDS_DIFF, key=diff_sort_key)
+
+
+def test_diff_records_by_type():
+    old = [
+        RecordSet("a.asd", "A", 300, {"1.1.1.1"}),
+        RecordSet("a.asd", "CNAME", 300, {"b.asd"}),
+        RecordSet("c.asd", "A", 300, {"1.1.1.3"}),
+    ]
+    new = [
+        RecordSet("a.asd", "A", 300, {"1.1.1.1"}),
+        RecordSet("c.asd", "A", 60, {"1.1.1.3"}),
+        RecordSet("c.asd", "CNAME", 60, {"b.asd"}),
+    ]
+
+    generated = ec2_dns.diff_records(iter(old), new)
+    assert sorted(generated, key=diff_sort_key) == [
+        old[1].delete_request(),
+        new[1].change_request(existing=True),
+        new[2].change_request()
+    ]
+
+    assert list(ec2_dns.diff_records(old, old)) == []
 
 
 def test_converge_records(mocker, route53_stub):
@@ -313,7 +451,7 @@ def test_converge_records(mocker, route53_stub):
     change_id = "C1234567"
 
     existing_records = mocker.patch(
-        "ec2_route53_lambdas.ec2_dns.existing_records",
+        "ec2_route53_lambdas.ec2_dns.existing_records_stream",
         return_value=OLD_RECORDS, autospec=True)
     records_from_running_instances = mocker.patch(
         "ec2_route53_lambdas.ec2_dns.records_from_running_instances",
@@ -351,15 +489,124 @@ def test_converge_records(mocker, route53_stub):
             "Id": change_id
         })
 
-    ec2_dns.converge_records(HOSTED_ZONE_ID, vpc_domain_map, TTL)
+    metrics = Metrics()
+    ec2_dns.converge_records(HOSTED_ZONE_ID, vpc_domain_map, TTL,
+                             metrics=metrics)
     route53_stub.assert_no_pending_responses()
 
     existing_records.assert_called_once_with(
-        HOSTED_ZONE_ID, list(vpc_domain_map.values()))
+        HOSTED_ZONE_ID, list(vpc_domain_map.values()), shards=1)
     records_from_running_instances.assert_called_once_with(
-        vpc_domain_map, TTL)
-    diff_records.assert_called_once_with(
-        OLD_RECORDS, NEW_RECORDS)
+        vpc_domain_map, TTL, metrics=mocker.ANY, slots=None,
+        group_routing=None, locations=None, instances=None)
+    diff_records.assert_called_once_with(mocker.ANY, NEW_RECORDS)
+    assert list(diff_records.call_args[0][0]) == OLD_RECORDS
+
+    assert metrics.get("ChangesCreate") == 2
+    assert metrics.get("ChangesUpsert") == 1
+    assert metrics.get("ChangesDelete") == 2
+    assert metrics.get("ChangeBatches") == 1
+    for phase in ("ZoneListing", "Diff", "Submit", "Propagation"):
+        assert metrics.get(phase + "Time") >= 0
+
+
+def test_summarize_changes():
+    assert ec2_dns.summarize_changes(RECORDS_DIFF, limit=2) == "\n".join([
+        "5 changes (2 CREATE, 1 UPSERT, 2 DELETE)",
+        "DELETE CNAME b.asd a.asd.",
+        "CREATE A b.asd. 1.1.1.5",
+        "... and 3 more"
+    ])
+    assert ec2_dns.summarize_changes(RECORDS_DIFF, limit=0) == \
+        "5 changes (2 CREATE, 1 UPSERT, 2 DELETE)"
+
+
+SNAPSHOT_OLD_RECORDS = [OLD_RECORDS[i] for i in (0, 2, 3, 4)]
+SNAPSHOT_NEW_RECORDS = [NEW_RECORDS[i] for i in (0, 2, 3)]
+
+
+def test_converge_records_snapshot(mocker, tmpdir):
+    vpc_domain_map = {"vpc-1234": "asd"}
+    store = FileStateStore(str(tmpdir))
+    snapshot = ZoneSnapshot(store, HOSTED_ZONE_ID, ["asd"])
+    snapshot.save(SNAPSHOT_OLD_RECORDS, time.time())
+
+    existing_records = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.existing_records", autospec=True)
+    mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.records_from_running_instances",
+        return_value=SNAPSHOT_NEW_RECORDS, autospec=True)
+    apply_changes = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.apply_changes", autospec=True)
+
+    assert ec2_dns.converge_records(HOSTED_ZONE_ID, vpc_domain_map, TTL,
+                                    state=store)
+    assert not existing_records.called
+    assert apply_changes.call_count == 1
+
+    # The snapshot now reflects the applied changes
+    assert snapshot.load() == set(SNAPSHOT_NEW_RECORDS)
+
+
+def test_converge_records_snapshot_rejected(mocker, tmpdir):
+    vpc_domain_map = {"vpc-1234": "asd"}
+    store = FileStateStore(str(tmpdir))
+    snapshot = ZoneSnapshot(store, HOSTED_ZONE_ID, ["asd"])
+    snapshot.save(SNAPSHOT_OLD_RECORDS[:1], time.time())
+
+    existing_records = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.existing_records",
+        return_value=frozenset(SNAPSHOT_OLD_RECORDS), autospec=True)
+    mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.records_from_running_instances",
+        return_value=SNAPSHOT_NEW_RECORDS, autospec=True)
+    error = ClientError({"Error": {"Code": "InvalidChangeBatch"}},
+                        "ChangeResourceRecordSets")
+    apply_changes = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.apply_changes",
+        side_effect=[error, True], autospec=True)
+
+    assert ec2_dns.converge_records(HOSTED_ZONE_ID, vpc_domain_map, TTL,
+                                    state=store)
+    existing_records.assert_called_once_with(
+        HOSTED_ZONE_ID, ["asd"], shards=1, boundaries=[])
+    assert apply_changes.call_count == 2
+    assert snapshot.load() == set(SNAPSHOT_NEW_RECORDS)
+
+
+def test_converge_records_no_wait(mocker, route53_stub, tmpdir):
+    store = FileStateStore(str(tmpdir))
+    submitted_at = datetime(2017, 1, 1, 0, 0, 0)
+
+    mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.existing_records_stream",
+        return_value=iter(SNAPSHOT_OLD_RECORDS), autospec=True)
+    mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.records_from_running_instances",
+        return_value=SNAPSHOT_NEW_RECORDS, autospec=True)
+    mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.apply_changes",
+        return_value=[{"Id": "C1", "Status": "PENDING",
+                       "SubmittedAt": submitted_at}],
+        autospec=True)
+    mocker.patch("time.time", return_value=to_epoch(submitted_at) + 45)
+
+    assert ec2_dns.converge_records(HOSTED_ZONE_ID, {"vpc-1234": "asd"}, TTL,
+                                    state=store, snapshot_max_age=0,
+                                    wait=False)
+    pending = PendingChanges(store, HOSTED_ZONE_ID)
+    assert [c["Id"] for c in pending.load()] == ["C1"]
+
+    # The next run polls the outstanding change before doing anything else
+    route53_stub.add_response(
+        "get_change",
+        {"ChangeInfo": {"Id": "C1", "Status": "INSYNC",
+                        "SubmittedAt": submitted_at}},
+        {"Id": "C1"})
+
+    assert ec2_dns.check_pending_changes(HOSTED_ZONE_ID, store) == [45]
+    assert pending.load() == []
+    route53_stub.assert_no_pending_responses()
 
 
 EC2_STATE_EVENT = {
@@ -393,5 +640,652 @@ def test_handler(mocker, monkeypatch):
 
     assert ec2_dns.handler(EC2_STATE_EVENT, context)
 
-    converge_records.assert_called_once_with(HOSTED_ZONE_ID, VPC_DOMAIN_MAP,
-                                             TTL)
+    converge_records.assert_called_once_with(
+        HOSTED_ZONE_ID, VPC_DOMAIN_MAP, TTL, state=None,
+        snapshot_max_age=SNAPSHOT_MAX_AGE, wait=True, metrics=mocker.ANY,
+        stable_slots=False, bounded=False, listing_shards=1,
+        group_routing=None, locations={}, full_interval=0)
+
+
+def change_key(change):
+    record_set = change["ResourceRecordSet"]
+    values = frozenset(r["Value"] for r in record_set["ResourceRecords"])
+    return (record_set["Name"], record_set["Type"], change["Action"], values)
+
+
+def list_response(records, next_name=None):
+    response = {
+        "ResourceRecordSets": records,
+        "IsTruncated": next_name is not None,
+        "MaxItems": "100"
+    }
+    if next_name:
+        response["NextRecordName"] = next_name
+        response["NextRecordType"] = "A"
+    return response
+
+
+def record_json(name, values, tpe="A", ttl=TTL):
+    return {
+        "Name": name,
+        "Type": tpe,
+        "TTL": ttl,
+        "ResourceRecords": [{"Value": v} for v in values]
+    }
+
+
+DB_GROUP_FILTERS = [
+    {"Name": "instance-state-name", "Values": ["pending", "running"]},
+    {"Name": "vpc-id", "Values": [PROD_VPC]},
+    {"Name": "tag:Name", "Values": ["db", "db-*"]}
+]
+DB_ADDRESS_FILTERS = DB_GROUP_FILTERS[:2] + [
+    {"Name": "private-ip-address", "Values": ["10.0.0.103", "10.0.0.104"]}
+]
+
+
+def add_db_instance_responses(ec2_stub):
+    ec2_stub.add_response(
+        "describe_instances",
+        {"Reservations": [{"Instances": STARTING_INSTANCES[2:4]}]},
+        {"Filters": DB_GROUP_FILTERS})
+    # Members of the group are also looked up by their published addresses
+    ec2_stub.add_response(
+        "describe_instances",
+        {"Reservations": [{"Instances": STARTING_INSTANCES[2:4]}]},
+        {"Filters": DB_ADDRESS_FILTERS})
+
+
+def add_db_group_responses(route53_stub, instance_id, records):
+    route53_stub.add_response(
+        "list_resource_record_sets",
+        list_response(records.get(instance_id, [])
+                      + [record_json("job-worker.prod.", ["10.0.0.1"])]),
+        {"HostedZoneId": HOSTED_ZONE_ID,
+         "StartRecordName": instance_id + ".prod."})
+    route53_stub.add_response(
+        "list_resource_record_sets",
+        list_response([record_json("db.prod.", ["10.0.0.103", "10.0.0.104"]),
+                       record_json("dba.prod.", ["10.0.0.1"])]),
+        {"HostedZoneId": HOSTED_ZONE_ID, "StartRecordName": "db.prod."})
+    route53_stub.add_response(
+        "list_resource_record_sets",
+        list_response([record_json("db-1.prod.", ["10.0.0.104"])],
+                      next_name="db-2.prod."),
+        {"HostedZoneId": HOSTED_ZONE_ID, "StartRecordName": "db-.prod."})
+    route53_stub.add_response(
+        "list_resource_record_sets",
+        list_response([record_json("db-2.prod.", ["10.0.0.103"]),
+                       record_json("db.prod.", ["10.0.0.103", "10.0.0.104"])]),
+        {"HostedZoneId": HOSTED_ZONE_ID, "StartRecordName": "db-2.prod.",
+         "StartRecordType": "A"})
+
+
+def test_converge_instance_running(mocker, ec2_stub, route53_stub):
+    apply_changes = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.apply_changes",
+        return_value=True, autospec=True)
+
+    new_instance = gen_instance_info_response(
+        name='db', instance_id="i-0000000000000007",
+        vpc_id=PROD_VPC, private_ip="10.0.0.107",
+        launch_time=datetime(2017, 1, 2, 0, 0, 0))
+
+    ec2_stub.add_response(
+        "describe_instances",
+        {"Reservations": [{"Instances": [new_instance]}]},
+        {"InstanceIds": ["i-0000000000000007"]})
+    add_db_instance_responses(ec2_stub)
+    add_db_group_responses(route53_stub, "i-0000000000000007", {})
+
+    assert ec2_dns.converge_instance(HOSTED_ZONE_ID, VPC_DOMAIN_MAP, TTL,
+                                     "i-0000000000000007", "running")
+    ec2_stub.assert_no_pending_responses()
+    route53_stub.assert_no_pending_responses()
+
+    changes = apply_changes.call_args[0][1]
+    assert sorted(map(change_key, changes)) == sorted(map(change_key, [
+        RecordSet("db-3.prod", "A", TTL, {"10.0.0.107"}).change_request(),
+        RecordSet("db.prod", "A", TTL,
+                  {"10.0.0.103", "10.0.0.104", "10.0.0.107"})
+        .change_request(existing=True),
+        RecordSet("i-0000000000000007.prod", "A", TTL, {"10.0.0.107"})
+        .change_request()
+    ]))
+
+
+def test_converge_instance_terminated(mocker, ec2_stub, route53_stub):
+    apply_changes = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.apply_changes",
+        return_value=True, autospec=True)
+
+    terminated = gen_instance_info_response(
+        name='db', instance_id="i-0000000000000004",
+        vpc_id=PROD_VPC, private_ip="10.0.0.104",
+        launch_time=datetime(2017, 1, 1, 0, 0, 0))
+    terminated["State"] = {"Code": 48, "Name": "terminated"}
+    del terminated["VpcId"]
+
+    ec2_stub.add_response(
+        "describe_instances",
+        {"Reservations": [{"Instances": [terminated]}]},
+        {"InstanceIds": ["i-0000000000000004"]})
+    # The VPC is gone, so the domain is found through the ID record
+    route53_stub.add_response(
+        "list_resource_record_sets",
+        list_response([record_json("job-worker.dev.", ["10.0.1.101"])]),
+        {"HostedZoneId": HOSTED_ZONE_ID,
+         "StartRecordName": "i-0000000000000004.dev."})
+    id_record = record_json("i-0000000000000004.prod.", ["10.0.0.104"])
+    route53_stub.add_response(
+        "list_resource_record_sets",
+        list_response([id_record]),
+        {"HostedZoneId": HOSTED_ZONE_ID,
+         "StartRecordName": "i-0000000000000004.prod."})
+
+    add_db_instance_responses(ec2_stub)
+    add_db_group_responses(route53_stub, "i-0000000000000004",
+                           {"i-0000000000000004": [id_record]})
+
+    assert ec2_dns.converge_instance(HOSTED_ZONE_ID, VPC_DOMAIN_MAP, TTL,
+                                     "i-0000000000000004", "terminated")
+    ec2_stub.assert_no_pending_responses()
+    route53_stub.assert_no_pending_responses()
+
+    changes = apply_changes.call_args[0][1]
+    assert sorted(map(change_key, changes)) == sorted(map(change_key, [
+        RecordSet("db-1.prod", "A", TTL, {"10.0.0.103"})
+        .change_request(existing=True),
+        {"Action": "DELETE",
+         "ResourceRecordSet": record_json("db-2.prod.", ["10.0.0.103"])},
+        RecordSet("db.prod", "A", TTL, {"10.0.0.103"})
+        .change_request(existing=True),
+        {"Action": "DELETE", "ResourceRecordSet": id_record}
+    ]))
+
+
+def test_handler_incremental(mocker, monkeypatch):
+    monkeypatch.setenv('EC2_DNS_HOSTED_ZONE_ID', HOSTED_ZONE_ID)
+    monkeypatch.setenv("EC2_DNS_VPC_IDS", ",".join(VPC_DOMAIN_MAP.keys()))
+    monkeypatch.setenv("EC2_DNS_VPC_DOMAINS", ",".join(VPC_DOMAIN_MAP.values()))
+    monkeypatch.setenv("EC2_DNS_RECORD_TTL", str(TTL))
+    monkeypatch.setenv("EC2_DNS_INCREMENTAL_EVENTS", "true")
+
+    converge_records = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.converge_records",
+        return_value=True, autospec=True)
+    converge_instance = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.converge_instance",
+        return_value=True, autospec=True)
+
+    assert ec2_dns.handler(EC2_STATE_EVENT, mocker.MagicMock())
+    converge_instance.assert_called_once_with(
+        HOSTED_ZONE_ID, VPC_DOMAIN_MAP, TTL, "i-abcd1111", "pending",
+        state_store=None, wait=True, stable_slots=False,
+        group_routing=None, locations={})
+
+    assert ec2_dns.handler({"detail-type": "Scheduled Event"},
+                           mocker.MagicMock())
+    converge_records.assert_called_once_with(
+        HOSTED_ZONE_ID, VPC_DOMAIN_MAP, TTL, state=None,
+        snapshot_max_age=SNAPSHOT_MAX_AGE, wait=True, metrics=mocker.ANY,
+        stable_slots=False, bounded=False, listing_shards=1,
+        group_routing=None, locations={}, full_interval=0)
+
+
+def test_handler_lease(mocker, monkeypatch, tmpdir):
+    monkeypatch.setenv('EC2_DNS_HOSTED_ZONE_ID', HOSTED_ZONE_ID)
+    monkeypatch.setenv("EC2_DNS_VPC_IDS", ",".join(VPC_DOMAIN_MAP.keys()))
+    monkeypatch.setenv("EC2_DNS_VPC_DOMAINS", ",".join(VPC_DOMAIN_MAP.values()))
+    monkeypatch.setenv("EC2_DNS_RECORD_TTL", str(TTL))
+    monkeypatch.setenv("EC2_DNS_LEASE_URL", str(tmpdir))
+
+    converge_records = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.converge_records",
+        return_value=True, autospec=True)
+    context = mocker.MagicMock()
+    context.get_remaining_time_in_millis.return_value = 60000
+
+    # Another invocation holds the lease: this one only marks it dirty
+    zones = ec2_dns.zones_from_env()
+    other = ec2_dns.lease_from_env(zones, context)
+    assert other.acquire()
+
+    assert ec2_dns.handler({"detail-type": "Scheduled Event"}, context)
+    assert not converge_records.called
+
+    assert not other.release()
+    assert other.release()
+
+    assert ec2_dns.handler({"detail-type": "Scheduled Event"}, context)
+    assert converge_records.call_count == 1
+    assert other.acquire()
+
+
+def test_handler_batched_events(mocker, monkeypatch):
+    monkeypatch.setenv('EC2_DNS_HOSTED_ZONE_ID', HOSTED_ZONE_ID)
+    monkeypatch.setenv("EC2_DNS_VPC_IDS", ",".join(VPC_DOMAIN_MAP.keys()))
+    monkeypatch.setenv("EC2_DNS_VPC_DOMAINS", ",".join(VPC_DOMAIN_MAP.values()))
+    monkeypatch.setenv("EC2_DNS_RECORD_TTL", str(TTL))
+    monkeypatch.setenv("EC2_DNS_INCREMENTAL_EVENTS", "true")
+
+    converge_records = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.converge_records",
+        return_value=True, autospec=True)
+    converge_instance = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.converge_instance",
+        return_value=True, autospec=True)
+
+    def state_event(instance_id, state):
+        return dict(EC2_STATE_EVENT, detail={"instance-id": instance_id,
+                                             "state": state})
+
+    # A small burst is still handled instance by instance, once each
+    queue = LocalQueue()
+    queue.send(state_event("i-1", "pending"))
+    queue.send(state_event("i-2", "pending"))
+    queue.send(state_event("i-1", "running"))
+    queue.drain(ec2_dns.handler, max_messages=10)
+
+    assert not converge_records.called
+    assert [c[0][3:5] for c in converge_instance.call_args_list] == \
+        [("i-2", "pending"), ("i-1", "running")]
+
+    # A scale out converges the whole zone once per batch
+    converge_instance.reset_mock()
+    for i in range(200):
+        queue.send(state_event("i-{}".format(i), "pending"))
+    queue.drain(ec2_dns.handler, max_messages=100)
+
+    assert not converge_instance.called
+    assert converge_records.call_count == 2
+
+
+def test_converge_zones(mocker):
+    zones = ec2_dns.zone_vpc_maps(
+        {"vpc-1": "a", "vpc-2": "b", "vpc-3": "c"}, "Z1",
+        {"vpc-2": "Z2", "vpc-3": "Z2"})
+    assert zones == {"Z1": {"vpc-1": "a"}, "Z2": {"vpc-2": "b", "vpc-3": "c"}}
+
+    def converge(hosted_zone_id, vpc_map, ttl, **options):
+        if hosted_zone_id == "Z2":
+            raise ValueError("failed")
+        return True
+
+    converge_records = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.converge_records",
+        side_effect=converge, autospec=True)
+
+    results = ec2_dns.converge_zones(zones, TTL, concurrency=2, state=None)
+    assert converge_records.call_count == 2
+    converge_records.assert_any_call("Z1", {"vpc-1": "a"}, TTL, state=None,
+                                     metrics=mocker.ANY)
+    converge_records.assert_any_call(
+        "Z2", {"vpc-2": "b", "vpc-3": "c"}, TTL, state=None,
+        metrics=mocker.ANY)
+
+    results = dict((r["hosted_zone_id"], r) for r in results)
+    assert results["Z1"]["error"] is None
+    assert results["Z1"]["domains"] == ["a"]
+    assert isinstance(results["Z2"]["error"], ValueError)
+    assert results["Z2"]["domains"] == ["b", "c"]
+    assert all(r["elapsed"] >= 0 for r in results.values())
+
+
+def test_handler_multiple_zones(mocker, monkeypatch):
+    monkeypatch.setenv('EC2_DNS_HOSTED_ZONE_ID', HOSTED_ZONE_ID)
+    monkeypatch.setenv("EC2_DNS_VPC_IDS", "{},{}".format(PROD_VPC, DEV_VPC))
+    monkeypatch.setenv("EC2_DNS_VPC_DOMAINS", "prod,dev")
+    monkeypatch.setenv("EC2_DNS_VPC_HOSTED_ZONE_IDS", ",Z2")
+    monkeypatch.setenv("EC2_DNS_RECORD_TTL", str(TTL))
+
+    converge_records = mocker.patch(
+        "ec2_route53_lambdas.ec2_dns.converge_records",
+        side_effect=[True, ValueError("failed")], autospec=True)
+
+    with pytest.raises(RuntimeError):
+        ec2_dns.handler(EC2_STATE_EVENT, mocker.MagicMock())
+
+    assert converge_records.call_count == 2
+
+
+def test_domain_sections():
+    records = ec2_dns.extract_existing_records([
+        record_json("db.a.prod.", ["10.0.0.1"]),
+        record_json("a.prod.", ["10.0.0.2"]),
+        record_json("db.dev.", ["10.0.1.1"]),
+        record_json("web.prod.", ["10.0.0.3"]),
+        record_json("db.a.prod.", ["10.0.0.4"]),
+    ], ["prod", "a.prod", "dev"])
+    records = sorted(records, key=lambda r: route53_sort_key(r.name))
+
+    sections = [(d, sorted(r.name for r in section))
+                for d, section in ec2_dns.domain_sections(
+                    records, ["prod", "a.prod", "dev"])]
+    assert sections == [
+        ("dev", ["db.dev."]),
+        ("prod", ["a.prod.", "web.prod."]),
+        ("a.prod", ["db.a.prod.", "db.a.prod."])
+    ]
+
+
+def fleet(vpc_count, size):
+    instances = []
+    for v in range(vpc_count):
+        for i in range(size):
+            tags = [{"Key": "Name", "Value": "svc-{}".format(i // 4)}]
+            if i % 2:
+                tags.append({"Key": "aws:autoscaling:groupName",
+                             "Value": "asg"})
+            instances.append({
+                "InstanceId": "i-{:08x}{:08x}".format(v, i),
+                "VpcId": "vpc-{}".format(v),
+                "PrivateIpAddress": "10.{}.{}.{}".format(
+                    v, i // 250, i % 250 + 1),
+                "LaunchTime": datetime(2017, 1, 1, 0, 0, i % 60),
+                "State": {"Code": 16, "Name": "running"},
+                "Tags": tags
+            })
+
+    vpc_map = dict(("vpc-{}".format(v), "vpc{}.example.com".format(v))
+                   for v in range(vpc_count))
+    return instances, vpc_map
+
+
+def zone_listing(records):
+    return [r.to_json() for r in records]
+
+
+def converge_fixture(instances, zone, vpc_map, **options):
+    route53 = FakeRoute53(zone)
+    register_client("ec2", FakeEc2(instances))
+    register_client("route53", route53)
+    ec2_dns.converge_records(HOSTED_ZONE_ID, vpc_map, TTL, **options)
+    return route53.changes
+
+
+def test_converge_records_bounded():
+    instances, vpc_map = fleet(3, 40)
+    # Some of the instances are gone, and others are new
+    zone = zone_listing(ec2_dns.records_from_instances(
+        instances[10:], vpc_map, TTL))
+    instances = instances[:-10]
+
+    changes = converge_fixture(instances, zone, vpc_map)
+    bounded = converge_fixture(instances, zone, vpc_map, bounded=True)
+    assert len(changes) > 0
+    assert sorted(map(change_key, bounded)) == sorted(map(change_key, changes))
+
+
+@pytest.mark.skipif(tracemalloc is None, reason="requires tracemalloc")
+def test_converge_records_bounded_memory():
+    def peak_memory(vpc_count, **options):
+        instances, vpc_map = fleet(vpc_count, 500)
+        zone = zone_listing(ec2_dns.records_from_instances(
+            instances, vpc_map, TTL))
+        register_client("ec2", FakeEc2(instances))
+        register_client("route53", FakeRoute53(zone))
+
+        tracemalloc.start()
+        try:
+            ec2_dns.converge_records(HOSTED_ZONE_ID, vpc_map, TTL, **options)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    # With 4 times as many instances, spread over 4 times as many VPCs, the
+    # peak only grows with the size of each VPC in bounded mode
+    small = peak_memory(2, bounded=True)
+    large = peak_memory(8, bounded=True)
+    assert large < small * 1.5
+
+    assert peak_memory(8) > large * 2
+
+
+def test_shard_ranges():
+    assert ec2_dns.shard_ranges(["prod"], 1) == [(None, None)]
+    assert ec2_dns.shard_ranges([], 4) == [(None, None)]
+    assert ec2_dns.shard_ranges(["b.asd", "a.asd", "c.asd", "a.asd."], 3) == [
+        (None, "asd.b."),
+        ("b.asd.", "asd.c."),
+        ("c.asd.", None)
+    ]
+
+
+def test_existing_records_sharded():
+    instances, vpc_map = fleet(3, 30)
+    records = zone_listing(ec2_dns.records_from_instances(
+        instances, vpc_map, TTL))
+    records.extend([
+        record_json("a.example.com.", ["10.1.1.1"]),
+        record_json("vpc1.example.com.", ["10.1.1.2"]),
+        record_json("svc-0.vpc1.example.com.", ["svc-1.vpc1.example.com."],
+                    tpe="CNAME"),
+        record_json("zzz.example.com.", ["10.1.1.3"])
+    ])
+    register_client("route53", FakeRoute53(records, page_size=7))
+    domains = list(vpc_map.values())
+
+    serial = list(ec2_dns.existing_records_stream(HOSTED_ZONE_ID, domains))
+    assert len(serial) == len(records) - 3
+
+    names = [r["Name"] for r in records[::5]]
+    for shards in range(2, 6):
+        for boundaries in (None, names):
+            assert list(ec2_dns.existing_records_stream(
+                HOSTED_ZONE_ID, domains, shards=shards,
+                boundaries=boundaries)) == serial
+
+
+def test_domain_ranges():
+    assert ec2_dns.domain_ranges(
+        ["vpc1.example.com", "a.vpc1.example.com.", "vpc0.example.com"]) == [
+        ("vpc0.example.com.", "com.example.vpc0/"),
+        ("vpc1.example.com.", "com.example.vpc1/")
+    ]
+    assert ec2_dns.domain_ranges(
+        ["vpc1.example.com"], shards=2,
+        boundaries=["a.example.com", "vpc1.example.com", "b.vpc1.example.com",
+                    "c.vpc1.example.com"]) == [
+        ("vpc1.example.com.", "com.example.vpc1.c."),
+        ("c.vpc1.example.com.", "com.example.vpc1/")
+    ]
+
+    # Without names to go by, domains are still split in as many ranges
+    ranges = ec2_dns.domain_ranges(["vpc1.example.com"], shards=4)
+    assert len(ranges) == 4
+    assert ranges[0][0] == "vpc1.example.com."
+    assert ranges[-1][1] == "com.example.vpc1/"
+
+
+def test_existing_records_managed_sections():
+    instances, vpc_map = fleet(2, 20)
+    records = zone_listing(ec2_dns.records_from_instances(
+        instances, vpc_map, TTL))
+    managed = len(records)
+    # Unmanaged names on both sides of the managed domains
+    for i in range(500):
+        records.append(record_json("host{}.a.example.com.".format(i),
+                                   ["10.2.0.1"]))
+        records.append(record_json("host{}.zzz.example.com.".format(i),
+                                   ["10.2.0.2"]))
+    route53 = FakeRoute53(records, page_size=10)
+    register_client("route53", route53)
+
+    listed = list(ec2_dns.existing_records_stream(
+        HOSTED_ZONE_ID, list(vpc_map.values())))
+
+    assert len(listed) == managed
+    # At most one page past the end of each domain is read
+    assert route53.listed <= managed + 2 * 10
+
+
+def test_records_from_instances_split_groups():
+    instances, vpc_map = fleet(1, 6)
+
+    records = ec2_dns.records_from_instances(instances, vpc_map, TTL,
+                                             group_routing="multivalue")
+    shards = [r for r in records if r.name == "svc-0.vpc0.example.com."]
+    assert all(r.routing == ("MultiValueAnswer", True) for r in shards)
+    # Every instance is published, in the record set of its shard
+    assert sorted(ip for r in shards for ip in r.records) == \
+        sorted(i["PrivateIpAddress"] for i in instances[:4])
+    for instance in instances[:4]:
+        shard = str(ec2_dns.group_shard(instance["InstanceId"]))
+        assert instance["PrivateIpAddress"] in \
+            next(r for r in shards if r.set_identifier == shard).records
+
+
+def test_records_from_instances_weighted_shards():
+    instances, vpc_map = fleet(1, 150)
+    for instance in instances:
+        instance["Tags"] = [{"Key": "Name", "Value": "web"}]
+
+    def shards(instances):
+        records = ec2_dns.records_from_instances(instances, vpc_map, TTL,
+                                                 group_routing="weighted")
+        return set(r for r in records if r.name == "web.vpc0.example.com.")
+
+    published = shards(instances)
+    assert len(published) == ec2_dns.GROUP_SHARDS
+    assert len(set(ip for r in published for ip in r.records)) == 150
+
+    # An instance joining the group only changes the record set of its shard
+    instances.append(dict(instances[0], InstanceId="i-ffffffff",
+                          PrivateIpAddress="10.0.9.99"))
+    changed = shards(instances) - published
+    assert [r.set_identifier for r in changed] == \
+        [str(ec2_dns.group_shard("i-ffffffff"))]
+
+
+def test_converge_records_split_groups():
+    instances, vpc_map = fleet(2, 12)
+
+    changes = converge_fixture(instances, [], vpc_map,
+                               group_routing="weighted")
+    zone = [c["ResourceRecordSet"] for c in changes]
+    assert any(r.get("SetIdentifier") for r in zone)
+
+    # The split layout is stable, and reads back without changes
+    assert converge_fixture(instances, zone, vpc_map,
+                            group_routing="weighted") == []
+    assert converge_fixture(instances, zone, vpc_map, group_routing="weighted",
+                            bounded=True) == []
+
+    # An instance leaving its group only changes the record set of its shard
+    changes = converge_fixture(instances[1:], zone, vpc_map,
+                               group_routing="weighted")
+    assert sorted((c["ResourceRecordSet"]["Name"],
+                   c["ResourceRecordSet"].get("SetIdentifier"))
+                  for c in changes) == [
+        ("i-0000000000000000.vpc0.example.com.", None),
+        ("svc-0.vpc0.example.com.",
+         str(ec2_dns.group_shard("i-0000000000000000")))
+    ]
+
+
+@pytest.mark.parametrize("gone", [0, 5])
+def test_converge_instance_mixed_case_names(gone):
+    vpc_map = {PROD_VPC: "example.com"}
+    instances = [gen_instance_info_response(
+        name="DB" if i == 5 else "db", vpc_id=PROD_VPC,
+        instance_id="i-{:016x}".format(i),
+        private_ip="10.0.0.{}".format(i + 1),
+        launch_time=datetime(2017, 1, 1, 0, 0, i)) for i in range(6)]
+    others = [gen_instance_info_response(
+        name="web", vpc_id=PROD_VPC, instance_id="i-{:016x}".format(i),
+        private_ip="10.0.1.{}".format(i),
+        launch_time=datetime(2017, 1, 1, 0, 0, 0)) for i in range(10, 30)]
+    zone = zone_listing(ec2_dns.records_from_instances(
+        map(ec2_dns.slim_instance, instances + others), vpc_map, TTL))
+
+    # Both spellings publish into the same group, and the incremental update
+    # gets it to the same state as a full run
+    remaining = instances[:gone] + instances[gone + 1:]
+    expected = converge_fixture(remaining + others, zone, vpc_map)
+
+    instances[gone]["State"] = {"Code": 48, "Name": "terminated"}
+    ec2 = FakeEc2(instances + others)
+    route53 = FakeRoute53(zone)
+    register_client("ec2", ec2)
+    register_client("route53", route53)
+    ec2_dns.converge_instance(HOSTED_ZONE_ID, vpc_map, TTL,
+                              instances[gone]["InstanceId"], "terminated")
+
+    assert sorted(map(ec2_dns.format_change, route53.changes)) == \
+        sorted(map(ec2_dns.format_change, expected))
+    # Instances outside of the group are never described
+    assert not any(i in others for selected in ec2.selections.values()
+                   for i in selected)
+
+
+def test_converge_records_locations():
+    instances, vpc_map = fleet(3, 8)
+    location = ("arn:aws:iam::222222222222:role/ec2-dns", "eu-west-1")
+    remote = [i for i in instances if i["VpcId"] == "vpc-2"]
+    expected = converge_fixture(instances, [], vpc_map)
+
+    # Instances of the remote VPC are only visible through its own client
+    register_client("ec2", FakeEc2(remote), *location)
+    local = [i for i in instances if i["VpcId"] != "vpc-2"]
+    changes = converge_fixture(local, [], vpc_map,
+                               locations={"vpc-2": location})
+    assert sorted(map(ec2_dns.format_change, changes)) == \
+        sorted(map(ec2_dns.format_change, expected))
+
+
+def test_locations_from_env(monkeypatch):
+    monkeypatch.setenv("EC2_DNS_VPC_IDS", "vpc-0,vpc-1,vpc-2")
+    monkeypatch.setenv("EC2_DNS_VPC_ROLE_ARNS", ",arn:aws:iam::2:role/dns")
+    monkeypatch.setenv("EC2_DNS_VPC_REGIONS", ",eu-west-1,us-west-2")
+
+    assert ec2_dns.locations_from_env() == {
+        "vpc-1": ("arn:aws:iam::2:role/dns", "eu-west-1"),
+        "vpc-2": (None, "us-west-2")
+    }
+
+
+def test_inventory_fingerprint():
+    instances, vpc_map = fleet(2, 6)
+    config = [TTL, sorted(vpc_map.items())]
+    fingerprint = ec2_dns.inventory_fingerprint(instances, config)
+
+    assert ec2_dns.inventory_fingerprint(instances[::-1], config) == \
+        fingerprint
+    assert ec2_dns.inventory_fingerprint(instances[1:], config) != \
+        fingerprint
+    assert ec2_dns.inventory_fingerprint(instances, [TTL + 1]) != fingerprint
+
+    moved = [dict(i) for i in instances]
+    moved[0]["PrivateIpAddress"] = "10.9.9.9"
+    assert ec2_dns.inventory_fingerprint(moved, config) != fingerprint
+
+
+def test_converge_records_unchanged_inventory(tmpdir):
+    instances, vpc_map = fleet(2, 6)
+    store = FileStateStore(str(tmpdir))
+
+    def converge(instances, bounded=False):
+        route53 = FakeRoute53([])
+        register_client("ec2", FakeEc2(instances))
+        register_client("route53", route53)
+        metrics = Metrics()
+        ec2_dns.converge_records(HOSTED_ZONE_ID, vpc_map, TTL, state=store,
+                                 metrics=metrics, bounded=bounded,
+                                 full_interval=600)
+        return route53, metrics
+
+    route53, metrics = converge(instances)
+    assert route53.changes
+    assert metrics.get("InventoryUnchanged") == 0
+
+    # Nothing is listed or derived while the instances stay the same
+    for bounded in (False, True):
+        route53, metrics = converge(instances, bounded=bounded)
+        assert metrics.get("InventoryUnchanged") == 1
+        assert route53.listed == 0 and not route53.changes
+        assert metrics.get("Records") is None
+
+    route53, metrics = converge(instances[1:])
+    assert metrics.get("InventoryUnchanged") == 0
+    assert metrics.get("Records")
@@ -0,0 +1,56 @@
+from __future__ import absolute_import, unicode_literals
+
+from ec2_route53_lambdas import events
+
+
+def state_event(instance_id, state, time):
+    return {
+        "detail-type": events.STATE_CHANGE_EVENT,
+        "source": "aws.ec2",
+        "time": time,
+        "detail": {"instance-id": instance_id, "state": state}
+    }
+
+
+SCHEDULED_EVENT = {
+    "detail-type": "Scheduled Event",
+    "source": "aws.events",
+    "time": "2017-01-01T00:00:30Z"
+}
+
+
+def test_unwrap_events():
+    event = state_event("i-1", "pending", "2017-01-01T00:00:00Z")
+    assert events.unwrap_events(event) == [event]
+
+    queue = events.LocalQueue()
+    queue.send(event)
+    queue.send(SCHEDULED_EVENT)
+    assert events.unwrap_events(queue.receive()) == [event, SCHEDULED_EVENT]
+    assert queue.receive() is None
+
+
+def test_coalesce_events():
+    batch = [
+        state_event("i-2", "running", "2017-01-01T00:00:10Z"),
+        state_event("i-1", "pending", "2017-01-01T00:00:00Z"),
+        state_event("i-1", "terminated", "2017-01-01T00:00:20Z")
+    ]
+
+    states, full = events.coalesce_events(batch)
+    assert list(states.items()) == [("i-2", "running"),
+                                    ("i-1", "terminated")]
+    assert not full
+
+    states, full = events.coalesce_events(batch + [SCHEDULED_EVENT])
+    assert full
+
+
+def test_local_queue_drain():
+    queue = events.LocalQueue()
+    for i in range(25):
+        queue.send(state_event("i-{}".format(i), "pending",
+                               "2017-01-01T00:00:00Z"))
+
+    sizes = queue.drain(lambda batch, context: len(batch["Records"]))
+    assert sizes == [10, 10, 5]
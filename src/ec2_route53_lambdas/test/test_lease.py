@@ -0,0 +1,125 @@
+from __future__ import absolute_import, unicode_literals
+
+import pytest
+from botocore.exceptions import ClientError
+
+from ec2_route53_lambdas.lease import \
+    DynamoDBLeaseStore, FileLeaseStore, Lease, lease_store_from_url, \
+    single_flight
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def leases(store, clock, count=2):
+    return [Lease(store, "converge", duration=60, owner="owner-{}".format(i),
+                  clock=clock)
+            for i in range(count)]
+
+
+def test_file_lease(tmpdir):
+    clock = FakeClock()
+    first, second = leases(FileLeaseStore(str(tmpdir)), clock)
+
+    assert first.acquire()
+    assert not second.acquire()
+
+    # A dirty lease is kept, and renewed, for one more pass
+    assert second.mark_dirty()
+    assert not first.release()
+    assert not second.acquire()
+    assert first.release()
+
+    assert not second.mark_dirty()
+    assert second.acquire()
+
+    # Expired leases can be taken over, and are no longer the old holder's
+    clock.now += 61
+    assert first.acquire()
+    assert second.release()
+    assert not second.acquire()
+    first.abandon()
+    assert second.acquire()
+
+
+def test_single_flight(tmpdir):
+    clock = FakeClock()
+    first, second = leases(FileLeaseStore(str(tmpdir)), clock)
+    calls = []
+
+    def contend():
+        calls.append("func")
+        # Invocations arriving meanwhile don't run, and one extra pass
+        # covers all of them
+        assert not single_flight(second, calls.append)
+        assert not single_flight(second, calls.append)
+
+    assert single_flight(first, contend, again=lambda: calls.append("again"))
+    assert calls == ["func", "again"]
+
+    assert second.acquire()
+    assert not single_flight(first, calls.append, mark_dirty=False)
+    assert second.release()
+
+
+def test_single_flight_failure(tmpdir):
+    clock = FakeClock()
+    first, second = leases(FileLeaseStore(str(tmpdir)), clock)
+
+    def fail():
+        raise RuntimeError("Route53 failure")
+
+    with pytest.raises(RuntimeError):
+        single_flight(first, fail)
+
+    assert second.acquire()
+
+
+def test_dynamodb_lease(dynamodb_stub):
+    store = DynamoDBLeaseStore("leases")
+    key = {"LeaseKey": {"S": "converge"}}
+
+    dynamodb_stub.add_client_error(
+        "put_item", "ConditionalCheckFailedException", expected_params={
+            "TableName": "leases",
+            "Item": dict(key, Owner={"S": "owner-0"}, Expires={"N": "1060.0"},
+                         Dirty={"BOOL": False}),
+            "ConditionExpression": "attribute_not_exists(LeaseKey) OR "
+                                   "Expires < :now",
+            "ExpressionAttributeValues": {":now": {"N": "1000.0"}}
+        })
+    assert not store.acquire("converge", "owner-0", 1060.0, 1000.0)
+
+    dynamodb_stub.add_client_error("delete_item",
+                                   "ConditionalCheckFailedException")
+    dynamodb_stub.add_response("update_item", {}, {
+        "TableName": "leases",
+        "Key": key,
+        "UpdateExpression": "SET Dirty = :false, Expires = :expires",
+        "ConditionExpression": "Owner = :owner AND Dirty = :true",
+        "ExpressionAttributeValues": {
+            ":owner": {"S": "owner-0"},
+            ":true": {"BOOL": True},
+            ":false": {"BOOL": False},
+            ":expires": {"N": "1120.0"}
+        }
+    })
+    assert not store.release("converge", "owner-0", 1120.0)
+
+    dynamodb_stub.add_client_error("put_item", "ResourceNotFoundException")
+    with pytest.raises(ClientError):
+        store.acquire("converge", "owner-0", 1060.0, 1000.0)
+
+    dynamodb_stub.assert_no_pending_responses()
+
+
+def test_lease_store_from_url(tmpdir):
+    assert lease_store_from_url("") is None
+    assert lease_store_from_url("dynamodb://leases").table == "leases"
+    assert lease_store_from_url("file://" + str(tmpdir)).directory == \
+        str(tmpdir)
@@ -0,0 +1,63 @@
+from __future__ import absolute_import, unicode_literals
+
+import io
+import json
+
+from ec2_route53_lambdas.metrics import Metrics
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_metrics_timers():
+    clock = FakeClock()
+    metrics = Metrics(clock=clock)
+
+    with metrics.timer("Diff"):
+        clock.now += 1.5
+    with metrics.timer("Diff"):
+        clock.now += 0.5
+    assert metrics.get("DiffTime") == 2000
+
+    def items():
+        for i in range(2):
+            clock.now += 0.25
+            yield i
+
+    assert list(metrics.timed("ZoneListing", items())) == [0, 1]
+    assert metrics.get("ZoneListingTime") == 500
+
+
+def test_metrics_emf():
+    clock = FakeClock()
+    metrics = Metrics(dimensions={"HostedZoneId": "Z1"}, clock=clock)
+    metrics.add("ChangesCreate", 2)
+    metrics.add("ChangesCreate")
+    metrics.append("PropagationLatency", 30, unit="Seconds")
+    metrics.append("PropagationLatency", 45, unit="Seconds")
+
+    stream = io.StringIO()
+    metrics.emit(stream)
+    document = json.loads(stream.getvalue())
+
+    assert document == {
+        "_aws": {
+            "Timestamp": 1000000,
+            "CloudWatchMetrics": [{
+                "Namespace": "Ec2Dns",
+                "Dimensions": [["HostedZoneId"]],
+                "Metrics": [
+                    {"Name": "ChangesCreate", "Unit": "Count"},
+                    {"Name": "PropagationLatency", "Unit": "Seconds"}
+                ]
+            }]
+        },
+        "HostedZoneId": "Z1",
+        "ChangesCreate": 3,
+        "PropagationLatency": [30, 45]
+    }
@@ -0,0 +1,162 @@
+from __future__ import absolute_import, unicode_literals
+
+import io
+import json
+from datetime import datetime
+
+from botocore.response import StreamingBody
+
+from ec2_route53_lambdas import state
+from ec2_route53_lambdas.util import RecordSet
+
+
+HOSTED_ZONE_ID = "/hostedzone/Z1111111111111"
+DOMAINS = ["prod", "dev"]
+
+RECORDS = frozenset([
+    RecordSet("a.prod", "A", 60, {"10.0.0.1"}),
+    RecordSet.from_json({
+        "Name": "b.prod",
+        "Type": "A",
+        "TTL": 60,
+        "ResourceRecords": [{"Value": "10.0.0.2"}],
+        "HealthCheckId": "H123134"
+    })
+])
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_file_state_store(tmpdir):
+    store = state.FileStateStore(str(tmpdir.join("state")))
+    assert store.get("key") is None
+
+    store.put("key", {"a": [1, 2]})
+    assert store.get("key") == {"a": [1, 2]}
+
+    store.delete("key")
+    store.delete("key")
+    assert store.get("key") is None
+
+
+def test_object_state_store(s3_stub):
+    body = json.dumps({"a": 1}).encode("utf-8")
+    s3_stub.add_client_error("get_object", service_error_code="NoSuchKey",
+                             http_status_code=404,
+                             expected_params={"Bucket": "bucket",
+                                              "Key": "ec2-dns/key.json"})
+    s3_stub.add_response("put_object", {},
+                         {"Bucket": "bucket", "Key": "ec2-dns/key.json",
+                          "Body": body, "ContentType": "application/json"})
+    s3_stub.add_response(
+        "get_object",
+        {"Body": StreamingBody(io.BytesIO(body), len(body))},
+        {"Bucket": "bucket", "Key": "ec2-dns/key.json"})
+
+    store = state.state_store_from_url("s3://bucket/ec2-dns")
+    assert store.get("key") is None
+    store.put("key", {"a": 1})
+    assert store.get("key") == {"a": 1}
+    s3_stub.assert_no_pending_responses()
+
+
+def test_state_store_from_url(tmpdir):
+    assert state.state_store_from_url("") is None
+
+    store = state.state_store_from_url("file://" + str(tmpdir))
+    assert isinstance(store, state.FileStateStore)
+    assert store.directory == str(tmpdir)
+
+
+def test_zone_snapshot(tmpdir):
+    clock = FakeClock()
+    store = state.FileStateStore(str(tmpdir))
+    snapshot = state.ZoneSnapshot(store, HOSTED_ZONE_ID, DOMAINS, max_age=60,
+                                  clock=clock)
+    assert snapshot.load() is None
+
+    snapshot.save(RECORDS, clock.now)
+    loaded = snapshot.load()
+    assert loaded == RECORDS
+    assert {r.name: r.delete_request() for r in loaded} == \
+        {r.name: r.delete_request() for r in RECORDS}
+
+    # Snapshots are keyed on the zone and set of domains
+    other = state.ZoneSnapshot(store, HOSTED_ZONE_ID, ["prod"], clock=clock)
+    assert other.load() is None
+
+    clock.now += 61
+    assert snapshot.load() is None
+
+
+def test_zone_snapshot_apply(tmpdir):
+    clock = FakeClock()
+    snapshot = state.ZoneSnapshot(state.FileStateStore(str(tmpdir)),
+                                  HOSTED_ZONE_ID, DOMAINS, clock=clock)
+    new_a = RecordSet("a.prod", "A", 60, {"10.0.0.3"})
+    new_c = RecordSet("c.prod", "CNAME", 60, {"a.prod"})
+
+    snapshot.apply([new_a.change_request()])
+    assert snapshot.load() is None
+
+    snapshot.save(RECORDS, clock.now)
+    snapshot.apply([
+        new_a.change_request(existing=True),
+        new_c.change_request(),
+        RecordSet("b.prod", "A", 60, {"10.0.0.2"}).delete_request()
+    ])
+
+    assert snapshot.load() == {new_a, new_c}
+
+
+def test_zone_snapshot_invalidate(tmpdir):
+    snapshot = state.ZoneSnapshot(state.FileStateStore(str(tmpdir)),
+                                  HOSTED_ZONE_ID, DOMAINS)
+    snapshot.save(RECORDS, snapshot.clock())
+    snapshot.invalidate()
+    assert snapshot.load() is None
+
+
+def test_pending_changes(tmpdir):
+    clock = FakeClock()
+    pending = state.PendingChanges(state.FileStateStore(str(tmpdir)),
+                                   HOSTED_ZONE_ID, clock=clock)
+    assert pending.load() == []
+
+    pending.add([
+        {"Id": "C1", "Status": "PENDING",
+         "SubmittedAt": datetime(2017, 1, 1, 0, 0, 0)},
+        {"Id": "C2", "Status": "INSYNC"},
+        {"Id": "C3", "Status": "PENDING"}
+    ])
+    assert pending.load() == [
+        {"Id": "C1", "SubmittedAt": 1483228800},
+        {"Id": "C3", "SubmittedAt": clock.now}
+    ]
+
+    pending.save([])
+    assert pending.load() == []
+
+
+def test_inventory_fingerprint(tmpdir):
+    clock = FakeClock()
+    store = state.FileStateStore(str(tmpdir))
+    fingerprints = state.InventoryFingerprint(store, HOSTED_ZONE_ID, DOMAINS,
+                                              max_age=60, clock=clock)
+    assert not fingerprints.matches("abc")
+
+    fingerprints.save("abc")
+    assert fingerprints.matches("abc")
+    assert not fingerprints.matches("abd")
+
+    # A full reconcile is forced once the fingerprint is old enough
+    clock.now += 61
+    assert not fingerprints.matches("abc")
+    fingerprints.save("abc")
+    assert fingerprints.matches("abc")
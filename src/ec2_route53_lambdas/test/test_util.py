@@ -0,0 +1,291 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import datetime
+
+import boto3
+import pytest
+from dateutil.tz import tzutc
+
+from ec2_route53_lambdas import util
+
+
+def test_client_reused(mocker):
+    mocker.patch.dict(util.SCHEDULERS, clear=True)
+    client = mocker.patch.object(boto3, 'client', autospec=True,
+                                 side_effect=lambda *a, **kw: object())
+
+    assert util.route53() is util.route53()
+    assert util.ec2() is not util.route53()
+    assert client.call_count == 2
+    client.assert_any_call('route53', config=util.CLIENT_CONFIG)
+
+    util.reset_clients()
+    util.route53()
+    assert client.call_count == 3
+
+
+def test_client_assumed_role(sts_stub):
+    role_arn = "arn:aws:iam::222222222222:role/ec2-dns"
+    sts_stub.add_response("assume_role", {
+        "Credentials": {
+            "AccessKeyId": "AKIAEXAMPLE22222222",
+            "SecretAccessKey": "secret",
+            "SessionToken": "token",
+            "Expiration": datetime(2100, 1, 1, tzinfo=tzutc())
+        }
+    }, {"RoleArn": role_arn, "RoleSessionName": util.ROLE_SESSION_NAME})
+
+    client = util.ec2(role_arn, "eu-west-1")
+    assert client.meta.region_name == "eu-west-1"
+    assert client._request_signer._credentials.access_key == \
+        "AKIAEXAMPLE22222222"
+    assert util.ec2(role_arn, "eu-west-1") is client
+    sts_stub.assert_no_pending_responses()
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+def test_request_scheduler_token_bucket():
+    clock = FakeClock()
+    scheduler = util.RequestScheduler(rate=2, burst=2, clock=clock,
+                                      sleep=clock.sleep)
+
+    for _ in range(4):
+        scheduler.acquire()
+
+    # The burst goes out right away, the rest at the configured rate
+    assert clock.now == 1.0
+    assert scheduler.stats()["requests"] == 4
+    assert scheduler.stats()["wait_time"] == 1.0
+
+
+def test_request_scheduler_backoff(mocker):
+    mocker.patch("random.uniform", side_effect=lambda a, b: b)
+    scheduler = util.RequestScheduler(rate=4, burst=4, max_attempts=3)
+    throttled = (None, {"Error": {"Code": "Throttling"}})
+
+    assert scheduler._needs_retry(throttled, attempts=1) == 1.0
+    assert scheduler._needs_retry(throttled, attempts=2) == 2.0
+    assert scheduler._needs_retry(throttled, attempts=3) is None
+    assert scheduler._needs_retry(
+        (None, {"Error": {"Code": "InvalidChangeBatch"}}), attempts=1) is None
+    assert scheduler._needs_retry(None, attempts=1) is None
+
+    stats = scheduler.stats()
+    assert stats["throttled"] == 2
+    assert stats["backoff_time"] == 3.0
+    assert stats["rate"] == 1
+
+    scheduler._after_call(None, {})
+    assert scheduler.stats()["rate"] == 1.1
+
+
+def test_request_scheduler_registered(route53_stub):
+    util.ROUTE53_SCHEDULER.reset_stats()
+    route53_stub.add_response("get_change", {"ChangeInfo": {
+        "Id": "C1", "Status": "INSYNC", "SubmittedAt": "2017-01-01T00:00:00Z"
+    }}, {"Id": "C1"})
+
+    util.route53().get_change(Id="C1")
+    assert util.ROUTE53_SCHEDULER.stats()["requests"] == 1
+
+
+def asg_instances_response(states):
+    return {"AutoScalingInstances": [{
+        "InstanceId": instance_id,
+        "AutoScalingGroupName": "asg",
+        "AvailabilityZone": "us-east-1a",
+        "LifecycleState": state,
+        "HealthStatus": "HEALTHY",
+        "ProtectedFromScaleIn": False
+    } for instance_id, state in states]}
+
+
+class FakeContext(object):
+    def __init__(self, clock, remaining):
+        self.clock = clock
+        self.end = clock() + remaining
+
+    def get_remaining_time_in_millis(self):
+        return int((self.end - self.clock()) * 1000)
+
+
+def test_wait_asg_instance_states(asg_stub):
+    clock = FakeClock()
+    asg_stub.add_response(
+        "describe_auto_scaling_instances",
+        asg_instances_response([("i-1", "Pending:Wait"),
+                                ("i-2", "InService")]),
+        {"InstanceIds": ["i-1", "i-2", "i-3"]})
+    asg_stub.add_response(
+        "describe_auto_scaling_instances",
+        asg_instances_response([("i-1", "InService"),
+                                ("i-3", "Pending:Wait")]),
+        {"InstanceIds": ["i-1", "i-3"]})
+    asg_stub.add_response(
+        "describe_auto_scaling_instances",
+        asg_instances_response([("i-3", "InService")]),
+        {"InstanceIds": ["i-3"]})
+
+    timed_out = util.wait_asg_instance_states(
+        ["i-1", "i-2", "i-3"], "InService", clock=clock, sleep=clock.sleep)
+
+    assert timed_out == []
+    assert clock.sleeps == [1, 2]
+    asg_stub.assert_no_pending_responses()
+
+
+def test_wait_asg_instance_states_remaining_time(asg_stub):
+    clock = FakeClock()
+    context = FakeContext(clock, remaining=20)
+    for _ in range(5):
+        asg_stub.add_response(
+            "describe_auto_scaling_instances",
+            asg_instances_response([("i-1", "Pending:Wait"),
+                                    ("i-2", "InService")]))
+
+    timed_out = util.wait_asg_instance_states(
+        ["i-1", "i-2"], "InService", context=context, clock=clock,
+        sleep=clock.sleep)
+
+    # The wait stops `margin` seconds before the invocation runs out
+    assert timed_out == ["i-1"]
+    assert clock.sleeps == [1, 2, 4, 8]
+    assert context.get_remaining_time_in_millis() == 5000
+    asg_stub.assert_no_pending_responses()
+
+
+def test_wait_asg_instance_state(asg_stub):
+    asg_stub.add_response(
+        "describe_auto_scaling_instances",
+        asg_instances_response([]), {"InstanceIds": ["i-1"]})
+
+    with pytest.raises(RuntimeError):
+        util.wait_asg_instance_state("i-1", "InService", timeout=0)
+
+
+def test_domain_index():
+    index = util.DomainIndex(["prod.aws.example.com", "a.prod.aws.example.com.",
+                              "Dev.aws.example.com"])
+
+    assert index.match("db.prod.aws.example.com.") == "prod.aws.example.com"
+    assert index.match("x.y.prod.aws.example.com") == "prod.aws.example.com"
+    assert index.match("db.a.prod.aws.example.com.") == \
+        "a.prod.aws.example.com."
+    assert index.match("a.prod.aws.example.com.") == "prod.aws.example.com"
+    assert index.match("DB.dev.aws.example.com.") == "Dev.aws.example.com"
+
+    assert index.match("prod.aws.example.com.") is None
+    assert index.match("prefix-prod.aws.example.com.") is None
+    assert index.match("aws.example.com.") is None
+    assert index.match("com.") is None
+
+
+def test_record_set():
+    record = util.RecordSet("a.asd", "A", 300, ["1.1.1.2", "1.1.1.1"])
+    assert record.name == "a.asd."
+    assert record.records == frozenset(["1.1.1.1", "1.1.1.2"])
+    assert record == util.RecordSet("a.asd.", "A", 300, {"1.1.1.1", "1.1.1.2"})
+    assert hash(record) == hash(
+        util.RecordSet("a.asd.", "A", 300, {"1.1.1.2", "1.1.1.1"}))
+    assert record != util.RecordSet("a.asd", "A", 60, {"1.1.1.1", "1.1.1.2"})
+    assert record != util.RecordSet("a.asd", "A", 300, {"1.1.1.1"})
+    assert not hasattr(record, "__dict__")
+
+    assert record.change_request(existing=True) == {
+        "Action": "UPSERT",
+        "ResourceRecordSet": {
+            "Name": "a.asd.",
+            "Type": "A",
+            "TTL": 300,
+            "ResourceRecords": [{"Value": "1.1.1.1"}, {"Value": "1.1.1.2"}]
+        }
+    }
+
+    cname = util.RecordSet("b.asd", "CNAME", 300, ["a.asd"])
+    assert cname.records == frozenset(["a.asd."])
+    assert cname._replace(ttl=60) == util.RecordSet("b.asd.", "CNAME", 60,
+                                                    ["a.asd."])
+
+    # Values that aren't plain dotted quads are kept as they are
+    odd = util.RecordSet("c.asd", "A", 300, ["10.1"])
+    assert odd.records == frozenset(["10.1"])
+
+
+def test_record_set_json():
+    json = {
+        "Name": "c.asd",
+        "Type": "A",
+        "TTL": 300,
+        "ResourceRecords": [{"Value": "1.1.1.2"}],
+        "HealthCheckId": "H123134"
+    }
+    record = util.RecordSet.from_json(json)
+    assert record == util.RecordSet("c.asd", "A", 300, {"1.1.1.2"})
+    assert record.delete_request() == {"Action": "DELETE",
+                                       "ResourceRecordSet": json}
+    assert record.original_json == json
+
+    plain = util.RecordSet.from_json({
+        "Name": "d.asd.",
+        "Type": "A",
+        "TTL": 300,
+        "ResourceRecords": [{"Value": "1.1.1.3"}]
+    })
+    assert plain.original_json is None
+    assert plain.to_json() == {
+        "Name": "d.asd.",
+        "Type": "A",
+        "TTL": 300,
+        "ResourceRecords": [{"Value": "1.1.1.3"}]
+    }
+
+
+def test_record_set_routing_json():
+    json = {
+        "Name": "web.asd.",
+        "Type": "A",
+        "TTL": 300,
+        "ResourceRecords": [{"Value": "1.1.1.2"}],
+        "SetIdentifier": "i-1",
+        "Weight": 1
+    }
+    record = util.RecordSet.from_json(json)
+    assert record == util.RecordSet("web.asd", "A", 300, {"1.1.1.2"},
+                                    set_identifier="i-1",
+                                    routing=("Weight", 1))
+    assert record != util.RecordSet("web.asd", "A", 300, {"1.1.1.2"})
+    assert record.original_json is None
+    assert record.to_json() == json
+    assert record.change_request(existing=True) == {
+        "Action": "UPSERT", "ResourceRecordSet": json}
+
+
+def test_record_set_merge():
+    a = util.RecordSet("a.asd", "A", 300, {"1.1.1.1"})
+    b = util.RecordSet("a.asd", "A", 300, {"1.1.1.2", "1.1.1.3"})
+    merged = a.merge(b)
+    assert merged == util.RecordSet("a.asd", "A", 300,
+                                    {"1.1.1.1", "1.1.1.2", "1.1.1.3"})
+    assert a.merge(None) is a
+    assert a.merge(a) == a
+
+    odd = util.RecordSet("a.asd", "A", 300, {"10.1"})
+    assert a.merge(odd).records == frozenset(["1.1.1.1", "10.1"])
+
+    with pytest.raises(ValueError):
+        a.merge(util.RecordSet("a.asd", "CNAME", 300, {"b.asd"}))
+    with pytest.raises(ValueError):
+        util.RecordSet("a.asd", "CNAME", 300, {"b.asd"}).merge(
+            util.RecordSet("a.asd", "CNAME", 300, {"c.asd"}))
@@ -1,23 +1,109 @@
 from __future__ import absolute_import, unicode_literals
 
-import math
+import numbers
+import random
 import re
+import socket
+import struct
+import threading
 import time
-from collections import namedtuple
 
 import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
 
 
-class RecordSet(namedtuple('RecordSet', 'name type ttl records')):
-    def __new__(cls, name, type, ttl, records, original_json=None):
+try:
+    from sys import intern
+except ImportError:
+    # Python 2 can only intern byte strings, skip it there
+    def intern(s):
+        return s
+
+
+def pack_values(type, values):
+    values = list(values)
+    if type == 'A':
+        try:
+            packed = [struct.unpack('!I', socket.inet_aton(v))[0]
+                      for v in values]
+        except (socket.error, struct.error, TypeError):
+            packed = None
+
+        # inet_aton also accepts shorthands like "10.1", keep those as text
+        if packed and all(socket.inet_ntoa(struct.pack('!I', p)) == v
+                          for p, v in zip(packed, values)):
+            values = packed
+
+    values = tuple(sorted(set(values)))
+    # Most record sets have a single value, don't pay for a tuple then
+    return values[0] if len(values) == 1 else values
+
+
+def is_packed(values):
+    return bool(values) and isinstance(values[0], numbers.Integral)
+
+
+def unpack_values(values):
+    if not isinstance(values, tuple):
+        values = (values,)
+
+    if is_packed(values):
+        return [socket.inet_ntoa(struct.pack('!I', v)) for v in values]
+
+    return list(values)
+
+
+class RecordSet(object):
+    __slots__ = ('name', 'type', 'ttl', '_values', '_extra',
+                 'set_identifier', 'routing')
+
+    # Fields of the Route53 JSON that are rebuilt from the record itself, and
+    # so don't have to be kept around for delete requests
+    JSON_FIELDS = frozenset(['Name', 'Type', 'TTL', 'ResourceRecords',
+                             'SetIdentifier', 'MultiValueAnswer', 'Weight'])
+    # Routing policies the record can carry, as a (field, value) pair in
+    # `routing`. Record sets of the same name and type that use one are told
+    # apart by their `set_identifier`.
+    ROUTING_FIELDS = ('MultiValueAnswer', 'Weight')
+
+    def __init__(self, name, type, ttl, records, original_json=None,
+                 set_identifier=None, routing=None):
         if type == 'CNAME':
-            records = map(cls.normalize_name, records)
+            records = map(self.normalize_name, records)
+
+        self._init(self.normalize_name(name), type, ttl,
+                   pack_values(type, records),
+                   original_json and self._json_extra(original_json),
+                   set_identifier, routing)
 
-        inst = super(cls, RecordSet).__new__(cls, cls.normalize_name(name),
-                                             type, ttl, frozenset(records))
-        inst.original_json = original_json and dict(original_json)
+    def _init(self, name, type, ttl, values, extra, set_identifier=None,
+              routing=None):
+        self.name = intern(name)
+        self.type = intern(type)
+        self.ttl = ttl
+        self._values = values
+        self._extra = extra
+        self.set_identifier = set_identifier
+        self.routing = routing
+
+    @classmethod
+    def _make(cls, name, type, ttl, values, extra=None, set_identifier=None,
+              routing=None):
+        inst = cls.__new__(cls)
+        inst._init(name, type, ttl, values, extra, set_identifier, routing)
         return inst
 
+    @classmethod
+    def _json_extra(cls, json):
+        extra = dict((k, v) for k, v in json.items()
+                     if k not in cls.JSON_FIELDS)
+        if json['Name'] != cls.normalize_name(json['Name']):
+            extra['Name'] = json['Name']
+
+        return extra or None
+
     @classmethod
     def normalize_name(cls, name):
         if not name.endswith("."):
@@ -26,25 +112,86 @@ class RecordSet(namedtuple('RecordSet', 'name type ttl records')):
 
     @classmethod
     def from_json(cls, json):
+        routing = None
+        for field in cls.ROUTING_FIELDS:
+            if field in json:
+                routing = (field, json[field])
+
         return cls(name=json['Name'], type=json['Type'], ttl=json['TTL'],
                    records=[r['Value'] for r in json['ResourceRecords']],
-                   original_json=json)
+                   original_json=json,
+                   set_identifier=json.get('SetIdentifier'), routing=routing)
+
+    @property
+    def records(self):
+        return frozenset(unpack_values(self._values))
+
+    @property
+    def original_json(self):
+        return self.to_json() if self._extra else None
+
+    def _key(self):
+        return (self.name, self.type, self.set_identifier, self.routing,
+                self.ttl, self._values)
+
+    def __eq__(self, other):
+        if not isinstance(other, RecordSet):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        routing = ''
+        if self.set_identifier is not None:
+            routing = ', set_identifier={!r}, routing={!r}'.format(
+                self.set_identifier, self.routing)
+
+        return 'RecordSet(name={!r}, type={!r}, ttl={!r}, records={!r}{})' \
+            .format(self.name, self.type, self.ttl, self.records, routing)
+
+    def _replace(self, **kwargs):
+        fields = dict(name=self.name, type=self.type, ttl=self.ttl,
+                      records=self.records,
+                      set_identifier=self.set_identifier,
+                      routing=self.routing)
+        fields.update(kwargs)
+        return RecordSet(**fields)
 
     def change_request(self, existing=False):
+        record_set = {
+            'Name': self.name,
+            'Type': self.type,
+            'TTL': self.ttl,
+            'ResourceRecords': [
+                {'Value': r} for r in unpack_values(self._values)]
+        }
+        if self.set_identifier is not None:
+            record_set['SetIdentifier'] = self.set_identifier
+        if self.routing is not None:
+            field, value = self.routing
+            record_set[field] = value
+
         return {
             'Action': ('UPSERT' if existing else 'CREATE'),
-            'ResourceRecordSet': {
-                'Name': self.name,
-                'Type': self.type,
-                'TTL': self.ttl,
-                'ResourceRecords': [{'Value': r} for r in self.records]
-            }
+            'ResourceRecordSet': record_set
         }
 
+    def to_json(self):
+        json = self.change_request()['ResourceRecordSet']
+        if self._extra:
+            json.update(self._extra)
+        return json
+
     def delete_request(self):
         return {
             'Action': 'DELETE',
-            'ResourceRecordSet': self.original_json
+            'ResourceRecordSet': self.to_json()
         }
 
     def merge(self, other):
@@ -58,42 +205,320 @@ class RecordSet(namedtuple('RecordSet', 'name type ttl records')):
 
             raise ValueError("Cannot merge CNAME records")
 
-        return self._replace(records=self.records | other.records)
+        mine, theirs = self._value_tuple(), other._value_tuple()
+        if is_packed(mine) != is_packed(theirs):
+            return self._replace(records=self.records | other.records)
+
+        # Merge the packed values directly, without converting them to text
+        values = tuple(sorted(set(mine).union(theirs)))
+        return self._make(self.name, self.type, self.ttl,
+                          values[0] if len(values) == 1 else values,
+                          set_identifier=self.set_identifier,
+                          routing=self.routing)
+
+    def _value_tuple(self):
+        values = self._values
+        return values if isinstance(values, tuple) else (values,)
+
+
+class DomainIndex(object):
+    def __init__(self, domains):
+        self.domains = dict((RecordSet.normalize_name(d).lower(), d)
+                            for d in domains)
+
+    def match(self, name):
+        # Check every suffix of the name starting after a label boundary,
+        # longest first, so the most specific domain that strictly contains
+        # the name wins. Cost depends on the number of labels, not domains.
+        name = RecordSet.normalize_name(name).lower()
+        dot = name.find(".")
+        while 0 <= dot < len(name) - 1:
+            domain = self.domains.get(name[dot + 1:])
+            if domain is not None:
+                return domain
+            dot = name.find(".", dot + 1)
+
+        return None
+
+
+# Errors Route53 returns when the account-wide request rate is exceeded, or
+# while it's still processing a previous change batch for the same zone
+THROTTLING_CODES = frozenset(["Throttling", "ThrottlingException",
+                              "PriorRequestNotComplete"])
+
+
+# Token bucket shared by every client of a service in the process. Calls
+# reserve a token before being sent, waiting for it if the bucket is empty.
+# Throttling errors halve the rate and are retried with jittered exponential
+# backoff, and each successful call adds back a fraction of the rate, so
+# concurrent runs slow down under contention instead of failing.
+class RequestScheduler(object):
+    def __init__(self, rate, burst, min_rate=0.5, rate_step=0.1,
+                 max_attempts=10, base_delay=0.5, max_delay=20,
+                 clock=time.time, sleep=time.sleep):
+        self.max_rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.rate_step = rate_step
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = burst
+        self.updated = clock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.requests = 0
+        self.throttled = 0
+        self.wait_time = 0.0
+        self.backoff_time = 0.0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "wait_time": self.wait_time,
+                "backoff_time": self.backoff_time,
+                "rate": self.rate
+            }
+
+    def acquire(self):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            # Tokens can go negative, queueing callers in the order they
+            # arrived without holding the lock while they wait
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+            self.requests += 1
+            self.wait_time += delay
+
+        if delay > 0:
+            self.sleep(delay)
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+
+    def backoff(self, attempts):
+        with self.lock:
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            delay = random.uniform(
+                0, min(self.max_delay, self.base_delay * 2 ** attempts))
+            self.backoff_time += delay
+
+        return delay
+
+    def _before_call(self, **kwargs):
+        self.acquire()
+
+    def _after_call(self, http_response, parsed, **kwargs):
+        if "Error" not in parsed:
+            self.succeeded()
+
+    def _needs_retry(self, response, attempts, caught_exception=None,
+                     **kwargs):
+        if response is None:
+            return None
+
+        code = response[1].get("Error", {}).get("Code")
+        if code not in THROTTLING_CODES or attempts >= self.max_attempts:
+            return None
+
+        return self.backoff(attempts)
+
+    def register(self, client):
+        # Registered first so they run before botocore's own retry handler.
+        # The wildcard is matched before the service name would be, so calls
+        # are also counted when stubbed responses short-circuit them in tests
+        events = client.meta.events
+        service_id = client.meta.service_model.service_id.hyphenize()
+        events.register_first("before-call.*.*", self._before_call)
+        events.register_first("after-call." + service_id, self._after_call)
+        events.register_first("needs-retry." + service_id, self._needs_retry)
+
+
+# Route53 allows 5 requests per second for the whole account
+ROUTE53_SCHEDULER = RequestScheduler(rate=4, burst=5)
+
+SCHEDULERS = {
+    'route53': ROUTE53_SCHEDULER
+}
+
+CLIENT_CONFIG = Config(
+    connect_timeout=5,
+    read_timeout=30,
+    max_pool_connections=20,
+    retries={'max_attempts': 5})
+
+_clients = {}
+# Reentrant, as clients for assumed roles need the STS client to be built
+_clients_lock = threading.RLock()
+
+
+ROLE_SESSION_NAME = 'ec2-route53-lambdas'
+
+
+# Session with the credentials of `role_arn`, assumed again whenever they are
+# about to expire, so clients built from it can be cached like any other.
+def assumed_role_session(role_arn, region=None):
+    def assume_role():
+        credentials = sts().assume_role(
+            RoleArn=role_arn, RoleSessionName=ROLE_SESSION_NAME)['Credentials']
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat()
+        }
+
+    session = botocore.session.get_session()
+    session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=assume_role(), refresh_using=assume_role,
+        method='sts-assume-role')
+    return boto3.Session(botocore_session=session, region_name=region)
+
+
+def _client_key(service, role_arn=None, region=None):
+    return (service, role_arn, region) if role_arn or region else service
+
+
+# Clients are expensive to build (service models are parsed and a connection
+# pool is set up for each one), so they are created once per process and
+# shared between threads and warm Lambda invocations. Clients for another
+# account, through `role_arn`, or another region are kept apart.
+def client(service, role_arn=None, region=None):
+    key = _client_key(service, role_arn, region)
+    try:
+        return _clients[key]
+    except KeyError:
+        pass
+
+    with _clients_lock:
+        if key not in _clients:
+            if role_arn:
+                instance = assumed_role_session(role_arn, region).client(
+                    service, config=CLIENT_CONFIG)
+            elif region:
+                instance = boto3.client(service, region_name=region,
+                                        config=CLIENT_CONFIG)
+            else:
+                instance = boto3.client(service, config=CLIENT_CONFIG)
+
+            if service in SCHEDULERS:
+                SCHEDULERS[service].register(instance)
+            _clients[key] = instance
+
+        return _clients[key]
+
+
+def register_client(service, instance, role_arn=None, region=None):
+    with _clients_lock:
+        _clients[_client_key(service, role_arn, region)] = instance
+
+
+def reset_clients():
+    with _clients_lock:
+        _clients.clear()
 
 
 def aws_lambda():
-    return boto3.client('lambda')
+    return client('lambda')
+
 
+def dynamodb():
+    return client('dynamodb')
 
-def ec2():
-    return boto3.client('ec2')
+
+def ec2(role_arn=None, region=None):
+    return client('ec2', role_arn, region)
 
 
 def asg():
-    return boto3.client('autoscaling')
+    return client('autoscaling')
 
 
 def cfn():
-    return boto3.client('cloudformation')
+    return client('cloudformation')
 
 
 def route53():
-    return boto3.client('route53')
+    return client('route53')
 
 
-def wait_asg_instance_state(instance_id, desired_state, delay=10, timeout=120):
-    for attempt in range(int(math.ceil(timeout / delay))):
-        response = asg().describe_auto_scaling_instances(
-            InstanceIds=[instance_id])
+def s3():
+    return client('s3')
+
+
+def sts():
+    return client('sts')
+
+
+ASG_BATCH_SIZE = 50
 
-        state = response['AutoScalingInstances'][0]['LifecycleState']
-        if state == desired_state:
+
+def describe_asg_instance_states(instance_ids):
+    states = {}
+    paginator = asg().get_paginator('describe_auto_scaling_instances')
+    for i in range(0, len(instance_ids), ASG_BATCH_SIZE):
+        batch = instance_ids[i:i + ASG_BATCH_SIZE]
+        for page in paginator.paginate(InstanceIds=batch):
+            for instance in page['AutoScalingInstances']:
+                states[instance['InstanceId']] = instance['LifecycleState']
+
+    return states
+
+
+# Waits for all of `instance_ids` to reach `desired_state`, fetching their
+# states together on each round. Rounds back off exponentially, and the wait
+# ends early enough to leave `margin` seconds of the Lambda invocation in
+# `context`. Returns the IDs of the instances that didn't get there in time.
+def wait_asg_instance_states(instance_ids, desired_state, context=None,
+                             timeout=120, base_delay=1, max_delay=10,
+                             margin=5, clock=time.time, sleep=time.sleep):
+    deadline = clock() + timeout
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000.0
+        deadline = min(deadline, clock() + remaining - margin)
+
+    pending = list(instance_ids)
+    attempts = 0
+    while pending:
+        states = describe_asg_instance_states(pending)
+        pending = [i for i in pending if states.get(i) != desired_state]
+
+        left = deadline - clock()
+        if not pending or left <= 0:
             break
 
-        time.sleep(delay)
-    else:
+        sleep(min(max_delay, base_delay * 2 ** attempts, left))
+        attempts += 1
+
+    return pending
+
+
+def wait_asg_instance_state(instance_id, desired_state, delay=10, timeout=120):
+    if wait_asg_instance_states([instance_id], desired_state, timeout=timeout,
+                                max_delay=delay):
         raise RuntimeError('Failed to wait for instance LifecycleState')
 
 
+def route53_sort_key(name):
+    # Route53 lists records ordered by name with the labels reversed,
+    # including the trailing dot (e.g. "com.example.www.")
+    labels = RecordSet.normalize_name(name)[:-1].split(".")
+    return ".".join(reversed(labels)) + "."
+
+
 def clean_hostname(s):
     return re.sub(r"[^a-z0-9-_]", "", s.lower())